@@ -1,6 +1,6 @@
 from django.contrib import admin
 
-from .models import Book, Category, OrderBook, Order, Address, ExtraImage
+from .models import Book, Category, OrderBook, Order, Address, ExtraImage, Payment, PaymentEvent
 
 
 class ExtraImageAdmin(admin.StackedInline):
@@ -20,4 +20,10 @@ class ExtraImageAdmin(admin.ModelAdmin):
 admin.site.register(OrderBook)
 admin.site.register(Order)
 admin.site.register(Address)
-admin.site.register(Category)
\ No newline at end of file
+admin.site.register(Category)
+admin.site.register(Payment)
+
+@admin.register(PaymentEvent)
+class PaymentEventAdmin(admin.ModelAdmin):
+    list_display = ['topic', 'resource_id', 'received_at', 'processed_at', 'attempts']
+    list_filter = ['topic', 'processed_at']
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DjbooksappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'djbooks'
+
+    def ready(self):
+        from djbooks import signals  # noqa: F401
@@ -0,0 +1,262 @@
+"""
+Precompiled CSS/JS bundles, built by ``python manage.py build_assets``.
+
+Each bundle in ``BUNDLES`` is its sources (SCSS compiled with libsass,
+CSS minified with rcssmin, JS with rjsmin) concatenated into one file
+named after its content hash, e.g. ``build/site.3f2a9c1e04b7.css``,
+next to ``.gz`` and, when the ``brotli`` package is installed, ``.br``
+copies. Hashed names never change content, so they can be cached
+forever; ``build/manifest.json`` maps bundle names to them.
+
+Templates include bundles with ``{% bundle 'site.css' %}`` (see
+djbooks.templatetags.template_tags). With ``ASSET_BUNDLES`` off, or
+before the first build, the tag links the sources one by one like the
+templates used to (SCSS through sass_processor).
+
+Relative ``url()`` references in the CSS are rewritten to absolute
+static URLs, the bundles live in another directory than their sources.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import FileResponse, Http404
+from django.templatetags.static import static
+from django.utils.html import format_html_join
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# libsass, rcssmin and rjsmin are imported by the functions building the
+# bundles, pages only read the manifest
+
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+
+# name -> sources, relative to the static root, in the order they were linked
+BUNDLES = {
+    # base.html
+    'site.css': [
+        'assets/scss/bootstrap.scss',
+        'assets/scss/inner-page.scss',
+        'assets/scss/font-awesome.scss',
+        'assets/scss/themify.scss',
+        'assets/css/safari-dropdown.css',
+    ],
+    # base-home.html
+    'home.css': [
+        'assets/scss/bootstrap.scss',
+        'assets/scss/font-awesome.scss',
+        'assets/scss/themify.scss',
+        'assets/scss/flaticon.scss',
+        'assets/css/safari-dropdown.css',
+    ],
+    'vendor.js': [
+        'assets/js/jquery-3.3.1.min.js',
+        'assets/js/popper.min.js',
+        'assets/js/bootstrap.js',
+    ],
+    # After the page scripts
+    'main.js': [
+        'assets/js/main.js',
+    ],
+    # Pages
+    'ecommerce.css': [
+        'assets/css/owl.carousel.min.css',
+        'assets/css/owl.theme.default.min.css',
+        'assets/scss/magnific-popup.scss',
+        'assets/scss/color-7.scss',
+    ],
+    'ecommerce.js': [
+        'assets/js/owl.carousel.min.js',
+        'assets/js/magnific-popup.js',
+        'assets/js/isotope.min.js',
+        'assets/js/portfolio.js',
+        'assets/js/aos.js',
+        'assets/js/ecommerce.js',
+    ],
+    'book.css': [
+        'assets/scss/slick.scss',
+        'assets/scss/slick-theme.scss',
+    ],
+    'book.js': [
+        'assets/js/slick.js',
+        'assets/js/product.js',
+    ],
+    'category.js': [
+        'assets/js/category.js',
+        'assets/js/cart.js',
+    ],
+}
+
+URL_RE = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+def static_root():
+    return str(settings.STATIC_ROOT)
+
+
+def build_root():
+    return os.path.join(static_root(), BUILD_DIR)
+
+
+def absolute_urls(css, source):
+    """Point the relative ``url()`` of ``source``'s CSS at the static URL."""
+    base = posixpath.dirname(source)
+
+    def replace(match):
+        url = match.group(2)
+        if url.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+            return match.group(0)
+        # Font URLs carry ?v= and #id suffixes, left as they are
+        path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        return 'url("%s%s")' % (static(posixpath.normpath(posixpath.join(base, path))), suffix)
+
+    return URL_RE.sub(replace, css)
+
+
+def read_source(source):
+    """``source``'s CSS or JS as served without bundles."""
+    import sass
+
+    path = os.path.join(static_root(), source)
+    if source.endswith(('.scss', '.sass')):
+        # sass_processor's default output style
+        return sass.compile(filename=path, output_style='nested')
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def minify(text, source):
+    import rcssmin
+    import rjsmin
+
+    if source.endswith('.js'):
+        # Statements end at newlines in some theme scripts, keep them apart
+        return rjsmin.jsmin(text).rstrip().rstrip(';') + ';'
+    return absolute_urls(rcssmin.cssmin(text), source)
+
+
+def hashed_name(name, content):
+    root, ext = os.path.splitext(name)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+
+
+def write_compressed(path, content):
+    """Write the ``.gz`` (and ``.br``) copies of ``path``, returns their sizes."""
+    sizes = {}
+    # mtime=0 so rebuilding the same content gives the same file
+    data = gzip.compress(content, compresslevel=9, mtime=0)
+    with open(path + '.gz', 'wb') as f:
+        f.write(data)
+    sizes['gz'] = len(data)
+    if brotli is not None:
+        data = brotli.compress(content, quality=11)
+        with open(path + '.br', 'wb') as f:
+            f.write(data)
+        sizes['br'] = len(data)
+    return sizes
+
+
+def build_bundle(name):
+    """Build ``name``, returns ``(hashed name, sizes)``."""
+    texts = [(source, read_source(source)) for source in BUNDLES[name]]
+    separator = '\n' if name.endswith('.js') else ''
+    content = separator.join(minify(text, source) for source, text in texts).encode()
+    filename = hashed_name(name, content)
+    path = os.path.join(build_root(), filename)
+    with open(path, 'wb') as f:
+        f.write(content)
+    sizes = {
+        'sources': sum(len(text.encode()) for _, text in texts),
+        'min': len(content),
+    }
+    sizes.update(write_compressed(path, content))
+    return filename, sizes
+
+
+def build(names=None):
+    """Build the bundles and write the manifest, returns ``{name: (file, sizes)}``."""
+    os.makedirs(build_root(), exist_ok=True)
+    built = {name: build_bundle(name) for name in names or BUNDLES}
+    manifest = load_manifest.__wrapped__() if names else {}
+    manifest.update({name: filename for name, (filename, _) in built.items()})
+    with open(os.path.join(build_root(), MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    load_manifest.cache_clear()
+    return built
+
+
+def remove_stale():
+    """Delete built files the manifest no longer points to, returns how many."""
+    keep = set(load_manifest().values())
+    removed = 0
+    for filename in os.listdir(build_root()):
+        original = filename[:-3] if filename.endswith(('.gz', '.br')) else filename
+        if filename != MANIFEST and original not in keep:
+            os.remove(os.path.join(build_root(), filename))
+            removed += 1
+    return removed
+
+
+@lru_cache(maxsize=None)
+def load_manifest():
+    # Read once per process, restart after building
+    try:
+        with open(os.path.join(build_root(), MANIFEST)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def bundle_urls(name):
+    """URLs to link for bundle ``name``, the built file or its sources."""
+    if getattr(settings, 'ASSET_BUNDLES', not settings.DEBUG):
+        filename = load_manifest().get(name)
+        if filename:
+            return [static(f'{BUILD_DIR}/{filename}')]
+    from sass_processor.processor import sass_processor
+
+    return [
+        sass_processor(source) if source.endswith(('.scss', '.sass')) else static(source)
+        for source in BUNDLES[name]
+    ]
+
+
+def bundle_tags(name):
+    urls = ((url,) for url in bundle_urls(name))
+    if name.endswith('.css'):
+        return format_html_join('\n', '<link href="{}" rel="stylesheet" type="text/css">', urls)
+    return format_html_join('\n', '<script src="{}"></script>', urls)
+
+
+def serve(request, path):
+    """
+    Serve a built file picking its brotli or gzip copy, for runserver.
+    In production the web server does the same (gzip_static/brotli_static).
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    full_path = os.path.join(build_root(), path)
+    if path.startswith('..') or not os.path.isfile(full_path):
+        raise Http404(path)
+    accepted = request.headers.get('Accept-Encoding', '')
+    encoding = None
+    for suffix, name in (('.br', 'br'), ('.gz', 'gzip')):
+        if name in accepted and os.path.isfile(full_path + suffix):
+            full_path, encoding = full_path + suffix, name
+            break
+    response = FileResponse(open(full_path, 'rb'), content_type=mimetypes.guess_type(path)[0])
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Vary'] = 'Accept-Encoding'
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
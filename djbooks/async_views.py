@@ -0,0 +1,218 @@
+"""
+Async versions of the read heavy catalog views, routed by
+``unice.urls_async`` when ``settings.ASYNC_VIEWS`` is on (the default
+under ``unice/asgi.py``).
+
+The sync views hand lazy querysets to templates that only evaluate them
+when a ``{% cache %}`` fragment has to be rendered again. These views
+pass the same lazy values, so a fragment evicted or invalidated while
+the request runs is still rendered from fresh data. Templates can't
+await, so the fragments that are already stale are looked up first and
+their queries run together with ``asyncio.gather``; the results replace
+the lazy values. The fragment keys are read from the ``{% cache %}``
+tags of the templates themselves. Rendering, the context processors and
+the sync parts of the catalog (search backends, facets, keyset
+pagination) run through ``sync_to_async``.
+
+Django 4.1's async ORM still runs each query in the request's sync
+thread, so queries gathered in one request take turns on its connection,
+while the event loop keeps serving other requests.
+"""
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.cache.utils import make_template_fragment_key
+from django.core.paginator import Paginator
+from django.http import Http404
+from django.middleware.csrf import get_token
+from django.shortcuts import render
+from django.template import Context
+from django.template.loader import get_template
+from django.template.loader_tags import ExtendsNode, IncludeNode
+from django.templatetags.cache import CacheNode
+from django.views.generic import View
+
+from djbooks import views
+from djbooks.catalog_cache import get_book_version, get_catalog_version
+from djbooks.forms import SearchForm
+from djbooks.models import Book, Category
+from djbooks.search import search_books
+from djbooks.stats import category_book_counts
+
+
+render_async = sync_to_async(render)
+
+
+async def alist(queryset):
+    return [obj async for obj in queryset]
+
+
+async def gather_dict(**awaitables):
+    """``asyncio.gather`` keyed by name."""
+    results = await asyncio.gather(*awaitables.values())
+    return dict(zip(awaitables, results))
+
+
+async def nothing():
+    return None
+
+
+def fragment_cache():
+    # Same cache as the {% cache %} tag
+    try:
+        return caches['template_fragments']
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def cache_nodes(template_name, seen=None):
+    """The ``{% cache %}`` nodes of a template, its parents and includes."""
+    seen = set() if seen is None else seen
+    if template_name in seen:
+        return []
+    seen.add(template_name)
+    nodes = []
+    nodelist = get_template(template_name).template.nodelist
+    for node in nodelist.get_nodes_by_type((CacheNode, ExtendsNode, IncludeNode)):
+        if isinstance(node, CacheNode):
+            nodes.append(node)
+            continue
+        name = node.parent_name if isinstance(node, ExtendsNode) else node.template
+        # Only names written in the template, not variables
+        if isinstance(name.var, str) and not name.filters:
+            nodes.extend(cache_nodes(name.var, seen))
+    return nodes
+
+
+def fragment_keys(template_name, context):
+    """``{fragment name: cache key}`` as the template would render them."""
+    template_context = Context(context)
+    return {
+        node.fragment_name: make_template_fragment_key(
+            node.fragment_name, [var.resolve(template_context) for var in node.vary_on])
+        for node in cache_nodes(template_name)
+    }
+
+
+async def stale_fragments(template_name, context):
+    """Names of the fragments of the template that aren't cached."""
+    keys = await sync_to_async(fragment_keys)(template_name, context)
+    cached = await fragment_cache().aget_many(list(keys.values()))
+    return {name for name, key in keys.items() if key not in cached}
+
+
+INDEX_TEMPLATE = 'home/ecommerce_layout/ecommerce_layout.html'
+
+
+async def index(request):
+    catalog_version = await sync_to_async(get_catalog_version)()
+    books = Book.objects.order_by('-id')
+    context = {
+        'books': books[:10],
+        'new_books': books[:5],
+        'categories': Category.objects.all(),
+        'catalog_version': catalog_version,
+        'header_classes': 'ecommerce nav-fix',
+        'header_image': views.default_header_image}
+    stale = await stale_fragments(INDEX_TEMPLATE, context)
+    data = await gather_dict(
+        books=alist(books[:10]) if stale & {'home_newest', 'home_books'} else nothing(),
+        categories=alist(Category.objects.all()) if stale & {'header_categories', 'header_categories_dropdown'} else nothing(),
+    )
+    if data['books'] is not None:
+        context.update(books=data['books'], new_books=data['books'][:5])
+    if data['categories'] is not None:
+        context['categories'] = data['categories']
+    return await render_async(request, INDEX_TEMPLATE, context)
+
+
+async def collection(request):
+    catalog_version = await sync_to_async(get_catalog_version)()
+    context = {
+        "header": "dark",
+        "layout": "agency",
+        # Called by the template when the fragment is rendered
+        "data": category_book_counts,
+        "catalog_version": catalog_version,
+    }
+    if await stale_fragments('collection.html', context):
+        context['data'] = {category: category.book_count async for category in Category.objects.all()}
+    return await render_async(request, 'collection.html', context)
+
+
+async def book_detail(request, slug):
+    book, catalog_version = await asyncio.gather(
+        Book.objects.filter(slug=slug).afirst(), sync_to_async(get_catalog_version)())
+    if book is None:
+        raise Http404("No existe ese libro")
+    book_version = await sync_to_async(get_book_version)(book.pk)
+    context = {
+        'object': book,
+        'book': book,
+        'layout': 'agency',
+        'header': 'dark position-relative nav-lg',
+        'book_version': book_version,
+        'catalog_version': catalog_version,
+        'tags': book.tags.all(),
+        'extra_images': book.extraimage_set.all(),
+        'related_books': book.get_related_books(),
+    }
+    stale = await stale_fragments(views.BookDetailView.template_name, context)
+    data = await gather_dict(
+        category=book.category.order_by('pk').afirst() if 'book_breadcrumb' in stale else nothing(),
+        extra_images=alist(book.extraimage_set.all()) if 'book_detail' in stale else nothing(),
+        tags=alist(book.tags.all()) if 'book_detail' in stale else nothing(),
+        related_books=alist(book.get_related_books()) if 'book_related' in stale else nothing(),
+    )
+    if 'book_breadcrumb' in stale:
+        # Otherwise Book.main_category queries it if the fragment is rendered
+        book.main_category = data['category']
+    context.update({name: value for name, value in data.items() if name != 'category' and value is not None})
+    return await render_async(request, views.BookDetailView.template_name, context)
+
+
+def search_page(query, number):
+    # The search backends run raw SQL, the page is loaded here
+    return Paginator(search_books(query), views.SEARCH_RESULTS_PER_PAGE).get_page(number)
+
+
+async def search_view(request):
+    form = SearchForm(request.GET)
+    results = []
+    if form.is_valid():
+        results = await sync_to_async(search_page)(form.cleaned_data['query'], request.GET.get('page'))
+    return await render_async(request, 'search-book.html', {
+        'form': form, 'results': results, "layout": views.default_layout,
+        "header": "dark position-relative nav-lg"})
+
+
+class CollectionListView(views.CollectionListView):
+    """
+    The facets and the page of books don't depend on each other, they are
+    computed together once the category is known.
+    """
+    # The sync view's dispatch is wrapped by ensure_csrf_cookie, which
+    # can't wrap a coroutine (see get)
+    dispatch = View.dispatch
+
+    async def get(self, request, *args, **kwargs):
+        try:
+            self.category = await Category.objects.aget(slug=self.kwargs['category'])
+        except Category.DoesNotExist:
+            raise Http404("No existe esa categoría")
+        self.object_list = self.get_queryset()
+        _, self.page = await asyncio.gather(
+            sync_to_async(self.get_facets)(), sync_to_async(self.load_page)())
+        context = await sync_to_async(self.get_context_data)()
+        # What ensure_csrf_cookie does for the sync view, the cart buttons post
+        get_token(request)
+        # Rendered by the handler, in a thread
+        return self.render_to_response(context)
+
+    def load_page(self):
+        return super().paginate_queryset(self.object_list, self.get_paginate_by(self.object_list))
+
+    def paginate_queryset(self, queryset, page_size):
+        # Already loaded by get()
+        return self.page
@@ -0,0 +1,305 @@
+"""
+As-you-type suggestions for the search box.
+
+Titles, authors and tags live in an in-process index: every suggestion
+is stored under the folded text starting at each of its words (so
+"soledad" finds "Cien años de soledad") in a list sorted by key, plus a
+list sorted by popularity. A prefix is a ``bisect`` range on the first
+list; when that range is too large to rank, the popularity list is
+walked instead, which finds enough matches quickly precisely because
+the prefix is common. Queries never touch the database.
+
+Server processes build the index at startup (``start()``, called by
+unice.wsgi and unice.asgi) in a background thread, which rebuilds it
+every ``AUTOCOMPLETE_REBUILD_INTERVAL`` seconds so other processes'
+edits and the popularity are picked up. A rebuild fills a new index and
+swaps it in whole, requests keep using the old one meanwhile. Until the
+first build ends there are no suggestions. Processes that never called
+``start()`` (tests, shells) build it in place on first use. A process
+forked after ``start()`` (gunicorn ``--preload``) inherits the index but
+not the thread, it starts its own on first use.
+
+The signals of the process that edits a book apply the edit to the
+current index, and to the one being built if any. An index is changed
+and read under its lock.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from heapq import nsmallest
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Count
+from django.urls import reverse
+from django.utils.http import urlencode
+from taggit.models import TaggedItem
+
+from djbooks.helpers import fold
+from djbooks.models import Book, OrderBook
+
+
+logger = logging.getLogger(__name__)
+
+SUGGESTIONS = 8
+MIN_PREFIX = 2
+# Larger ranges are served from the popularity list
+SCAN_LIMIT = 2000
+WORD_RE = re.compile(r'\w+')
+# Sorts after every character a key can contain
+HIGH = '\U0010ffff'
+
+
+def word_keys(text):
+    """The folded ``text`` starting at each of its words."""
+    folded = fold(text)
+    keys = [folded[match.start():] for match in WORD_RE.finditer(folded)]
+    if folded and folded not in keys:
+        keys.insert(0, folded)
+    return keys
+
+
+def search_url(text):
+    return reverse('djbooks:buscar_libro') + '?' + urlencode({'query': text})
+
+
+class PrefixIndex:
+
+    def __init__(self):
+        self.by_key = []      # (key, -score, sid)
+        self.by_score = []    # (-score, sid)
+        self.entries = {}     # sid -> (kind, label, slug, score, keys)
+        self.books = {}       # pk -> (author sid, tag sids)
+        self.members = {}     # author/tag sid -> book pks
+        self.labels = {}      # author/tag sid -> label
+        self.popularity = {}  # book pk -> purchases + wishes
+        self.lock = threading.Lock()
+
+    # Building
+
+    def build(self):
+        popularity = dict(OrderBook.objects.filter(order__ordered=True).values_list('item')
+                          .annotate(n=Count('id')).order_by())
+        for pk, wishes in (Book.users_wishlist.through.objects.values_list('book')
+                           .annotate(n=Count('id')).order_by()):
+            popularity[pk] = popularity.get(pk, 0) + wishes
+        tags = {}
+        for pk, slug, name in TaggedItem.objects.filter(
+                content_type__app_label='djbooks', content_type__model='book',
+        ).values_list('object_id', 'tag__slug', 'tag__name'):
+            tags.setdefault(pk, []).append((slug, name))
+
+        with self.lock:
+            self.by_key, self.by_score, self.entries = [], [], {}
+            self.books, self.members, self.labels = {}, {}, {}
+            self.popularity = popularity
+            for pk, title, author, slug in Book.objects.values_list('pk', 'title', 'author', 'slug'):
+                self.put_book(pk, title, author, slug, tags.get(pk, ()), rebuild=False)
+            for sid in list(self.members):
+                self.refresh_group(sid, add=False)
+            self.by_key = sorted(
+                (key, -entry[3], sid) for sid, entry in self.entries.items() for key in entry[4])
+            self.by_score = sorted((-entry[3], sid) for sid, entry in self.entries.items())
+
+    # Maintenance, ``rebuild=False`` only fills ``entries`` during build()
+
+    def insert(self, sid, kind, label, slug, score, rebuild=True):
+        entry = (kind, label, slug, score, word_keys(label))
+        self.entries[sid] = entry
+        if rebuild:
+            for key in entry[4]:
+                insort(self.by_key, (key, -score, sid))
+            insort(self.by_score, (-score, sid))
+
+    def delete(self, sid):
+        entry = self.entries.pop(sid, None)
+        if entry is None:
+            return
+        for item in [(key, -entry[3], sid) for key in entry[4]] + [(-entry[3], sid)]:
+            target = self.by_key if len(item) == 3 else self.by_score
+            position = bisect_left(target, item)
+            if position < len(target) and target[position] == item:
+                del target[position]
+
+    def refresh_group(self, sid, add=True):
+        """Recompute an author or tag from its books."""
+        if add:
+            self.delete(sid)
+        pks = self.members.get(sid)
+        if not pks:
+            self.members.pop(sid, None)
+            self.labels.pop(sid, None)
+            self.entries.pop(sid, None)
+            return
+        kind, label = sid[0], self.labels[sid]
+        score = sum(self.popularity.get(pk, 0) + 1 for pk in pks)
+        self.insert(sid, kind, label, None, score, rebuild=add)
+
+    def put_book(self, pk, title, author, slug, tags, rebuild=True):
+        self.insert(('book', pk), 'book', title, slug, self.popularity.get(pk, 0), rebuild=rebuild)
+        groups = [(('author', fold(author)), author.strip())] if fold(author) else []
+        groups += [(('tag', tag_slug), name) for tag_slug, name in tags]
+        self.books[pk] = [sid for sid, _ in groups]
+        for sid, label in groups:
+            self.members.setdefault(sid, set()).add(pk)
+            self.labels.setdefault(sid, label)
+            if rebuild:
+                self.refresh_group(sid)
+
+    def update_book(self, pk, title, author, slug, tags):
+        with self.lock:
+            self.drop_book(pk)
+            self.put_book(pk, title, author, slug, tags)
+
+    def remove_book(self, pk):
+        with self.lock:
+            self.drop_book(pk)
+
+    def drop_book(self, pk):
+        self.delete(('book', pk))
+        for sid in self.books.pop(pk, ()):
+            self.members.get(sid, set()).discard(pk)
+            self.refresh_group(sid)
+
+    # Lookups
+
+    def suggest(self, text, limit=SUGGESTIONS):
+        prefix = fold(text)
+        if len(prefix) < MIN_PREFIX:
+            return []
+        with self.lock:
+            ranked = self.rank(prefix, limit)
+            entries = [self.entries[sid] for sid in ranked]
+        suggestions = []
+        for kind, label, slug, _, _ in entries:
+            # Urls are built here, only for the few suggestions returned
+            if kind == 'book':
+                url = reverse('djbooks:book_detail', kwargs={'slug': slug})
+            else:
+                url = search_url(label)
+            suggestions.append({'kind': kind, 'label': label, 'url': url})
+        return suggestions
+
+    def rank(self, prefix, limit):
+        low = bisect_left(self.by_key, (prefix,))
+        high = bisect_left(self.by_key, (prefix + HIGH,))
+        if high - low <= SCAN_LIMIT:
+            # The best score of each suggestion within the range
+            seen, found = set(), []
+            for key, negative, sid in self.by_key[low:high]:
+                if sid not in seen:
+                    seen.add(sid)
+                    found.append((negative, sid))
+            ranked = [sid for _, sid in nsmallest(limit, found)]
+        else:
+            ranked = []
+            for _, sid in self.by_score:
+                if any(key.startswith(prefix) for key in self.entries[sid][4]):
+                    ranked.append(sid)
+                    if len(ranked) == limit:
+                        break
+        return ranked
+
+
+_index = None            # the index requests read, replaced whole by rebuild()
+_replay = None           # changes to apply to the index being built, if any
+_thread = None           # the builder started by start()
+_pid = None              # the process that started it
+_build_lock = threading.Lock()
+_swap_lock = threading.Lock()
+
+
+def reset_after_fork():
+    # Only the forking thread survives, the builder may have died holding
+    # a lock or halfway through a build
+    global _build_lock, _swap_lock, _replay
+    _build_lock, _swap_lock = threading.Lock(), threading.Lock()
+    _replay = None
+
+
+os.register_at_fork(after_in_child=reset_after_fork)
+
+
+def rebuild(missing_only=False):
+    """Build a new index from the database and swap it in."""
+    global _index, _replay
+    with _build_lock:
+        if missing_only and _index is not None:
+            return
+        with _swap_lock:
+            _replay = []
+        index = PrefixIndex()
+        try:
+            index.build()
+        except BaseException:
+            with _swap_lock:
+                _replay = None
+            raise
+        with _swap_lock:
+            # Edits saved while reading, the build may or may not have seen them
+            for change in _replay:
+                change(index)
+            _index, _replay = index, None
+
+
+def keep_built():
+    interval = getattr(settings, 'AUTOCOMPLETE_REBUILD_INTERVAL', 60 * 60)
+    while True:
+        try:
+            rebuild()
+        except Exception:
+            logger.exception('Autocomplete index build failed')
+        finally:
+            connections.close_all()
+        time.sleep(interval)
+
+
+def start():
+    """Build the index now and keep rebuilding it, in a background thread."""
+    global _thread, _pid
+    with _swap_lock:
+        if _thread is None or _pid != os.getpid():
+            _thread = threading.Thread(target=keep_built, name='autocomplete-index', daemon=True)
+            _pid = os.getpid()
+            _thread.start()
+
+
+def apply(change):
+    with _swap_lock:
+        if _index is not None:
+            change(_index)
+        if _replay is not None:
+            _replay.append(change)
+
+
+def is_used():
+    return _index is not None or _replay is not None
+
+
+def update_book(book):
+    if is_used():
+        # The values as saved now, the change may be replayed later
+        values = (book.pk, book.title, book.author, book.slug, list(book.tags.values_list('slug', 'name')))
+        apply(lambda index: index.update_book(*values))
+
+
+def remove_book(pk):
+    if is_used():
+        apply(lambda index: index.remove_book(pk))
+
+
+def suggest(text, limit=SUGGESTIONS):
+    if _thread is not None and _pid != os.getpid():
+        # Forked after start(), the index would never be rebuilt
+        start()
+    index = _index
+    if index is None:
+        if _thread is not None:
+            # Still building after startup
+            return []
+        rebuild(missing_only=True)
+        index = _index
+    return index.suggest(text, limit)
@@ -0,0 +1,380 @@
+"""
+Request level benchmarks of the store, run by ``manage.py run_benchmark``
+against the data left by ``manage.py generate_catalog``.
+
+Every scenario is a function drawing the next request (method, path and
+POST data) at random from the catalog, so runs with the same seed over
+the same data send the same requests. Three drivers send them:
+
+* ``ClientDriver`` goes through Django's test client (the WSGI handler)
+  in this process from ``concurrency`` threads, one at a time by default,
+  and also counts the queries of each request.
+* ``AsgiDriver`` does the same through the ASGI handler with the async
+  views of ``djbooks.async_views``, from ``concurrency`` tasks.
+* ``HttpDriver`` sends real HTTP requests from ``concurrency`` threads,
+  to a WSGI server started here or to ``--url``. Latencies then include
+  the server and contention, and throughput is meaningful.
+
+Results are plain dicts (``summarize``) so they can be written as JSON
+and compared between runs (``compare``).
+"""
+import asyncio
+import http.cookiejar
+import itertools
+import json
+import math
+import platform
+import random
+import statistics
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import connection
+from django.middleware.csrf import CSRF_SECRET_LENGTH
+from django.test import AsyncClient, Client, override_settings
+from django.utils.crypto import get_random_string
+
+from djbooks.middleware import QueryRecorder
+from djbooks.models import Book, Category, OrderBook
+
+
+SEARCH_TERMS = ('amor', 'noche ciudad', 'garcia', 'historia del mar', 'bolano', 'sombar', 'primaver')
+SORTS = ('recientes', 'precio', '-precio', 'anio', '-anio')
+
+
+class Fixture:
+    """Slugs and categories the scenarios draw from."""
+
+    def __init__(self, sample=500, seed=1):
+        self.rng = random.Random(seed)
+        # Random rows without ORDER BY RANDOM() over the whole table
+        top = Book.objects.order_by('-pk').values_list('pk', flat=True).first() or 0
+        ids = self.rng.sample(range(1, top + 1), min(top, sample * 4))
+        self.books = list(Book.objects.filter(pk__in=ids, stock__gt=0).values_list('slug', flat=True)[:sample])
+        self.categories = list(Category.objects.filter(book_count__gt=0).values_list('slug', flat=True))
+        if not self.books or not self.categories:
+            raise ValueError('No books to benchmark, run generate_catalog first')
+
+    def choice(self, values):
+        return self.rng.choice(values)
+
+
+def home(fixture):
+    return 'get', '/', None
+
+
+def catalog(fixture):
+    return 'get', '/catalogo', None
+
+
+def category(fixture):
+    return 'get', '/categoria/%s?sort=%s' % (fixture.choice(fixture.categories), fixture.choice(SORTS)), None
+
+
+def detail(fixture):
+    return 'get', '/' + fixture.choice(fixture.books), None
+
+
+def search(fixture):
+    return 'get', '/buscar_libro?' + urllib.parse.urlencode({'query': fixture.choice(SEARCH_TERMS)}), None
+
+
+def add_to_cart(fixture):
+    return 'post', '/api/cart/%s/add/' % fixture.choice(fixture.books), {'quantity': 1}
+
+
+def checkout(fixture):
+    # The payment page builds (or reuses) the Mercado Pago preference
+    return 'get', fixture.choice(('/checkout', '/pago')), None
+
+
+# name -> (request factory, needs a logged in user with a cart)
+SCENARIOS = {
+    'home': (home, False),
+    'catalog': (catalog, False),
+    'category': (category, False),
+    'detail': (detail, False),
+    'search': (search, False),
+    'add_to_cart': (add_to_cart, True),
+    'checkout': (checkout, True),
+}
+
+
+def benchmark_users(count, prefix='bench-'):
+    User = get_user_model()
+    users = list(User.objects.filter(username__startswith=prefix).order_by('pk')[:count])
+    users += [User.objects.create(username=f'{prefix}runner-{n}') for n in range(count - len(users))]
+    return users
+
+
+def fill_carts(users, slugs):
+    # checkout needs something in the cart
+    from djbooks.cart import CartService
+    from djbooks.inventory import OutOfStock
+
+    for user, slug in zip(users, itertools.cycle(slugs)):
+        try:
+            CartService(user).add(slug)
+        except OutOfStock:
+            pass
+
+
+def empty_carts(users):
+    """Give back the stock the benchmark reserved."""
+    from djbooks.inventory import release
+
+    for line in OrderBook.objects.filter(user__in=users, ordered=False):
+        release(line)
+    OrderBook.objects.filter(user__in=users, ordered=False).delete()
+
+
+def percentile(values, fraction):
+    # Nearest rank, values sorted
+    if not values:
+        return None
+    return values[max(0, math.ceil(fraction * len(values)) - 1)]
+
+
+def summarize(samples, elapsed):
+    """``samples`` is a list of ``(seconds, status, queries)``."""
+    latencies = sorted(seconds * 1000 for seconds, _, _ in samples)
+    statuses = {}
+    for _, status, _ in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    queries = [count for _, _, count in samples if count is not None]
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, status, _ in samples if not status or status >= 500),
+        'statuses': statuses,
+        'mean_ms': round(statistics.fmean(latencies), 3) if latencies else None,
+        'p50_ms': round(percentile(latencies, 0.50), 3) if latencies else None,
+        'p90_ms': round(percentile(latencies, 0.90), 3) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95), 3) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99), 3) if latencies else None,
+        'max_ms': round(latencies[-1], 3) if latencies else None,
+        'throughput_rps': round(len(samples) / elapsed, 1) if elapsed else None,
+        'queries_mean': round(statistics.fmean(queries), 2) if queries else None,
+    }
+
+
+class Driver:
+    concurrency = 1
+
+    def send(self, method, path, data, logged_in, rng):
+        raise NotImplementedError
+
+    def run(self, requests):
+        requests = list(requests)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            started = time.perf_counter()
+            samples = list(pool.map(lambda request: self.send(*request), requests))
+            elapsed = time.perf_counter() - started
+        return samples, elapsed
+
+    def close(self):
+        pass
+
+
+class ClientDriver(Driver):
+    name = 'client'
+
+    def __init__(self, users, concurrency=1):
+        self.users = users
+        self.concurrency = concurrency
+        # Test clients are not thread safe, each thread logs in its own
+        self.local = threading.local()
+
+    def clients(self):
+        if not hasattr(self.local, 'clients'):
+            self.local.anonymous = Client()
+            self.local.clients = []
+            for user in self.users:
+                client = Client()
+                client.force_login(user)
+                self.local.clients.append(client)
+        return self.local
+
+    def send(self, method, path, data, logged_in, rng):
+        clients = self.clients()
+        client = rng.choice(clients.clients) if logged_in else clients.anonymous
+        with QueryRecorder() as recorder:
+            started = time.perf_counter()
+            response = getattr(client, method)(path, data) if data else getattr(client, method)(path)
+            elapsed = time.perf_counter() - started
+        return elapsed, response.status_code, recorder.count
+
+
+class AsgiDriver(Driver):
+    """
+    Django's async test client through the ASGI handler, with the async
+    views routed and ``concurrency`` requests in flight on one event loop.
+    Compare it with ``ClientDriver`` at the same concurrency.
+    """
+    name = 'asgi'
+
+    def __init__(self, users, concurrency=8):
+        self.concurrency = concurrency
+        self.urls = override_settings(ROOT_URLCONF='unice.urls_async')
+        self.urls.enable()
+        self.anonymous = AsyncClient()
+        self.clients = []
+        for user in users:
+            client = AsyncClient()
+            client.force_login(user)
+            self.clients.append(client)
+
+    async def asend(self, semaphore, method, path, data, logged_in, rng):
+        client = rng.choice(self.clients) if logged_in else self.anonymous
+        async with semaphore:
+            with QueryRecorder() as recorder:
+                started = time.perf_counter()
+                response = await (getattr(client, method)(path, data) if data else getattr(client, method)(path))
+                elapsed = time.perf_counter() - started
+        return elapsed, response.status_code, recorder.count
+
+    async def arun(self, requests):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        started = time.perf_counter()
+        samples = await asyncio.gather(*(self.asend(semaphore, *request) for request in requests))
+        return list(samples), time.perf_counter() - started
+
+    def run(self, requests):
+        return asyncio.run(self.arun(list(requests)))
+
+    def close(self):
+        self.urls.disable()
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Measure the view that answered, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver(Driver):
+    name = 'http'
+
+    def __init__(self, users, concurrency=8, url=None):
+        self.concurrency = concurrency
+        self.server = None
+        if url is None:
+            self.server = ThreadedWSGIServer(('127.0.0.1', 0), QuietHandler, allow_reuse_address=True)
+            self.server.set_app(get_internal_wsgi_application())
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            url = 'http://127.0.0.1:%d' % self.server.server_port
+        self.url = url.rstrip('/')
+        self.anonymous = self.opener()
+        # The server reads the same sessions table, so logging in through the
+        # test client gives a session cookie it accepts
+        self.sessions = []
+        for user in users:
+            client = Client()
+            client.force_login(user)
+            self.sessions.append(self.opener(client.cookies['sessionid'].value))
+
+    def opener(self, session=None):
+        jar = http.cookiejar.CookieJar()
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar), NoRedirect)
+        host = urllib.parse.urlsplit(self.url).hostname
+        if session:
+            jar.set_cookie(self.cookie(settings.SESSION_COOKIE_NAME, session, host))
+        # Any well formed token is accepted while cookie and header agree
+        opener.csrf = get_random_string(CSRF_SECRET_LENGTH)
+        jar.set_cookie(self.cookie(settings.CSRF_COOKIE_NAME, opener.csrf, host))
+        return opener
+
+    def cookie(self, name, value, host):
+        return http.cookiejar.Cookie(
+            0, name, value, None, False, host, False, False, '/', True,
+            False, None, False, None, None, {})
+
+    def fetch(self, opener, method, path, data):
+        body = urllib.parse.urlencode(data).encode() if data else (b'' if method == 'post' else None)
+        request = urllib.request.Request(self.url + path, data=body, method=method.upper())
+        if method == 'post':
+            request.add_header('X-CSRFToken', opener.csrf)
+            request.add_header('Referer', self.url + '/')
+        try:
+            with opener.open(request, timeout=60) as response:
+                response.read()
+                return response.status, response.headers.get('X-Query-Count')
+        except urllib.error.HTTPError as error:
+            error.read()
+            return error.code, error.headers.get('X-Query-Count')
+        except (urllib.error.URLError, OSError):
+            return 0, None
+
+    def send(self, method, path, data, logged_in, rng):
+        opener = rng.choice(self.sessions) if logged_in else self.anonymous
+        started = time.perf_counter()
+        status, queries = self.fetch(opener, method, path, data)
+        return time.perf_counter() - started, status, int(queries) if queries else None
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def run_scenario(driver, fixture, name, requests, warmup, seed):
+    factory, logged_in = SCENARIOS[name]
+    rng = random.Random(seed)
+    fixture.rng = random.Random(seed)
+    draw = lambda: (*factory(fixture), logged_in, rng)
+    driver.run([draw() for _ in range(warmup)])
+    samples, elapsed = driver.run([draw() for _ in range(requests)])
+    return summarize(samples, elapsed)
+
+
+def environment():
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                  text=True, cwd=settings.BASE_DIR, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        revision = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'books': Book.objects.count(),
+        'machine': platform.machine(),
+    }
+
+
+def compare(previous, current):
+    """``{scenario: {metric: ratio}}``, ratios above 1 mean slower or fewer."""
+    ratios = {}
+    for name, result in current['scenarios'].items():
+        before = previous.get('scenarios', {}).get(name)
+        if not before:
+            continue
+        ratios[name] = {
+            metric: round(result[metric] / before[metric], 3)
+            for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps', 'queries_mean')
+            if result.get(metric) and before.get(metric)
+        }
+    return ratios
+
+
+def load_results(path):
+    with open(path) as source:
+        return json.load(source)
@@ -0,0 +1,150 @@
+from typing import NamedTuple, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+
+from djbooks.models import Book, Order, OrderBook
+from djbooks.transactions import write_atomic
+
+
+class CartSummary(NamedTuple):
+    item_count: int = 0
+    quantity: int = 0
+    total: float = 0
+
+
+EMPTY_CART = CartSummary()
+
+def cart_summary_timeout():
+    return getattr(settings, 'CART_SUMMARY_TIMEOUT', 60 * 60)
+
+
+def cart_summary_key(user_id):
+    return f'djbooks:cart-summary:{user_id}'
+
+
+def compute_cart_summary(user):
+    # Totals are stored on the order, no need to touch its lines
+    totals = Order.objects.filter(user=user, ordered=False).values_list(
+        'item_count', 'item_quantity', 'subtotal').first()
+    if totals is None:
+        return EMPTY_CART
+    item_count, quantity, subtotal = totals
+    # Floats from here on, summaries are cached and sent as JSON
+    return CartSummary(item_count, quantity, float(subtotal))
+
+
+def get_cart_summary(user):
+    """Cart totals for ``user``, computed once and cached until invalidated."""
+    if not user.is_authenticated:
+        return EMPTY_CART
+    key = cart_summary_key(user.pk)
+    summary = cache.get(key)
+    if summary is None:
+        summary = compute_cart_summary(user)
+        cache.set(key, tuple(summary), cart_summary_timeout())
+        return summary
+    return CartSummary(*summary)
+
+
+def invalidate_cart_summary(user):
+    cache.delete(cart_summary_key(user.pk))
+
+
+def invalidate_cart_summaries(user_ids):
+    cache.delete_many([cart_summary_key(user_id) for user_id in user_ids])
+
+
+class CartLine(NamedTuple):
+    slug: str
+    title: str
+    quantity: int
+    unit_price: float
+    total: float
+
+
+class CartChange(NamedTuple):
+    line: Optional[CartLine]
+    summary: CartSummary
+
+    def as_dict(self):
+        return {
+            'line': self.line._asdict() if self.line else None,
+            'cart': self.summary._asdict(),
+        }
+
+
+class CartService:
+    """
+    Cart changes for one user. Every change is one transaction with the
+    same number of queries whatever the size of the cart: the line is
+    upserted with ``update()`` and the order totals recomputed once.
+    Raises ``Book.DoesNotExist`` for unknown slugs and
+    ``djbooks.inventory.OutOfStock`` when copies run out.
+    """
+
+    def __init__(self, user):
+        self.user = user
+
+    def add(self, slug, quantity=1):
+        return self.change(slug, lambda current: current + quantity)
+
+    def remove(self, slug, quantity=None):
+        """Take ``quantity`` copies out of the cart, the whole line when None."""
+        return self.change(slug, lambda current: 0 if quantity is None else current - quantity)
+
+    def set_quantity(self, slug, quantity):
+        return self.change(slug, lambda current: quantity)
+
+    def change(self, slug, target):
+        from djbooks.inventory import release, reserve
+
+        book = Book.objects.only('pk', 'slug', 'title', 'price', 'discount_price').get(slug=slug)
+        # Reads the cart before changing it, see djbooks.transactions
+        with write_atomic():
+            order = Order.objects.filter(user=self.user, ordered=False).first()
+            line = OrderBook.objects.filter(order=order, item=book).first() if order else None
+            current = line.quantity if line else 0
+            quantity = max(target(current), 0)
+            if quantity == current:
+                return CartChange(self.get_line(line, book), self.get_summary(order))
+
+            if order is None:
+                order = Order.objects.create(user=self.user, ordered_date=timezone.now())
+            if line is None:
+                # Created with the final quantity, the totals are updated below
+                line = OrderBook.objects.create(user=self.user, item=book, quantity=quantity)
+                Order.items.through.objects.create(order=order, orderbook=line)
+                reserve(line, quantity)
+            elif quantity > current:
+                reserve(line, quantity - current)
+                OrderBook.objects.filter(pk=line.pk).update(quantity=quantity)
+            else:
+                release(line, current - quantity)
+                if quantity:
+                    OrderBook.objects.filter(pk=line.pk).update(quantity=quantity)
+                else:
+                    Order.items.through.objects.filter(orderbook=line).delete()
+                    OrderBook.objects.filter(pk=line.pk).delete()
+                    line = None
+            if line is not None:
+                line.quantity = quantity
+            order.update_totals()
+
+        summary = self.get_summary(order)
+        cache.set(cart_summary_key(self.user.pk), tuple(summary), cart_summary_timeout())
+        return CartChange(self.get_line(line, book), summary)
+
+    def get_line(self, line, book):
+        if line is None:
+            return None
+        line.item = book
+        unit_price = line.get_unit_price()
+        return CartLine(book.slug, book.title, line.quantity,
+                        float(unit_price), float(unit_price * line.quantity))
+
+    def get_summary(self, order):
+        if order is None:
+            return EMPTY_CART
+        return CartSummary(order.item_count, order.item_quantity, float(order.subtotal))
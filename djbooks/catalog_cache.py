@@ -0,0 +1,51 @@
+from django.conf import settings
+from django.core.cache import cache
+
+
+# Rendered fragments are keyed by these counters instead of being
+# deleted, bumping a counter makes every fragment built on it unreachable.
+CATALOG_VERSION_KEY = 'djbooks:catalog-version'
+
+
+def book_version_key(pk):
+    return f'djbooks:book-version:{pk}'
+
+
+def fragment_timeout():
+    return getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def get_version(key):
+    version = cache.get(key)
+    if version is None:
+        # add() so concurrent first readers agree on the starting value
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def bump_version(key):
+    try:
+        return cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+        return cache.incr(key)
+
+
+def get_catalog_version():
+    return get_version(CATALOG_VERSION_KEY)
+
+
+def get_book_version(pk):
+    return get_version(book_version_key(pk))
+
+
+def bump_catalog_version():
+    """Invalidate fragments listing books or categories."""
+    return bump_version(CATALOG_VERSION_KEY)
+
+
+def bump_book_version(*pks):
+    """Invalidate the fragments of specific books."""
+    for pk in pks:
+        bump_version(book_version_key(pk))
@@ -0,0 +1,23 @@
+from django.utils.functional import SimpleLazyObject
+
+from djbooks.cart import get_cart_summary
+from djbooks.catalog_cache import fragment_timeout, get_catalog_version
+
+
+def get_request_cart_summary(request):
+    # Memoized on the request so every template reading it shares one lookup
+    if not hasattr(request, '_cart_summary'):
+        request._cart_summary = get_cart_summary(request.user)
+    return request._cart_summary
+
+
+def cart(request):
+    return {'cart_summary': SimpleLazyObject(lambda: get_request_cart_summary(request))}
+
+
+def catalog_cache(request):
+    # Read by the {% cache %} tags wrapping catalog fragments
+    return {
+        'catalog_version': SimpleLazyObject(get_catalog_version),
+        'fragment_timeout': fragment_timeout(),
+    }
@@ -0,0 +1,187 @@
+"""
+Faceted navigation for the category pages.
+
+Each category gets a posting-list index, ``{facet: {value: set of book
+ids}}``, built with two queries and cached under the catalog version, so
+any edit to the catalog simply makes it unreachable. Facet counts for a
+filter set are then set intersections in memory, whatever the number of
+selected filters, and they are cached too by a normalized signature of
+the filters. The books themselves are still filtered in SQL (see
+``facet_filter``) so pages keep using the keyset pagination.
+"""
+import hashlib
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Q
+from taggit.models import TaggedItem
+
+from djbooks.catalog_cache import fragment_timeout, get_catalog_version
+from djbooks.models import Book
+
+
+# (key, label, lower, upper), upper excluded
+PRICE_BUCKETS = (
+    ('0-100', "Menos de $100", 0, 100),
+    ('100-200', "$100 a $200", 100, 200),
+    ('200-500', "$200 a $500", 200, 500),
+    ('500-', "Más de $500", 500, None),
+)
+
+PRICE_BUCKET_KEYS = [key for key, _, _, _ in PRICE_BUCKETS]
+
+# GET parameter -> label, in display order
+FACETS = {
+    'tag': "Etiquetas",
+    'editorial': "Editorial",
+    'year': "Año",
+    'condition': "Estado",
+    'price': "Precio",
+}
+
+# Values listed per facet, the selected ones are always shown
+FACET_LIMIT = 10
+
+
+def price_bucket(price):
+    for key, _, lower, upper in PRICE_BUCKETS:
+        if price >= lower and (upper is None or price < upper):
+            return key
+    return None
+
+
+def parse_filters(params):
+    """``{facet: sorted values}`` from a QueryDict, unknown values kept out."""
+    filters = {}
+    for facet in FACETS:
+        values = sorted({value.strip() for value in params.getlist(facet) if value.strip()})
+        if facet == 'price':
+            values = [value for value in values if value in PRICE_BUCKET_KEYS]
+        if values:
+            filters[facet] = values
+    return filters
+
+
+def filter_signature(filters):
+    """Same filters in any order and with repeated values, same signature."""
+    normalized = "&".join(
+        f"{facet}={'|'.join(values)}" for facet, values in sorted(filters.items()))
+    return hashlib.sha1(normalized.encode()).hexdigest()
+
+
+def facet_filter(filters):
+    """The filters as a Q over Book, values of a facet are OR'ed."""
+    condition = Q()
+    if 'tag' in filters:
+        tagged = TaggedItem.objects.filter(
+            content_type__app_label='djbooks', content_type__model='book',
+            tag__slug__in=filters['tag']).values('object_id')
+        condition &= Q(pk__in=tagged)
+    for facet in ('editorial', 'year', 'condition'):
+        if facet in filters:
+            condition &= Q(**{f'{facet}__in': filters[facet]})
+    if 'price' in filters:
+        prices = Q()
+        for key, _, lower, upper in PRICE_BUCKETS:
+            if key in filters['price']:
+                bucket = Q(effective_price__gte=lower)
+                if upper is not None:
+                    bucket &= Q(effective_price__lt=upper)
+                prices |= bucket
+        condition &= prices
+    return condition
+
+
+def build_index(category):
+    """Posting lists and value labels of the books of ``category``."""
+    postings = {facet: defaultdict(set) for facet in FACETS}
+    labels = {facet: {} for facet in FACETS}
+    everything = set()
+    books = Book.objects.filter(category=category)
+    rows = books.values_list(
+        'pk', 'editorial', 'year', 'condition', 'effective_price')
+    for pk, editorial, year, condition, price in rows:
+        everything.add(pk)
+        for facet, value in (('editorial', editorial), ('year', year), ('condition', condition)):
+            value = (value or '').strip()
+            if value:
+                postings[facet][value].add(pk)
+                labels[facet][value] = value
+        bucket = price_bucket(price or 0)
+        if bucket:
+            postings['price'][bucket].add(pk)
+    labels['price'] = {key: label for key, label, _, _ in PRICE_BUCKETS}
+
+    tagged = TaggedItem.objects.filter(
+        content_type__app_label='djbooks', content_type__model='book',
+        object_id__in=books.values('pk'))
+    for pk, slug, name in tagged.values_list('object_id', 'tag__slug', 'tag__name'):
+        postings['tag'][slug].add(pk)
+        labels['tag'][slug] = name
+
+    return {
+        'all': everything,
+        'postings': {facet: dict(values) for facet, values in postings.items()},
+        'labels': labels,
+    }
+
+
+def get_index(category):
+    key = f'djbooks:facet-index:{category.pk}:{get_catalog_version()}'
+    index = cache.get(key)
+    if index is None:
+        index = build_index(category)
+        cache.set(key, index, fragment_timeout())
+    return index
+
+
+def compute_facets(index, filters):
+    """
+    Counts of every facet value given the other selected facets (a value
+    of a facet adds to the facet's own selection) and the matching total.
+    """
+    postings = index['postings']
+    matches = {
+        facet: set().union(*(postings[facet].get(value, ()) for value in values))
+        for facet, values in filters.items()
+    }
+
+    def matching(exclude=None):
+        books = index['all']
+        for facet, ids in matches.items():
+            if facet != exclude:
+                books = books & ids
+        return books
+
+    facets = []
+    for facet, label in FACETS.items():
+        books = matching(exclude=facet)
+        counts = [(value, len(ids & books)) for value, ids in postings[facet].items()]
+        selected = set(filters.get(facet, ()))
+        if facet == 'price':
+            # Buckets keep their own order
+            counts.sort(key=lambda item: PRICE_BUCKET_KEYS.index(item[0]))
+        else:
+            counts.sort(key=lambda item: (-item[1], item[0]))
+        shown = [item for item in counts if item[1] or item[0] in selected]
+        shown = shown[:FACET_LIMIT] + [item for item in shown[FACET_LIMIT:] if item[0] in selected]
+        facets.append({
+            'name': facet,
+            'label': label,
+            'values': [
+                {'value': value, 'label': index['labels'][facet].get(value, value),
+                 'count': count, 'selected': value in selected}
+                for value, count in shown
+            ],
+        })
+    return {'facets': facets, 'count': len(matching())}
+
+
+def get_facets(category, filters):
+    """Facets and total for ``filters``, cached by their signature."""
+    key = 'djbooks:facets:%s:%s:%s' % (category.pk, get_catalog_version(), filter_signature(filters))
+    result = cache.get(key)
+    if result is None:
+        result = compute_facets(get_index(category), filters)
+        cache.set(key, result, fragment_timeout())
+    return result
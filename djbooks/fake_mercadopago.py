@@ -0,0 +1,129 @@
+"""
+Minimal stand-in for the Mercado Pago API, for development and tests.
+
+Run it with ``python manage.py fake_mercadopago`` and set
+``MERCADO_PAGO_API_URL=http://127.0.0.1:8765`` so the SDK talks to it,
+or start it in-process with ``start_fake_server()``. Only the endpoints
+used by the store are implemented and everything is kept in memory.
+"""
+import itertools
+import json
+import re
+import threading
+import uuid
+from decimal import Decimal
+from urllib.request import Request, urlopen
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+PREFERENCE_RE = re.compile(r'^/checkout/preferences/(?P<id>[\w-]+)$')
+# Not part of the real API, lets a developer "pay" from curl
+PAY_RE = re.compile(r'^/fake/pay/(?P<id>[\w-]+)$')
+PAYMENT_RE = re.compile(r'^/v1/payments/(?P<id>\d+)$')
+
+
+class FakeMercadoPagoHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_POST(self):
+        self.server.calls.append(('POST', self.path))
+        match = PAY_RE.match(self.path.split('?')[0])
+        if match and match['id'] in self.server.preferences:
+            status = self.read_json().get('status', 'approved')
+            return self.send_json(201, self.server.pay(match['id'], status))
+        if self.path.split('?')[0] != '/checkout/preferences':
+            return self.send_json(404, {'message': 'not found'})
+        data = self.read_json()
+        if not data.get('items'):
+            return self.send_json(400, {'message': 'items needed'})
+        preference_id = '%s-%s' % (self.server.collector_id, uuid.uuid4())
+        preference = dict(
+            data,
+            id=preference_id,
+            collector_id=self.server.collector_id,
+            init_point='%s/checkout/v1/redirect?pref_id=%s' % (self.server.url, preference_id),
+        )
+        self.server.preferences[preference_id] = preference
+        self.send_json(201, preference)
+
+    def do_GET(self):
+        self.server.calls.append(('GET', self.path))
+        path = self.path.split('?')[0]
+        match = PREFERENCE_RE.match(path)
+        if match and match['id'] in self.server.preferences:
+            return self.send_json(200, self.server.preferences[match['id']])
+        match = PAYMENT_RE.match(path)
+        if match and match['id'] in self.server.payments:
+            return self.send_json(200, self.server.payments[match['id']])
+        self.send_json(404, {'message': 'not found'})
+
+
+class FakeMercadoPagoServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), verbose=False):
+        super().__init__(address, FakeMercadoPagoHandler)
+        self.verbose = verbose
+        self.collector_id = 1000
+        self.preferences = {}
+        self.payments = {}
+        self.payment_ids = itertools.count(5000001)
+        # (method, path) of every request received, for assertions
+        self.calls = []
+
+    def pay(self, preference_id, status='approved', notify=True):
+        """
+        Simulate the buyer paying a preference. Like the real gateway it
+        then POSTs a notification to the preference's ``notification_url``.
+        """
+        preference = self.preferences[preference_id]
+        payment_id = str(next(self.payment_ids))
+        amount = sum(Decimal(str(item['unit_price'])) * item['quantity'] for item in preference['items'])
+        # Only fields of the real payment resource, which doesn't say
+        # what preference was paid but carries its metadata
+        payment = {
+            'id': int(payment_id),
+            'status': status,
+            'external_reference': preference.get('external_reference'),
+            'metadata': preference.get('metadata', {}),
+            'transaction_amount': float(amount),
+            'currency_id': 'MXN',
+        }
+        self.payments[payment_id] = payment
+        if notify and preference.get('notification_url'):
+            self.notify(preference['notification_url'], payment_id)
+        return payment
+
+    def notify(self, url, payment_id):
+        body = json.dumps({'type': 'payment', 'action': 'payment.updated',
+                           'data': {'id': payment_id}}).encode()
+        request = Request(url, data=body, headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=10) as response:
+            return response.status
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+
+def start_fake_server(host='127.0.0.1', port=0):
+    """Serve from a daemon thread, call ``shutdown()`` on the result when done."""
+    server = FakeMercadoPagoServer((host, port))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,107 @@
+"""
+Payment gateways, one per ``Payment.PaymentMethod``.
+
+``get_gateway(method)`` returns the process wide instance of the class
+configured for ``method`` in ``PAYMENT_GATEWAYS`` (dotted paths, like
+``SEARCH_BACKEND``). Gateways import their SDK on first use: the
+Mercado Pago SDK drags ``requests`` and ``urllib3`` along, which every
+management command, migration and worker start used to pay for through
+djbooks.models. ``python manage.py import_time`` keeps it that way.
+
+Every gateway takes the Mercado Pago preference format, the one the
+checkout builds, and answers payments in Mercado Pago's shape
+(``status``, ``transaction_amount``, ``external_reference``).
+"""
+import itertools
+import threading
+from decimal import Decimal
+from functools import cached_property, lru_cache
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+DEFAULT_GATEWAYS = {
+    'MP': 'djbooks.gateway.MercadoPagoGateway',
+    # No PayPal integration yet
+    'PP': 'djbooks.gateway.DummyGateway',
+}
+
+
+class PaymentGateway:
+
+    def create_checkout(self, preference):
+        """Register a checkout for ``preference``, returns its id or None."""
+        raise NotImplementedError
+
+    def fetch_payment(self, payment_id):
+        """The gateway's record of ``payment_id``, raises ValueError when it fails."""
+        raise NotImplementedError
+
+
+class MercadoPagoGateway(PaymentGateway):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    @cached_property
+    def sdk(self):
+        # Imported here, see the module docstring
+        from mercadopago import SDK
+
+        from djbooks.mercadopago_client import PooledHttpClient
+
+        return SDK(str(settings.MERCADO_PAGO_PRIVATE_KEY),
+                   http_client=PooledHttpClient(getattr(settings, 'MERCADO_PAGO_API_URL', None)))
+
+    def get_sdk(self):
+        # Threads fetching payments would each build one
+        with self.lock:
+            return self.sdk
+
+    def create_checkout(self, preference):
+        response = self.get_sdk().preference().create(preference)
+        return response['response'].get('id')
+
+    def fetch_payment(self, payment_id):
+        response = self.get_sdk().payment().get(payment_id)
+        if response['status'] != 200:
+            raise ValueError(f"status {response['status']}: {response['response']}")
+        return response['response']
+
+
+class DummyGateway(PaymentGateway):
+    """
+    Approves everything without leaving the process, for payment methods
+    without an integration and for development. A payment's id is its
+    checkout's.
+    """
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.checkouts = {}
+
+    def create_checkout(self, preference):
+        checkout_id = f'dummy-{next(self.ids)}'
+        self.checkouts[checkout_id] = preference
+        return checkout_id
+
+    def fetch_payment(self, payment_id):
+        preference = self.checkouts.get(payment_id)
+        if preference is None:
+            raise ValueError(f'unknown payment {payment_id}')
+        return {
+            'id': payment_id,
+            'status': 'approved',
+            'transaction_amount': sum(item['quantity'] * Decimal(str(item['unit_price']))
+                                      for item in preference['items']),
+            'external_reference': preference.get('external_reference'),
+            'metadata': preference.get('metadata', {}),
+        }
+
+
+@lru_cache(maxsize=None)
+def get_gateway(method):
+    """The gateway of ``method`` (a ``Payment.PaymentMethod`` value)."""
+    gateways = {**DEFAULT_GATEWAYS, **getattr(settings, 'PAYMENT_GATEWAYS', {})}
+    return import_string(gateways[method])()
@@ -1,7 +1,9 @@
 import os
+import unicodedata
 from functools import partial
 from uuid import uuid4
 
+from django.utils.text import slugify
 
 
 def upload_with_uuid(path):
@@ -21,4 +23,30 @@ def upload_extra_img(instance, filename, path):
     inner = f'libro_{slug}/extra_{uuid_part}'
 
     ext = os.path.splitext(filename)[-1].lower()
-    return os.path.join(path, inner + ext)
\ No newline at end of file
+    return os.path.join(path, inner + ext)
+
+
+def unique_slug(value, taken, max_length=255, allow_unicode=False):
+    """
+    Slugify ``value`` appending -2, -3... until it is not in ``taken``.
+
+    ``taken`` is any container of slugs already in use, so bulk loaders
+    can check against an in-memory set instead of querying per row.
+    """
+    base = slugify(value, allow_unicode=allow_unicode)[:max_length] or 'sin-titulo'
+    slug, n = base, 2
+    while slug in taken:
+        suffix = f'-{n}'
+        slug = base[:max_length - len(suffix)] + suffix
+        n += 1
+    return slug
+
+
+def fold(value):
+    """
+    Lowercase ``value`` without accents and with single spaces, for
+    matching what users type: ``'Cien  Años'`` -> ``'cien anos'``.
+    """
+    decomposed = unicodedata.normalize('NFKD', value or '')
+    stripped = ''.join(char for char in decomposed if not unicodedata.combining(char))
+    return ' '.join(stripped.casefold().split())
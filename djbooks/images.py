@@ -0,0 +1,91 @@
+import os
+
+
+# name -> bounding box (width, height), book covers are portrait
+VARIANTS = {
+    'thumbnail': (120, 180),
+    'card': (300, 450),
+    'detail': (600, 900),
+    'zoom': (1200, 1800),
+}
+
+# extension -> (Pillow format, save options)
+FORMATS = {
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+
+def variant_name(name, variant, ext):
+    root, _ = os.path.splitext(name)
+    return f'{root}_{variant}.{ext}'
+
+
+def render_variants(source_path):
+    """
+    Write every variant of the image at ``source_path`` next to it.
+
+    Only touches the filesystem so it can run in worker processes, the
+    caller stores the returned ``{variant: [width, height]}`` sizes.
+    """
+    # Pillow is only needed here, not to import the models
+    from PIL import Image, ImageOps
+
+    sizes = {}
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        for variant, box in VARIANTS.items():
+            resized = image.copy()
+            # thumbnail keeps the aspect ratio and never upscales
+            resized.thumbnail(box, Image.LANCZOS)
+            for ext, (fmt, options) in FORMATS.items():
+                resized.save(variant_name(source_path, variant, ext), fmt, **options)
+            sizes[variant] = [resized.width, resized.height]
+    return sizes
+
+
+def needs_variants(file, variants, default=None):
+    return bool(file) and file.name != default and variants.get('source') != file.name
+
+
+def build_variants(file):
+    """Render the variants of a stored file, returns the value to save."""
+    sizes = render_variants(file.storage.path(file.name))
+    return {'source': file.name, **sizes}
+
+
+class ImageVariants:
+    """
+    URLs of the generated variants of an image field.
+
+    ``images['card']`` gives ``{'jpg': url, 'webp': url, 'width': w,
+    'height': h}``; until variants exist every URL is the original file.
+    """
+
+    def __init__(self, file, variants):
+        self.file = file
+        self.variants = variants or {}
+
+    @property
+    def ready(self):
+        return bool(self.file) and self.variants.get('source') == self.file.name
+
+    def url(self, variant, ext='jpg'):
+        if not self.file:
+            return None
+        if self.ready and variant in self.variants:
+            return self.file.storage.url(variant_name(self.file.name, variant, ext))
+        return self.file.url
+
+    def __getitem__(self, variant):
+        if variant not in VARIANTS:
+            raise KeyError(variant)
+        width, height = self.variants.get(variant, (None, None)) if self.ready else (None, None)
+        return {
+            'jpg': self.url(variant, 'jpg'),
+            'webp': self.url(variant, 'webp') if self.ready else None,
+            'width': width,
+            'height': height,
+        }
@@ -0,0 +1,127 @@
+"""
+Stock reservations.
+
+Adding a book to a cart takes the copies out of ``Book.stock`` right
+away with a conditional ``UPDATE ... SET stock = stock - n WHERE stock
+>= n``, so two buyers can never get the last copy. The copies are held
+in a ``StockReservation`` until the order is paid (``confirm_orders``),
+the line is removed (``release``) or the reservation expires
+(``release_expired``, run by the ``release_expired_reservations``
+command). Adding copies and opening the payment page push the expiry
+back, but never past ``STOCK_RESERVATION_MAX_HOLD`` from when the
+copies were first held, or reloading a page would keep them forever. Mercado Pago preferences expire with the order's reservations
+(see ``Order.get_preference``), nobody can pay for copies that went
+back to the stock.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Least
+from django.utils import timezone
+
+from djbooks.cart import invalidate_cart_summaries
+from djbooks.catalog_cache import bump_book_version
+from djbooks.models import Book, OrderBook, StockReservation
+from djbooks.transactions import write_atomic
+
+
+class OutOfStock(Exception):
+    pass
+
+
+def reservation_expiry(now=None):
+    return (now or timezone.now()) + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+
+
+def extended_expiry(now=None):
+    """``expires_at`` of a reservation pushed back, for update()."""
+    return Least(Value(reservation_expiry(now)),
+                 F('held_since') + timedelta(seconds=settings.STOCK_RESERVATION_MAX_HOLD))
+
+
+def take_stock(book_id, quantity):
+    """Atomically take ``quantity`` copies, False when there aren't enough."""
+    return Book.objects.filter(pk=book_id, stock__gte=quantity).update(
+        stock=F('stock') - quantity) == 1
+
+
+def return_stock(quantities):
+    """Give back ``{book_id: quantity}`` with a single UPDATE."""
+    quantities = {pk: quantity for pk, quantity in quantities.items() if quantity}
+    if not quantities:
+        return
+    Book.objects.filter(pk__in=quantities).update(stock=F('stock') + Case(
+        *[When(pk=pk, then=Value(quantity)) for pk, quantity in quantities.items()],
+        default=Value(0),
+    ))
+
+
+def reserve(line, quantity=1):
+    """
+    Hold ``quantity`` more copies of the line's book, raises ``OutOfStock``
+    when they are not available. Also pushes back the line's expiry.
+    """
+    with transaction.atomic():
+        if not take_stock(line.item_id, quantity):
+            raise OutOfStock(line.item_id)
+        updated = StockReservation.objects.filter(line=line).update(
+            quantity=F('quantity') + quantity, expires_at=extended_expiry())
+        if not updated:
+            StockReservation.objects.create(
+                line=line, book_id=line.item_id, quantity=quantity, expires_at=reservation_expiry())
+    # After the commit, a page rendered before it would cache the old stock
+    # under the new version
+    transaction.on_commit(lambda: bump_book_version(line.item_id))
+
+
+def release(line, quantity=None):
+    """Give back ``quantity`` held copies of the line, all of them when None."""
+    with write_atomic():
+        reservation = StockReservation.objects.select_for_update().filter(line=line).first()
+        if reservation is None:
+            return
+        quantity = reservation.quantity if quantity is None else min(quantity, reservation.quantity)
+        return_stock({reservation.book_id: quantity})
+        if quantity == reservation.quantity:
+            reservation.delete()
+        else:
+            StockReservation.objects.filter(pk=reservation.pk).update(quantity=F('quantity') - quantity)
+        transaction.on_commit(lambda: bump_book_version(reservation.book_id))
+
+
+def extend(order):
+    """Keep the order's copies while its owner is paying, up to the maximum hold."""
+    StockReservation.objects.filter(line__order=order).update(expires_at=extended_expiry())
+
+
+def confirm_orders(order_ids):
+    """Paid orders keep their copies for good, forget the reservations."""
+    StockReservation.objects.filter(line__order__in=order_ids).delete()
+
+
+def release_expired(now=None):
+    """
+    Return the copies of every expired reservation and drop their lines
+    from the carts. Returns how many reservations expired.
+    """
+    now = now or timezone.now()
+    with write_atomic():
+        expired = StockReservation.objects.select_for_update().filter(expires_at__lte=now)
+        rows = list(expired.values_list('pk', 'line_id', 'book_id', 'quantity'))
+        if not rows:
+            return 0
+        quantities = defaultdict(int)
+        for _, _, book_id, quantity in rows:
+            quantities[book_id] += quantity
+        return_stock(quantities)
+        StockReservation.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        lines = OrderBook.objects.filter(pk__in=[row[1] for row in rows], ordered=False)
+        users = set(lines.values_list('user_id', flat=True))
+        # The line signals keep the order totals right
+        lines.delete()
+        transaction.on_commit(lambda: bump_book_version(*quantities))
+    invalidate_cart_summaries(users)
+    return len(rows)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from djbooks.assets import BUNDLES, brotli, build, remove_stale
+
+
+class Command(BaseCommand):
+    help = 'Compiles, minifies and fingerprints the CSS/JS bundles (see djbooks.assets)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('bundles', nargs='*', help='Bundles to build, all by default')
+        parser.add_argument('--clean', action='store_true',
+                            help='Delete the files of previous builds')
+
+    def handle(self, *args, **options):
+        unknown = set(options['bundles']) - set(BUNDLES)
+        if unknown:
+            raise CommandError(f'Unknown bundles: {", ".join(sorted(unknown))}')
+        if brotli is None:
+            self.stdout.write(self.style.WARNING('brotli is not installed, only gzip copies are written'))
+        built = build(options['bundles'])
+        for name, (filename, sizes) in built.items():
+            self.stdout.write(
+                f'{filename}: {sizes["sources"] // 1024} KB sources, {sizes["min"] // 1024} KB minified, '
+                + ', '.join(f'{sizes[ext] // 1024} KB {ext}' for ext in ('gz', 'br') if ext in sizes))
+        if options['clean']:
+            self.stdout.write(f'{remove_stale()} old files removed')
+        self.stdout.write(self.style.SUCCESS(f'{len(built)} bundles built'))
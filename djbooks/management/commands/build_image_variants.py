@@ -0,0 +1,62 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from djbooks.catalog_cache import bump_catalog_version
+from djbooks.images import render_variants
+from djbooks.models import Book, ExtraImage
+
+
+class Command(BaseCommand):
+    help = 'Generates the resized variants of existing covers and extra images'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                            help='Number of worker processes')
+        parser.add_argument('--force', action='store_true',
+                            help='Regenerate variants that already exist')
+
+    def get_jobs(self, force):
+        default = Book._meta.get_field('cover').default
+        for book in Book.objects.only('cover', 'back', 'cover_variants', 'back_variants'):
+            for field in ('cover', 'back'):
+                file = getattr(book, field)
+                variants = getattr(book, f'{field}_variants')
+                if not file or file.name == default:
+                    continue
+                if force or variants.get('source') != file.name:
+                    yield Book, book.pk, f'{field}_variants', file
+        for extra in ExtraImage.objects.only('image', 'variants'):
+            if extra.image and (force or extra.variants.get('source') != extra.image.name):
+                yield ExtraImage, extra.pk, 'variants', extra.image
+
+    def handle(self, *args, **kwargs):
+        jobs = list(self.get_jobs(kwargs['force']))
+        # Forked workers must not share the parent's database connection
+        connections.close_all()
+        done = failed = 0
+        with ProcessPoolExecutor(max_workers=kwargs['workers']) as pool:
+            futures = {
+                pool.submit(render_variants, file.storage.path(file.name)): (model, pk, field, file.name)
+                for model, pk, field, file in jobs
+            }
+            for future in as_completed(futures):
+                model, pk, field, name = futures[future]
+                try:
+                    sizes = future.result()
+                except Exception as error:
+                    failed += 1
+                    self.stderr.write('%s: %s' % (name, error))
+                    continue
+                model.objects.filter(pk=pk).update(**{field: {'source': name, **sizes}})
+                done += 1
+                if done % 100 == 0:
+                    self.stdout.write('%d/%d images processed' % (done, len(jobs)))
+
+        if done:
+            # Rows were updated without signals, drop every cached fragment
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            '%d images processed, %d failed' % (done, failed)))
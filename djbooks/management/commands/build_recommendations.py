@@ -0,0 +1,38 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.utils import timezone
+
+from djbooks.catalog_cache import bump_catalog_version
+from djbooks.models import BookNeighbor
+from djbooks.recommendations import books_ordered_since, refresh_recommendations
+
+
+class Command(BaseCommand):
+    help = ('Refreshes the precomputed related books. By default only books '
+            'ordered since the last run are recomputed, wishlist changes are '
+            'picked up by --full')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true',
+                            help='Recompute the whole catalog')
+        parser.add_argument('--hours', type=int,
+                            help='Recompute books ordered in the last N hours')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['hours']:
+            since = timezone.now() - timedelta(hours=kwargs['hours'])
+        else:
+            since = BookNeighbor.objects.aggregate(last=Max('updated_at'))['last']
+
+        if kwargs['full'] or since is None:
+            updated = refresh_recommendations()
+        else:
+            books = books_ordered_since(since)
+            updated = refresh_recommendations(books) if books else 0
+
+        if updated:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            'Related books refreshed for %d books' % updated))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from djbooks.fake_mercadopago import FakeMercadoPagoServer
+
+
+class Command(BaseCommand):
+    help = 'Runs a local fake Mercado Pago API (set MERCADO_PAGO_API_URL to its address)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', type=str, default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **kwargs):
+        server = FakeMercadoPagoServer((kwargs['host'], kwargs['port']), verbose=True)
+        self.stdout.write(self.style.SUCCESS(f'Fake Mercado Pago listening on {server.url}'))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,221 @@
+import random
+import time
+from datetime import timedelta
+from decimal import Decimal
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+from taggit.models import Tag, TaggedItem
+
+from djbooks.catalog_cache import bump_catalog_version
+from djbooks.models import Book, Category, Order, OrderBook
+from djbooks.orders import snapshot_orders
+from djbooks.recommendations import refresh_recommendations
+from djbooks.search import FuzzySearchBackend, get_search_backend
+from djbooks.stats import refresh_category_counts
+
+
+# Everything generated is named with this prefix so it can be told apart
+PREFIX = 'bench'
+
+# --size -> (books, categories, tags, users)
+SIZES = {
+    '1k': (1_000, 12, 40, 100),
+    '100k': (100_000, 40, 400, 5_000),
+    '1m': (1_000_000, 120, 2_000, 50_000),
+}
+
+WORDS = (
+    'amor guerra noche ciudad mar sombra tiempo silencio memoria viaje casa '
+    'jardín río sueño fuego luz camino muerte vida historia secreto isla '
+    'hombre mujer niño perro ángel diablo rey reina imperio puerta ventana '
+    'libro carta palabra nombre otoño invierno verano primavera montaña '
+    'desierto bosque lluvia viento piedra sangre oro plata cielo tierra'
+).split()
+FIRST_NAMES = (
+    'Gabriel Isabel Jorge Julio Laura Elena Carlos Rosario Octavio Juan Ana '
+    'Mario Clarice Pablo Alejandra Roberto Silvina Rubén Gioconda Horacio'
+).split()
+LAST_NAMES = (
+    'García Allende Borges Cortázar Esquivel Garro Fuentes Castellanos Paz '
+    'Rulfo Vargas Lispector Neruda Pizarnik Bolaño Ocampo Darío Belli Quiroga'
+).split()
+PUBLISHERS = (
+    'Alfaguara', 'Anagrama', 'Planeta', 'Sexto Piso', 'Tusquets', 'Era',
+    'Seix Barral', 'Fondo de Cultura', 'Siruela', 'Almadía', 'Debolsillo',
+)
+CONDITIONS = ('Nuevo', 'Como nuevo', 'Buen estado', 'Aceptable')
+
+
+def zipf_weights(n):
+    # A few categories, tags and books get most of the traffic. Cumulative
+    # so random.choices doesn't add them up again on every call
+    return list(accumulate(1 / (rank + 1) for rank in range(n)))
+
+
+class Command(BaseCommand):
+    help = ('Fills the database with a reproducible synthetic catalog (books, '
+            'categories, tags, users, wishlists and orders) for benchmarks')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--size', choices=SIZES, default='1k')
+        parser.add_argument('--books', type=int, help='Overrides --size')
+        parser.add_argument('--users', type=int, help='Overrides --size')
+        parser.add_argument('--orders', type=int, default=2,
+                            help='Completed orders per user')
+        parser.add_argument('--wishlist', type=int, default=5,
+                            help='Wished books per user')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--clear', action='store_true',
+                            help='Remove previously generated data first')
+
+    def handle(self, *args, **kwargs):
+        books, categories, tags, users = SIZES[kwargs['size']]
+        books = kwargs['books'] or books
+        users = kwargs['users'] or users
+        self.rng = random.Random(kwargs['seed'])
+        self.batch_size = kwargs['batch_size']
+        if kwargs['clear']:
+            self.clear()
+
+        started = time.monotonic()
+        self.categories = self.create_categories(categories)
+        self.tags = self.create_tags(tags)
+        book_ids = self.create_books(books)
+        user_ids = self.create_users(users)
+        self.create_wishlists(user_ids, book_ids, kwargs['wishlist'])
+        self.create_orders(user_ids, book_ids, kwargs['orders'])
+
+        refresh_category_counts()
+        refresh_recommendations()
+        bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS('%d books and %d users generated in %.1fs' % (
+            len(book_ids), len(user_ids), time.monotonic() - started)))
+
+    def clear(self):
+        # Their carts, orders and lines go with the users
+        get_user_model().objects.filter(username__startswith=f'{PREFIX}-').delete()
+        Book.objects.filter(slug__startswith=f'{PREFIX}-').delete()
+        self.stdout.write('Previous synthetic data removed')
+
+    def create_categories(self, count):
+        ids = []
+        for n in range(count):
+            # Saved one by one so they get a slug, like import_catalog
+            category, _ = Category.objects.get_or_create(name=f'{PREFIX.title()} {n + 1}')
+            ids.append(category.pk)
+        return ids
+
+    def create_tags(self, count):
+        names = [f'{PREFIX}-{WORDS[n % len(WORDS)]}-{n}' for n in range(count)]
+        existing = dict(Tag.objects.filter(name__in=names).values_list('name', 'pk'))
+        Tag.objects.bulk_create([Tag(name=name, slug=name) for name in names if name not in existing])
+        existing.update(Tag.objects.filter(name__in=names).values_list('name', 'pk'))
+        return [existing[name] for name in names]
+
+    def make_book(self, number):
+        rng = self.rng
+        title = ' '.join(rng.choices(WORDS, k=rng.randint(2, 5))).capitalize()
+        price = Decimal('%.2f' % rng.uniform(100, 1500))
+        return Book(
+            title=title,
+            author=f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+            editorial=rng.choice(PUBLISHERS),
+            edition=str(rng.randint(1, 5)),
+            year=str(rng.randint(1950, 2023)),
+            price=price,
+            discount_price=Decimal('%.2f' % (float(price) * rng.uniform(0.7, 0.95))) if rng.random() < 0.2 else None,
+            description=' '.join(rng.choices(WORDS, k=rng.randint(12, 30))).capitalize() + '.',
+            condition=rng.choice(CONDITIONS),
+            stock=0 if rng.random() < 0.1 else rng.randint(1, 10),
+            slug=f'{PREFIX}-{number}-{slugify(title)}',
+        )
+
+    def create_books(self, count):
+        first = Book.objects.filter(slug__startswith=f'{PREFIX}-').count()
+        content_type = ContentType.objects.get_for_model(Book)
+        category_weights = zipf_weights(len(self.categories))
+        tag_weights = zipf_weights(len(self.tags))
+        Through = Book.category.through
+        ids = []
+        for start in range(0, count, self.batch_size):
+            books = [self.make_book(first + number)
+                     for number in range(start, min(start + self.batch_size, count))]
+            with transaction.atomic():
+                Book.objects.bulk_create(books)
+                Through.objects.bulk_create([
+                    Through(book_id=book.pk, category_id=category_id)
+                    for book in books
+                    for category_id in set(self.rng.choices(
+                        self.categories, cum_weights=category_weights, k=self.rng.randint(1, 3)))
+                ])
+                TaggedItem.objects.bulk_create([
+                    TaggedItem(content_type=content_type, object_id=book.pk, tag_id=tag_id)
+                    for book in books
+                    for tag_id in set(self.rng.choices(self.tags, cum_weights=tag_weights, k=self.rng.randint(0, 4)))
+                ])
+                # bulk_create skips the post_save signals
+                get_search_backend().index_books(book.pk for book in books)
+                FuzzySearchBackend().index_books(book.pk for book in books)
+            ids += [book.pk for book in books]
+            self.stdout.write('%d/%d books' % (len(ids), count))
+        return ids
+
+    def create_users(self, count):
+        User = get_user_model()
+        first = User.objects.filter(username__startswith=f'{PREFIX}-').count()
+        # Hashing once, the benchmark logs them in without a password
+        password = make_password(None)
+        users = User.objects.bulk_create([
+            User(username=f'{PREFIX}-{first + n}', password=password)
+            for n in range(count)
+        ], batch_size=self.batch_size)
+        return [user.pk for user in users]
+
+    def create_wishlists(self, user_ids, book_ids, size):
+        Through = Book.users_wishlist.through
+        weights = zipf_weights(len(book_ids))
+        rows = []
+        for user_id in user_ids:
+            rows += [Through(user_id=user_id, book_id=book_id)
+                     for book_id in set(self.rng.choices(book_ids, cum_weights=weights, k=size))]
+        Through.objects.bulk_create(rows, batch_size=self.batch_size)
+
+    def create_orders(self, user_ids, book_ids, per_user):
+        weights = zipf_weights(len(book_ids))
+        prices = dict(Book.objects.filter(pk__in=book_ids).values_list('pk', 'effective_price'))
+        now = timezone.now()
+        Items = Order.items.through
+        for start in range(0, len(user_ids), self.batch_size):
+            orders, baskets = [], []
+            for user_id in user_ids[start:start + self.batch_size]:
+                for _ in range(per_user):
+                    basket = {book_id: self.rng.randint(1, 2) for book_id in
+                              self.rng.choices(book_ids, cum_weights=weights, k=self.rng.randint(1, 4))}
+                    orders.append(Order(
+                        user_id=user_id, ordered=True, paid=True,
+                        ordered_date=now - timedelta(days=self.rng.randint(0, 365)),
+                        subtotal=sum(prices[pk] * qty for pk, qty in basket.items()),
+                        item_count=len(basket), item_quantity=sum(basket.values()),
+                    ))
+                    baskets.append(basket)
+            with transaction.atomic():
+                Order.objects.bulk_create(orders)
+                lines = [
+                    (order, OrderBook(user_id=order.user_id, item_id=book_id, quantity=quantity, ordered=True))
+                    for order, basket in zip(orders, baskets)
+                    for book_id, quantity in basket.items()
+                ]
+                OrderBook.objects.bulk_create([line for _, line in lines])
+                Items.objects.bulk_create([
+                    Items(order_id=order.pk, orderbook_id=line.pk) for order, line in lines
+                ])
+                snapshot_orders(order.pk for order in orders)
+        self.stdout.write('%d orders' % (len(user_ids) * per_user))
@@ -0,0 +1,205 @@
+import csv
+import json
+import os
+import time
+from decimal import Decimal, InvalidOperation
+from itertools import islice
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from taggit.models import Tag, TaggedItem
+
+from djbooks.catalog_cache import bump_catalog_version
+from djbooks.helpers import unique_slug
+from djbooks.models import Book, Category
+from djbooks.search import FuzzySearchBackend, get_search_backend
+from djbooks.stats import refresh_category_counts
+
+
+# Separator for the categories and tags columns
+LIST_SEPARATOR = '|'
+
+TEXT_FIELDS = ('title', 'author', 'editorial', 'edition', 'description', 'condition')
+
+
+class RowError(ValueError):
+    pass
+
+
+def split_list(value):
+    if isinstance(value, list):
+        return [str(item).strip() for item in value if str(item).strip()]
+    return [item.strip() for item in (value or '').split(LIST_SEPARATOR) if item.strip()]
+
+
+def load_json(line):
+    """One JSONL record, a broken line only rejects itself."""
+    try:
+        record = json.loads(line)
+    except ValueError as error:
+        raise RowError(f'invalid JSON: {error}')
+    if not isinstance(record, dict):
+        raise RowError('not a JSON object')
+    return record
+
+
+def parse_money(value):
+    money = Decimal(str(value))
+    if not money.is_finite() or money < 0:
+        raise RowError(f'invalid amount {value!r}')
+    return money
+
+
+def parse_row(row):
+    """Turn a CSV/JSONL record into Book field values plus its names lists."""
+    values = {field: (row.get(field) or '').strip() for field in TEXT_FIELDS}
+    if not values['title'] or not values['author']:
+        raise RowError('title and author are required')
+    for field in ('description', 'condition'):
+        values[field] = values[field] or None
+    values['year'] = str(row.get('year') or '').strip()[:4]
+    if row.get('price') in (None, ''):
+        raise RowError('price is required')
+    try:
+        values['price'] = parse_money(row['price'])
+        discount = row.get('discount_price')
+        values['discount_price'] = parse_money(discount) if discount not in (None, '') else None
+        # A stock of 0 is an out of stock book, only a missing one defaults
+        stock = row.get('stock')
+        values['stock'] = int(stock) if stock not in (None, '') else 1
+    except (TypeError, ValueError, InvalidOperation) as error:
+        raise RowError(str(error))
+    if values['stock'] < 0:
+        raise RowError(f"invalid stock {values['stock']}")
+    return values, split_list(row.get('categories')), split_list(row.get('tags'))
+
+
+class Command(BaseCommand):
+    help = 'Imports a supplier catalog of books from a CSV or JSONL file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', type=str,
+                            help='CSV (with header) or JSONL file')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Defaults to the file extension')
+        parser.add_argument('--batch-size', type=int, default=2000)
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Validate the file without writing anything')
+        parser.add_argument('--checkpoint', type=str,
+                            help='File recording how many records were imported')
+        parser.add_argument('--resume', action='store_true',
+                            help='Skip the records already recorded in --checkpoint')
+
+    def read_records(self, path, fmt):
+        with open(path, newline='', encoding='utf-8') as source:
+            if fmt == 'csv':
+                yield from csv.DictReader(source)
+            else:
+                # Decoded by handle(), where a broken line is one rejected record
+                for line in source:
+                    if line.strip():
+                        yield line
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as checkpoint:
+            return json.load(checkpoint)['records']
+
+    def write_checkpoint(self, path, records):
+        # Written to a temporary file first so a crash never leaves it half written
+        with open(path + '.tmp', 'w') as checkpoint:
+            json.dump({'records': records}, checkpoint)
+        os.replace(path + '.tmp', path)
+
+    def handle(self, *args, **kwargs):
+        path = kwargs['path']
+        fmt = kwargs['format'] or ('jsonl' if path.endswith(('.jsonl', '.json')) else 'csv')
+        if kwargs['resume'] and not kwargs['checkpoint']:
+            raise CommandError('--resume needs --checkpoint')
+        self.dry_run = kwargs['dry_run']
+        skip = self.read_checkpoint(kwargs['checkpoint']) if kwargs['resume'] else 0
+
+        # Everything needed to resolve rows is loaded once up front
+        self.slugs = set(Book.objects.values_list('slug', flat=True))
+        self.categories = {c.name: c.pk for c in Category.objects.all()}
+        self.tags = dict(Tag.objects.values_list('name', 'pk'))
+        self.tag_slugs = set(Tag.objects.values_list('slug', flat=True))
+        self.content_type = ContentType.objects.get_for_model(Book)
+
+        records = islice(self.read_records(path, fmt), skip, None)
+        done, imported, failed = skip, 0, 0
+        started = time.monotonic()
+        while True:
+            batch = list(islice(records, kwargs['batch_size']))
+            if not batch:
+                break
+            rows = []
+            for offset, record in enumerate(batch, start=done + 1):
+                try:
+                    rows.append(parse_row(load_json(record) if fmt == 'jsonl' else record))
+                except (RowError, AttributeError) as error:
+                    failed += 1
+                    self.stderr.write('record %d: %s' % (offset, error))
+            imported += self.import_batch(rows)
+            done += len(batch)
+            if kwargs['checkpoint'] and not self.dry_run:
+                self.write_checkpoint(kwargs['checkpoint'], done)
+            elapsed = time.monotonic() - started
+            self.stdout.write('%d records read, %d imported (%.0f rows/s)' % (
+                done, imported, imported / elapsed if elapsed else 0))
+
+        if imported and not self.dry_run:
+            refresh_category_counts()
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS('%s%d books imported, %d records rejected' % (
+            '[dry run] ' if self.dry_run else '', imported, failed)))
+
+    def import_batch(self, rows):
+        books = []
+        for values, _, _ in rows:
+            slug = unique_slug(values['title'], self.slugs)
+            self.slugs.add(slug)
+            books.append(Book(slug=slug, **values))
+        if self.dry_run:
+            return len(books)
+
+        with transaction.atomic():
+            self.create_categories(name for _, names, _ in rows for name in names)
+            self.create_tags(name for _, _, names in rows for name in names)
+            Book.objects.bulk_create(books)
+
+            Through = Book.category.through
+            Through.objects.bulk_create([
+                Through(book_id=book.pk, category_id=self.categories[name])
+                for book, (_, names, _) in zip(books, rows)
+                for name in dict.fromkeys(names)
+            ])
+            TaggedItem.objects.bulk_create([
+                TaggedItem(content_type=self.content_type, object_id=book.pk, tag_id=self.tags[name])
+                for book, (_, _, names) in zip(books, rows)
+                for name in dict.fromkeys(names)
+            ])
+            # bulk_create skips the post_save signals
+            get_search_backend().index_books(book.pk for book in books)
+            FuzzySearchBackend().index_books(book.pk for book in books)
+        return len(books)
+
+    def create_categories(self, names):
+        for name in dict.fromkeys(names):
+            if name not in self.categories:
+                # Few and rarely new, saved one by one so they get a slug
+                category = Category(name=name)
+                category.save()
+                self.categories[name] = category.pk
+
+    def create_tags(self, names):
+        new = []
+        for name in dict.fromkeys(names):
+            if name not in self.tags:
+                slug = unique_slug(name, self.tag_slugs, max_length=100, allow_unicode=True)
+                self.tag_slugs.add(slug)
+                new.append(Tag(name=name, slug=slug))
+        for tag in Tag.objects.bulk_create(new):
+            self.tags[tag.name] = tag.pk
@@ -0,0 +1,52 @@
+import os
+import re
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# Heavy modules only the code using them may import, not the start of
+# every process (see djbooks.gateway)
+LAZY_MODULES = ('mercadopago', 'requests', 'urllib3', 'PIL.Image', 'sass', 'rcssmin', 'rjsmin')
+
+# What a process does before serving its first request
+STARTUP = 'import django; django.setup(); from django.urls import get_resolver; get_resolver().url_patterns'
+
+LINE_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+class Command(BaseCommand):
+    help = 'Measures the imports of a process start with -X importtime, failing when heavy modules are loaded'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=15, help='Slowest top level imports to list')
+        parser.add_argument('--max-ms', type=float, help='Fail when the imports take longer')
+
+    def handle(self, *args, **options):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE}
+        # A fresh interpreter, this one has already imported everything
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP],
+                                env=env, capture_output=True, text=True)
+        if result.returncode:
+            raise CommandError(result.stderr)
+        imports = [
+            (int(match[1]), int(match[2]), len(match[3]) // 2, match[4])
+            for match in map(LINE_RE.match, result.stderr.splitlines()) if match
+        ]
+        total = sum(own for own, _, _, _ in imports) / 1000
+        for _, cumulative, _, name in sorted(
+                (i for i in imports if i[2] == 0), key=lambda i: -i[1])[:options['top']]:
+            self.stdout.write(f'{cumulative / 1000:8.1f} ms  {name}')
+
+        loaded = {name for _, _, _, name in imports}
+        eager = [name for name in LAZY_MODULES if name in loaded]
+        problems = []
+        if eager:
+            problems.append(f'imported at startup: {", ".join(eager)}')
+        if options['max_ms'] is not None and total > options['max_ms']:
+            problems.append(f'{total:.0f} ms of imports, the limit is {options["max_ms"]:.0f} ms')
+        if problems:
+            raise CommandError('; '.join(problems))
+        self.stdout.write(self.style.SUCCESS(f'{len(imports)} modules imported in {total:.0f} ms'))
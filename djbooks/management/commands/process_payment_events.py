@@ -0,0 +1,32 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from djbooks.payments import EVENT_BATCH_SIZE, MAX_ATTEMPTS, process_payment_events
+
+
+class Command(BaseCommand):
+    help = 'Processes the queued payment gateway notifications'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=EVENT_BATCH_SIZE)
+        parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep polling the queue instead of exiting when empty')
+        parser.add_argument('--sleep', type=float, default=2,
+                            help='Seconds to wait between polls with --loop')
+
+    def handle(self, *args, **kwargs):
+        total_events = total_payments = 0
+        while True:
+            events, payments = process_payment_events(kwargs['batch_size'], kwargs['max_attempts'])
+            total_events += events
+            total_payments += payments
+            if events:
+                self.stdout.write(f'{events} events processed, {payments} new payments')
+                continue
+            if not kwargs['loop']:
+                break
+            time.sleep(kwargs['sleep'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{total_events} events processed, {total_payments} new payments'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from djbooks.search import FuzzySearchBackend, get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the book full-text and trigram search indexes from the catalog'
+
+    def handle(self, *args, **kwargs):
+        backend = get_search_backend()
+        backend.rebuild()
+        FuzzySearchBackend().rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            'Search indexes rebuilt using %s and trigrams' % type(backend).__name__))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from djbooks.stats import refresh_category_counts
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the denormalized number of books per category'
+
+    def handle(self, *args, **kwargs):
+        updated = refresh_category_counts()
+        self.stdout.write(self.style.SUCCESS(
+            '%d categories updated' % updated))
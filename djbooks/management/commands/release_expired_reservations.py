@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from djbooks.inventory import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Returns to stock the books held by expired cart reservations'
+
+    def handle(self, *args, **kwargs):
+        released = release_expired()
+        self.stdout.write(self.style.SUCCESS(f'{released} reservations released'))
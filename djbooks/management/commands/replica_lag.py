@@ -0,0 +1,52 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+from django.utils import timezone
+
+from djbooks.models import ReplicationHeartbeat
+
+
+class Command(BaseCommand):
+    help = 'Writes a heartbeat on the primary and reports how long the replicas take to show it'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--timeout', type=float, default=10.0,
+                            help='Seconds to wait for each replica')
+        parser.add_argument('--max-lag', type=float,
+                            help='Fail when a replica is further behind, in seconds')
+
+    def handle(self, *args, **options):
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No replicas configured, set DJBOOKS_REPLICA_PATH')
+        written = ReplicationHeartbeat.beat().beat_at
+        started = time.monotonic()
+        behind = []
+        for alias in settings.DATABASE_REPLICAS:
+            caught_up, lag = self.wait(alias, written, started, options['timeout'])
+            if lag is None:
+                self.stdout.write(self.style.ERROR(f'{alias}: no heartbeat yet'))
+            elif not caught_up or (options['max_lag'] is not None and lag > options['max_lag']):
+                self.stdout.write(self.style.ERROR(f'{alias}: {lag:.2f} s behind'))
+            else:
+                self.stdout.write(self.style.SUCCESS(f'{alias}: {lag:.2f} s behind'))
+                continue
+            behind.append(alias)
+        if behind:
+            raise CommandError(f'Replicas behind: {", ".join(behind)}')
+
+    def wait(self, alias, written, started, timeout):
+        """``(caught_up, seconds behind)`` of the replica ``alias``."""
+        while True:
+            try:
+                seen = ReplicationHeartbeat.objects.using(alias).filter(pk=1).values_list('beat_at', flat=True).first()
+            except DatabaseError:
+                # Not even migrated, never synced
+                seen = None
+            if seen is not None and seen >= written:
+                return True, time.monotonic() - started
+            if time.monotonic() - started > timeout:
+                # Still showing an older beat, it's at least that far behind
+                return False, (timezone.now() - seen).total_seconds() if seen else None
+            time.sleep(0.1)
@@ -0,0 +1,97 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from djbooks.benchmark import (
+    SCENARIOS, AsgiDriver, ClientDriver, Fixture, HttpDriver, benchmark_users, compare, empty_carts,
+    environment, fill_carts, load_results, run_scenario,
+)
+from djbooks.fake_mercadopago import start_fake_server
+from djbooks.gateway import get_gateway
+
+
+class Command(BaseCommand):
+    help = ('Measures latency percentiles and throughput of the main pages, '
+            'see djbooks.benchmark. Run generate_catalog first')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--driver', choices=['client', 'asgi', 'http'], default='client',
+                            help='asgi serves the async views, compare it with client')
+        parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                            help='Repeat to pick several, all by default')
+        parser.add_argument('--requests', type=int, default=200,
+                            help='Measured requests per scenario')
+        parser.add_argument('--warmup', type=int, default=20,
+                            help='Requests per scenario sent before measuring')
+        parser.add_argument('--concurrency', type=int,
+                            help='Requests in flight, 1 for the client driver and 8 '
+                                 'for the others by default')
+        parser.add_argument('--users', type=int, default=8,
+                            help='Logged in users for the cart and checkout scenarios')
+        parser.add_argument('--url', type=str,
+                            help='Benchmark a running server instead of starting one (http driver)')
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--output', type=str, help='Write the results as JSON')
+        parser.add_argument('--compare', type=str, help='JSON results of a previous run')
+
+    def handle(self, *args, **kwargs):
+        if kwargs['url'] and kwargs['driver'] != 'http':
+            raise CommandError('--url needs --driver http')
+        try:
+            fixture = Fixture(seed=kwargs['seed'])
+        except ValueError as error:
+            raise CommandError(str(error))
+        scenarios = kwargs['scenario'] or list(SCENARIOS)
+
+        # The checkout scenario must not reach the real payment gateway
+        gateway = None
+        if not kwargs['url']:
+            gateway = start_fake_server()
+            settings.MERCADO_PAGO_API_URL = gateway.url
+            get_gateway.cache_clear()
+
+        users = benchmark_users(kwargs['users'])
+        fill_carts(users, fixture.books)
+        concurrency = kwargs['concurrency'] or (1 if kwargs['driver'] == 'client' else 8)
+        if kwargs['driver'] == 'http':
+            driver = HttpDriver(users, concurrency, kwargs['url'])
+        elif kwargs['driver'] == 'asgi':
+            driver = AsgiDriver(users, concurrency)
+        else:
+            driver = ClientDriver(users, concurrency)
+
+        results = {
+            'environment': environment(),
+            'settings': {
+                'driver': driver.name,
+                'concurrency': driver.concurrency,
+                'requests': kwargs['requests'],
+                'warmup': kwargs['warmup'],
+                'users': kwargs['users'],
+                'seed': kwargs['seed'],
+            },
+            'scenarios': {},
+        }
+        try:
+            for name in scenarios:
+                result = run_scenario(driver, fixture, name, kwargs['requests'], kwargs['warmup'], kwargs['seed'])
+                results['scenarios'][name] = result
+                self.stdout.write(
+                    '%-12s p50 %8.2f ms  p95 %8.2f ms  p99 %8.2f ms  %8.1f req/s  %s queries  %d errors' % (
+                        name, result['p50_ms'], result['p95_ms'], result['p99_ms'],
+                        result['throughput_rps'], result['queries_mean'], result['errors']))
+        finally:
+            driver.close()
+            empty_carts(users)
+            if gateway is not None:
+                gateway.shutdown()
+
+        if kwargs['output']:
+            with open(kwargs['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Results written to {kwargs['output']}"))
+        if kwargs['compare']:
+            for name, ratios in compare(load_results(kwargs['compare']), results).items():
+                self.stdout.write('%-12s %s' % (name, '  '.join(
+                    f'{metric} x{ratio}' for metric, ratio in ratios.items())))
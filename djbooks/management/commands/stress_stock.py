@@ -0,0 +1,102 @@
+import threading
+import time
+import uuid
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.utils import timezone
+
+from djbooks.inventory import OutOfStock, release_expired, reserve
+from djbooks.models import Book, OrderBook, StockReservation
+
+
+class Command(BaseCommand):
+    help = ('Many threads reserving the same few books at once, reports the '
+            'reservations per second and checks nothing is oversold. Creates its '
+            'own books and users and removes them after. The same race is covered '
+            'by the test suite, this is for measuring it on a real database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--books', type=int, default=5)
+        parser.add_argument('--stock', type=int, default=50,
+                            help='Copies of each book')
+        parser.add_argument('--attempts', type=int, default=100,
+                            help='Reservations tried by each thread')
+
+    def handle(self, *args, **kwargs):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA journal_mode')
+                self.stdout.write(f'SQLite journal mode: {cursor.fetchone()[0]}')
+
+        run = uuid.uuid4().hex[:8]
+        User = get_user_model()
+        books = [Book.objects.create(
+            title=f'stress {run} {i}', author='stress', editorial='stress', edition='1',
+            year='2000', price=1, stock=kwargs['stock']) for i in range(kwargs['books'])]
+        users = [User.objects.create(username=f'stress-{run}-{i}') for i in range(kwargs['threads'])]
+        try:
+            self.stress(books, users, kwargs['attempts'])
+        finally:
+            StockReservation.objects.filter(book__in=books).delete()
+            OrderBook.objects.filter(user__in=users).delete()
+            Book.objects.filter(pk__in=[book.pk for book in books]).delete()
+            User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def stress(self, books, users, attempts):
+        # One cart line per user and book, created before the clock starts
+        lines = {user.pk: [OrderBook.objects.create(user=user, item=book, quantity=0) for book in books]
+                 for user in users}
+        results = Counter()
+        lock = threading.Lock()
+        start = threading.Barrier(len(users))
+
+        def worker(user_id):
+            local = Counter()
+            try:
+                start.wait()
+                for attempt in range(attempts):
+                    try:
+                        reserve(lines[user_id][attempt % len(books)])
+                        local['reserved'] += 1
+                    except OutOfStock:
+                        local['out of stock'] += 1
+                    except OperationalError:
+                        local['lock errors'] += 1
+            finally:
+                connections.close_all()
+                with lock:
+                    results.update(local)
+
+        threads = [threading.Thread(target=worker, args=(user.pk,)) for user in users]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - started
+
+        total = sum(results.values())
+        self.stdout.write('%d reservations tried in %.2fs (%.0f/s): %s' % (
+            total, elapsed, total / elapsed if elapsed else 0, dict(results)))
+
+        stock = {book.pk: book.stock for book in books}
+        held = Counter()
+        for book_id, quantity in StockReservation.objects.filter(book__in=books).values_list('book_id', 'quantity'):
+            held[book_id] += quantity
+        remaining = dict(Book.objects.filter(pk__in=stock).values_list('pk', 'stock'))
+        for pk, initial in stock.items():
+            if remaining[pk] < 0 or remaining[pk] + held[pk] != initial:
+                raise CommandError(f'Book {pk}: {initial} copies, {remaining[pk]} left and {held[pk]} reserved')
+        if results['reserved'] != sum(held.values()):
+            raise CommandError(f"{results['reserved']} reservations but {sum(held.values())} copies held")
+
+        StockReservation.objects.filter(book__in=books).update(expires_at=timezone.now())
+        release_expired()
+        remaining = dict(Book.objects.filter(pk__in=stock).values_list('pk', 'stock'))
+        if remaining != stock:
+            raise CommandError(f'Stock not restored after expiring: {remaining} != {stock}')
+        self.stdout.write(self.style.SUCCESS('No book oversold, all stock restored on expiry'))
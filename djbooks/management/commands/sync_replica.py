@@ -0,0 +1,44 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from djbooks.models import ReplicationHeartbeat
+
+
+class Command(BaseCommand):
+    help = 'Copies the SQLite primary onto the replica files (DATABASE_REPLICAS)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep copying every --interval seconds')
+        parser.add_argument('--interval', type=float, default=1.0)
+
+    def handle(self, *args, **options):
+        primary = connections['default']
+        if primary.vendor != 'sqlite':
+            raise CommandError('Only SQLite replicas are copied here, other databases replicate themselves')
+        if not settings.DATABASE_REPLICAS:
+            raise CommandError('No replicas configured, set DJBOOKS_REPLICA_PATH')
+        while True:
+            started = time.perf_counter()
+            self.sync(primary)
+            self.stdout.write(self.style.SUCCESS(
+                f'{len(settings.DATABASE_REPLICAS)} replicas synced in {(time.perf_counter() - started) * 1000:.0f} ms'))
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def sync(self, primary):
+        # Copied with the heartbeat, so replica_lag can tell how old the copy is
+        ReplicationHeartbeat.beat()
+        primary.ensure_connection()
+        for alias in settings.DATABASE_REPLICAS:
+            # The backup API copies a consistent snapshot page by page,
+            # readers of the replica wait for it like for any writer
+            target = sqlite3.connect(connections[alias].settings_dict['NAME'], timeout=20)
+            try:
+                primary.connection.backup(target)
+            finally:
+                target.close()
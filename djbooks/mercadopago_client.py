@@ -0,0 +1,42 @@
+"""
+Mercado Pago SDK http client, only imported by djbooks.gateway when
+the SDK is first used.
+"""
+import requests
+from mercadopago.http import HttpClient
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
+
+
+# Base URL hard-coded in the SDK configuration
+MERCADO_PAGO_API = 'https://api.mercadopago.com'
+
+# Connections kept open to the gateway, process_payment_events fetches
+# payments from 8 threads
+POOL_SIZE = 8
+
+
+class PooledHttpClient(HttpClient):
+    """
+    The SDK's own client opens a new session, and so a new TLS
+    connection, for every call; this one keeps a pool. Requests go to
+    ``api_url``, so development and tests can point it at
+    ``djbooks.fake_mercadopago``.
+    """
+
+    def __init__(self, api_url=None, max_retries=3):
+        self.api_url = (api_url or MERCADO_PAGO_API).rstrip('/')
+        # Same retries as the SDK, once for all calls
+        retries = Retry(total=max_retries, status_forcelist=[429, 500, 502, 503, 504])
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=retries)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, maxretries=None, **kwargs):
+        # maxretries is the SDK default, already in the adapter
+        if url.startswith(MERCADO_PAGO_API):
+            url = self.api_url + url[len(MERCADO_PAGO_API):]
+        result = self.session.request(method, url, **kwargs)
+        return {'status': result.status_code, 'response': result.json()}
+
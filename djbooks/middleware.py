@@ -0,0 +1,149 @@
+"""
+Per request SQL instrumentation.
+
+``query_count_middleware`` sees every query run while a view handles
+the request (``record_query`` wraps every connection) and records how
+many ran, how long they took and how often the same statement repeated. Statements
+are grouped by fingerprint: the SQL without its parameters and with
+``IN (%s, %s, ...)`` lists collapsed, so the queries issued by a loop
+over rows share one. A fingerprint seen ``QUERY_N_PLUS_ONE_THRESHOLD``
+times or more is reported as a likely N+1.
+
+Every request is logged on the ``djbooks.queries`` logger with the
+figures in ``extra``, at WARNING when an N+1 is found or the view goes
+over its entry in ``QUERY_BUDGETS``. With ``QUERY_COUNT_HEADERS`` the
+figures are also sent as ``X-Query-*`` response headers.
+"""
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+
+logger = logging.getLogger('djbooks.queries')
+
+IN_LIST_RE = re.compile(r'IN \((?:%s, )*%s\)')
+SPACES_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    sql = SPACES_RE.sub(' ', IN_LIST_RE.sub('IN (...)', sql)).strip()
+    return hashlib.sha1(sql.encode()).hexdigest()[:12], sql
+
+
+# Recorders active in the current context. A context variable instead of
+# a per thread wrapper so queries run by async views, through
+# sync_to_async in other threads, are recorded too
+active_recorders = ContextVar('active_recorders', default=())
+
+
+def record_query(execute, sql, params, many, context):
+    """Execute wrapper installed on every connection (see djbooks.signals)."""
+    recorders = active_recorders.get()
+    if not recorders:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        for recorder in recorders:
+            recorder.add(sql, duration)
+
+
+class QueryRecorder:
+    """
+    Records the queries run on every database connection while active,
+    used as a context manager.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+        self.statements = {}
+
+    def add(self, sql, duration):
+        self.duration += duration
+        self.count += 1
+        key, statement = fingerprint(sql)
+        self.fingerprints[key] += 1
+        self.statements.setdefault(key, statement)
+
+    def __enter__(self):
+        self.token = active_recorders.set(active_recorders.get() + (self,))
+        return self
+
+    def __exit__(self, *exc_info):
+        active_recorders.reset(self.token)
+
+    def repeated(self, threshold=None):
+        """``[(fingerprint, times, sql)]`` of the statements run ``threshold`` times or more."""
+        if threshold is None:
+            threshold = getattr(settings, 'QUERY_N_PLUS_ONE_THRESHOLD', 5)
+        return [
+            (key, times, self.statements[key])
+            for key, times in self.fingerprints.most_common()
+            if times >= threshold
+        ]
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else None
+
+
+def report(request, response, recorder):
+    name = view_name(request)
+    repeated = recorder.repeated()
+    budget = getattr(settings, 'QUERY_BUDGETS', {}).get(name)
+    over_budget = budget is not None and recorder.count > budget
+    logger.log(
+        logging.WARNING if repeated or over_budget else logging.DEBUG,
+        '%s %s: %d queries in %.1f ms%s%s',
+        request.method, request.path, recorder.count, recorder.duration * 1000,
+        ' (budget %d)' % budget if over_budget else '',
+        ', repeated: %s' % ', '.join('%s x%d' % (key, times) for key, times, _ in repeated) if repeated else '',
+        extra={
+            'view': name,
+            'path': request.path,
+            'status': response.status_code,
+            'query_count': recorder.count,
+            'query_time_ms': round(recorder.duration * 1000, 2),
+            'query_budget': budget,
+            'n_plus_one': [
+                {'fingerprint': key, 'times': times, 'sql': sql}
+                for key, times, sql in repeated
+            ],
+        },
+    )
+
+    if getattr(settings, 'QUERY_COUNT_HEADERS', settings.DEBUG):
+        response['X-Query-Count'] = str(recorder.count)
+        response['X-Query-Time'] = '%.1f' % (recorder.duration * 1000)
+        if repeated:
+            response['X-Query-Repeated'] = ', '.join(
+                '%s;n=%d' % (key, times) for key, times, _ in repeated)
+    return response
+
+
+@sync_and_async_middleware
+def query_count_middleware(get_response):
+    # Async capable so it doesn't force the async views through a thread
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            with QueryRecorder() as recorder:
+                response = await get_response(request)
+            return report(request, response, recorder)
+    else:
+        def middleware(request):
+            with QueryRecorder() as recorder:
+                response = get_response(request)
+            return report(request, response, recorder)
+    return middleware
@@ -2,15 +2,19 @@
 
 from django.conf import settings
 from django.db import migrations, models
+from django.utils.text import slugify
 import djbooks.models
-from djbooks.models import Category
 
+# Historical models don't run Category.save, so the slug is set here
 def create_data(apps, schema_editor):
-    obj, created = Category.objects.get_or_create(name="Ciudad de México")
-    if created:
-        obj.save()
+    Category = apps.get_model('djbooks', 'Category')
+    Category.objects.get_or_create(
+        name="Ciudad de México",
+        defaults={'slug': slugify("Ciudad de México")},
+    )
 
 def delete_data(apps, schema_editor):
+    Category = apps.get_model('djbooks', 'Category')
     Category.objects.filter(name="Ciudad de México").delete()
 
 class Migration(migrations.Migration):
@@ -0,0 +1,52 @@
+from django.db import migrations
+
+
+# Copied rather than imported from djbooks.search, which keeps changing
+# after this migration
+FTS_CREATE_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS djbooks_book_fts USING fts5(
+    title, author, editorial, description, tags,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+
+FTS_DROP_SQL = "DROP TABLE IF EXISTS djbooks_book_fts"
+
+FTS_POPULATE_SQL = """
+INSERT INTO djbooks_book_fts (rowid, title, author, editorial, description, tags)
+SELECT b.id, b.title, b.author, b.editorial, COALESCE(b.description, ''),
+    COALESCE((
+        SELECT group_concat(t.name, ' ')
+        FROM taggit_taggeditem ti
+        JOIN taggit_tag t ON t.id = ti.tag_id
+        JOIN django_content_type ct ON ct.id = ti.content_type_id
+        WHERE ti.object_id = b.id
+            AND ct.app_label = 'djbooks' AND ct.model = 'book'
+    ), '')
+FROM djbooks_book b
+"""
+
+
+def create_index(apps, schema_editor):
+    # FTS5 is SQLite only, other databases use DatabaseSearchBackend
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(FTS_CREATE_SQL)
+    schema_editor.execute(FTS_POPULATE_SQL)
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(FTS_DROP_SQL)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taggit', '0005_auto_20220424_2025'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('djbooks', '0002_load_data'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
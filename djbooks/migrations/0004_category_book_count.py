@@ -0,0 +1,25 @@
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def count_books(apps, schema_editor):
+    Category = apps.get_model('djbooks', 'Category')
+    categories = list(Category.objects.annotate(total=Count('book')))
+    for category in categories:
+        category.book_count = category.total
+    Category.objects.bulk_update(categories, ['book_count'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0003_book_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='book_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_books, migrations.RunPython.noop),
+    ]
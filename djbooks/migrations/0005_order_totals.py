@@ -0,0 +1,47 @@
+from django.db import migrations, models
+from django.db.models import Case, Count, F, Q, Sum, When
+
+
+def compute_totals(apps, schema_editor):
+    Order = apps.get_model('djbooks', 'Order')
+    line_total = F('quantity') * Case(
+        When(~Q(item__discount_price=0) & Q(item__discount_price__isnull=False),
+             then=F('item__discount_price')),
+        default=F('item__price'),
+    )
+    for order in Order.objects.all():
+        totals = order.items.aggregate(
+            subtotal=Sum(line_total),
+            item_count=Count('id'),
+            item_quantity=Sum('quantity'),
+        )
+        Order.objects.filter(pk=order.pk).update(
+            subtotal=totals['subtotal'] or 0,
+            item_count=totals['item_count'],
+            item_quantity=totals['item_quantity'] or 0,
+        )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0004_category_book_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='subtotal',
+            field=models.FloatField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='item_quantity',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(compute_totals, migrations.RunPython.noop),
+    ]
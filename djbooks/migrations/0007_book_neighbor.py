@@ -0,0 +1,47 @@
+# Generated by Django 4.1.7 on 2026-10-18 17:30
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_curated(apps, schema_editor):
+    # Keep showing the hand picked related books until recommendations are built
+    Book = apps.get_model('djbooks', 'Book')
+    BookNeighbor = apps.get_model('djbooks', 'BookNeighbor')
+    ranks = {}
+    rows = []
+    for book_id, related_id in Book.related_books.through.objects.values_list(
+            'from_book_id', 'to_book_id').order_by('pk'):
+        rank = ranks.get(book_id, 0)
+        if rank < 12:
+            rows.append(BookNeighbor(book_id=book_id, neighbor_id=related_id, rank=rank, score=2.0))
+            ranks[book_id] = rank + 1
+    BookNeighbor.objects.bulk_create(rows)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0006_image_variants'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookNeighbor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.PositiveSmallIntegerField()),
+                ('score', models.FloatField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbors', to='djbooks.book')),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recommended_in', to='djbooks.book')),
+            ],
+            options={
+                'ordering': ['book', 'rank'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='bookneighbor',
+            constraint=models.UniqueConstraint(fields=('book', 'rank'), name='unique_book_neighbor_rank'),
+        ),
+        migrations.RunPython(copy_curated, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.1.7 on 2026-10-18 17:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0007_book_neighbor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='preference_expires',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='preference_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='preference_id',
+            field=models.CharField(blank=True, editable=False, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 4.1.7 on 2026-10-18 17:35
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0009_payment_events'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reservations', to='djbooks.book')),
+                ('line', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='reservation', to='djbooks.orderbook')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.1.7 on 2026-10-18 17:38
+
+from django.db import migrations, models
+import django.db.models.expressions
+import django.db.models.functions.comparison
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0010_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(django.db.models.functions.comparison.Coalesce(django.db.models.functions.comparison.NullIf(models.F('discount_price'), django.db.models.expressions.RawSQL('0.0', ())), models.F('price')), models.F('id'), name='book_effective_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['year', 'id'], name='book_year_idx'),
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 4.1.7 on 2026-10-18 17:43
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# Inlined rather than imported from djbooks.trigrams and djbooks.helpers,
+# which keep changing after this migration
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+
+def trigrams(text):
+    decomposed = unicodedata.normalize('NFKD', text)
+    folded = ''.join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+    grams = set()
+    for word in NON_WORD_RE.sub(' ', folded).split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def populate_trigrams(apps, schema_editor):
+    Book = apps.get_model('djbooks', 'Book')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+    BookTrigram = apps.get_model('djbooks', 'BookTrigram')
+    documents = {pk: [title, author] for pk, title, author in Book.objects.values_list('pk', 'title', 'author')}
+    tagged = TaggedItem.objects.filter(content_type__app_label='djbooks', content_type__model='book')
+    for pk, name in tagged.values_list('object_id', 'tag__name'):
+        if pk in documents:
+            documents[pk].append(name)
+    rows = []
+    for pk, parts in documents.items():
+        grams = trigrams(' '.join(parts))
+        rows += [BookTrigram(book_id=pk, gram=gram, doc_size=len(grams)) for gram in grams]
+    BookTrigram.objects.bulk_create(rows, batch_size=5000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taggit', '0005_auto_20220424_2025'),
+        ('djbooks', '0011_book_sort_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookTrigram',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('gram', models.CharField(max_length=3)),
+                ('doc_size', models.PositiveSmallIntegerField()),
+                ('book', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='djbooks.book')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='booktrigram',
+            index=models.Index(fields=['gram', 'book'], name='book_trigram_gram_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='booktrigram',
+            constraint=models.UniqueConstraint(fields=('book', 'gram'), name='unique_book_trigram'),
+        ),
+        migrations.RunPython(populate_trigrams, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,64 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:08
+
+import os
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def thumbnail_url(book):
+    # djbooks.images.ImageVariants.url('thumbnail') as of this migration
+    cover = book.cover
+    if not cover:
+        return None
+    variants = book.cover_variants or {}
+    if variants.get('source') == cover.name and 'thumbnail' in variants:
+        root, _ = os.path.splitext(cover.name)
+        return cover.storage.url(f'{root}_thumbnail.jpg')
+    return cover.url
+
+
+def snapshot_paid_orders(apps, schema_editor):
+    # Inlined rather than imported from djbooks.orders, which keeps
+    # changing after this migration
+    Order = apps.get_model('djbooks', 'Order')
+    lines = Order.items.through.objects.filter(order__ordered=True).select_related(
+        'orderbook__item').order_by('orderbook_id')
+    snapshots = {pk: [] for pk in Order.objects.filter(ordered=True).values_list('pk', flat=True)}
+    for row in lines:
+        book, quantity = row.orderbook.item, row.orderbook.quantity
+        # Prices are still floats here, as strings through str so the
+        # JSON keeps the cents
+        unit_price = Decimal(str(book.discount_price or book.price))
+        snapshots[row.order_id].append({
+            'book': book.pk,
+            'slug': book.slug,
+            'title': book.title,
+            'unit_price': str(unit_price),
+            'quantity': quantity,
+            'total': str(unit_price * quantity),
+            'thumbnail': thumbnail_url(book),
+        })
+    Order.objects.bulk_update(
+        [Order(pk=pk, snapshot=snapshot) for pk, snapshot in snapshots.items()],
+        ['snapshot'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0013_replication_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='snapshot',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'ordered', 'ordered_date', 'id'], name='order_history_idx'),
+        ),
+        migrations.RunPython(snapshot_paid_orders, migrations.RunPython.noop),
+    ]
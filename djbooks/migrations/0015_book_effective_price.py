@@ -0,0 +1,61 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:11
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import F, Value
+from django.db.models.functions import Coalesce, NullIf
+
+
+def fill_effective_price(apps, schema_editor):
+    # Inlined rather than imported from djbooks.models, which keeps changing
+    # after this migration. A discount of 0 means no discount.
+    Book = apps.get_model('djbooks', 'Book')
+    money = models.DecimalField(max_digits=10, decimal_places=2)
+    Book.objects.update(effective_price=Coalesce(
+        NullIf(F('discount_price'), Value(Decimal(0), output_field=money)), F('price'),
+        output_field=money))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0014_order_snapshot'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='book',
+            name='book_effective_price_idx',
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='effective_price',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='discount_price',
+            field=models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='price',
+            field=models.DecimalField(blank=True, decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='subtotal',
+            field=models.DecimalField(decimal_places=2, default=0, editable=False, max_digits=12),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='amount',
+            field=models.DecimalField(decimal_places=2, max_digits=10),
+        ),
+        migrations.RunPython(fill_effective_price, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='book',
+            index=models.Index(fields=['effective_price', 'id'], name='book_price_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.1.7 on 2026-10-18 18:37
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('djbooks', '0016_payment_event_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stockreservation',
+            name='held_since',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,16 +1,24 @@
-from email.mime import image
+import hashlib
+import json
+from datetime import timedelta
+from decimal import Decimal
+
 from django.db.models.signals import post_save
 from django.conf import settings
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Count, F, Min, Sum, Value
+from django.db.models.functions import Coalesce, NullIf
 from django.shortcuts import reverse
+from django.utils import timezone
+from django.utils.functional import cached_property
 from django.utils.text import slugify
 
 from django.utils.translation import gettext_lazy as _
 from taggit.managers import TaggableManager
 
-from djbooks.helpers import upload_with_uuid
-
-from mercadopago import SDK
+from djbooks.gateway import get_gateway
+from djbooks.helpers import unique_slug, upload_with_uuid
+from djbooks.images import ImageVariants
 
 PATH = "static/assets/books/"
 
@@ -30,6 +38,8 @@ class Category(models.Model):
     default="djbooks/static/assets/images/inner-page/banner.jpg", 
     null=True)
     slug = models.SlugField(max_length=40, blank=True)
+    # Denormalized, kept up to date by djbooks.signals
+    book_count = models.PositiveIntegerField(default=0, editable=False)
 
     def __str__(self):
         return self.name
@@ -41,6 +51,55 @@ class Category(models.Model):
     class Meta:
         verbose_name_plural = "Categories"
 
+# Money, exact to the cent
+MONEY = {'max_digits': 10, 'decimal_places': 2}
+
+PRICE_FIELDS = {'price', 'discount_price'}
+
+
+def effective_price(discount_price=F('discount_price'), price=F('price')):
+    """Price a book sells for, a discount of 0 means no discount."""
+    money = models.DecimalField(**MONEY)
+    if not hasattr(discount_price, 'resolve_expression'):
+        discount_price = Value(discount_price, output_field=money)
+    if not hasattr(price, 'resolve_expression'):
+        price = Value(price, output_field=money)
+    return Coalesce(NullIf(discount_price, Value(Decimal(0), output_field=money)), price,
+                    output_field=money)
+
+
+class BookQuerySet(models.QuerySet):
+    """
+    Keeps ``Book.effective_price`` in sync on bulk writes, ``Book.save``
+    does it for single books. Raw SQL changing prices has to set it too.
+    """
+
+    def update(self, **kwargs):
+        if PRICE_FIELDS & kwargs.keys():
+            # SET expressions read the old row, compute it from the new values
+            kwargs['effective_price'] = effective_price(
+                kwargs.get('discount_price', F('discount_price')), kwargs.get('price', F('price')))
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        for obj in objs:
+            obj.effective_price = obj.get_effective_price()
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if PRICE_FIELDS & set(fields):
+            objs = list(objs)
+            for obj in objs:
+                obj.effective_price = obj.get_effective_price()
+            fields = [*fields, 'effective_price']
+        return super().bulk_update(objs, fields, *args, **kwargs)
+
+    bulk_update.alters_data = True
+
+
 class Book(models.Model):
     title = models.CharField(max_length=100)
     author = models.CharField(max_length=30)
@@ -48,11 +107,16 @@ class Book(models.Model):
     editorial = models.CharField(max_length=30, blank=True)
     edition = models.CharField(max_length=20, blank=True)
     year = models.CharField(max_length=4, blank=True)
-    price = models.FloatField(default=0, blank=True)
-    discount_price = models.FloatField(blank=True, null=True)
+    price = models.DecimalField(default=0, blank=True, **MONEY)
+    discount_price = models.DecimalField(blank=True, null=True, **MONEY)
+    # discount_price or price, so listings can sort and filter by it
+    effective_price = models.DecimalField(default=0, editable=False, **MONEY)
     cover = models.ImageField(upload_to=book_cover_path,
     default="djbooks/static/assets/images/inner-page/category/1.jpg", blank=True)
     back = models.ImageField(upload_to=book_back_path, null=True, blank=True)
+    # Sizes of the resized copies, see djbooks.images
+    cover_variants = models.JSONField(default=dict, blank=True, editable=False)
+    back_variants = models.JSONField(default=dict, blank=True, editable=False)
     description = models.TextField(default=None, null=True, blank=True)
     condition = models.TextField(default=None, null=True, blank=True)
     stock = models.IntegerField(default=1)
@@ -61,10 +125,42 @@ class Book(models.Model):
     related_books = models.ManyToManyField('self', blank=True)
     users_wishlist = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="user_wishlist", blank=True)
 
+    objects = BookQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Sort orders and price facets of the category pages, see CollectionListView
+            models.Index(fields=['effective_price', 'id'], name='book_price_idx'),
+            models.Index(fields=['year', 'id'], name='book_year_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        self.slug = slugify(self.title)
+        # Keep the slug stable once set, urls and upload paths depend on it
+        if not self.slug:
+            taken = Book.objects.filter(
+                slug__startswith=slugify(self.title)
+            ).exclude(pk=self.pk).values_list('slug', flat=True)
+            self.slug = unique_slug(self.title, set(taken))
+        self.effective_price = self.get_effective_price()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and PRICE_FIELDS & set(update_fields):
+            kwargs['update_fields'] = {*update_fields, 'effective_price'}
+        # Read by the signals, open carts only follow price changes
+        self._price_changed = (
+            (update_fields is None or bool(PRICE_FIELDS & set(update_fields)))
+            and self.effective_price != getattr(self, '_saved_effective_price', None))
         super(Book, self).save(*args, **kwargs)
+        self._saved_effective_price = self.effective_price
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        book = super().from_db(db, field_names, values)
+        # None when deferred, saves then count as price changes
+        book._saved_effective_price = book.__dict__.get('effective_price')
+        return book
+
+    def get_effective_price(self):
+        return self.discount_price or self.price
 
     @property
     def cover_url(self):
@@ -76,26 +172,44 @@ class Book(models.Model):
         if self.back and hasattr(self.back, 'url'):
             return self.back.url
 
+    @property
+    def cover_images(self):
+        return ImageVariants(self.cover, self.cover_variants)
+
+    @property
+    def back_images(self):
+        return ImageVariants(self.back, self.back_variants)
+
+    @property
+    def cover_thumbnail_url(self):
+        return self.cover_images.url('thumbnail')
+
+    @property
+    def cover_card_url(self):
+        return self.cover_images.url('card')
+
     def __str__(self):
         return self.title
 
+    @cached_property
+    def main_category(self):
+        # One query for name and slug, none when categories were prefetched
+        if 'category' in getattr(self, '_prefetched_objects_cache', {}):
+            return min(self.category.all(), key=lambda category: category.pk, default=None)
+        return self.category.order_by('pk').first()
+
     def get_category_name(self):
-        return self.category.first().name
-    
+        return self.main_category.name if self.main_category else ''
+
     def get_category_slug(self):
-        return self.category.first().slug
+        return self.main_category.slug if self.main_category else ''
 
     
-    @classmethod
-    # TODO: move outside
-    def get_book_all_categories_count(cls):
-        counts = dict()
-        for cat in Category.objects.all():
-            counts[cat] = cls.objects.filter(category=cat).count()
-        return counts
-    
     def get_related_books(self):
-        return self.related_books.all()
+        # Precomputed by djbooks.recommendations, curated books come first
+        return Book.objects.filter(
+            recommended_in__book=self
+        ).order_by('recommended_in__rank')
 
     def get_price(self) -> str: # TODO: annotate the other methods
         return f"{self.discount_price:,.2f}" if self.discount_price else f"{self.price:,.2f}"
@@ -112,15 +226,56 @@ class Book(models.Model):
     def get_add_to_wishlist(self):
         return reverse("djbooks:add-to-wishlist", kwargs={"slug": self.slug})
 
+class BookTrigram(models.Model):
+    """Trigrams of a book's folded title, author and tags, see djbooks.trigrams"""
+    book = models.ForeignKey(Book, related_name="trigrams", on_delete=models.CASCADE, db_index=False)
+    gram = models.CharField(max_length=3)
+    # Distinct trigrams of the book, repeated so ranking needs no join
+    doc_size = models.PositiveSmallIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'gram'], name='unique_book_trigram'),
+        ]
+        indexes = [
+            models.Index(fields=['gram', 'book'], name='book_trigram_gram_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id}: {self.gram!r}"
+
+
+class BookNeighbor(models.Model):
+    """Top related books of a book, see djbooks.recommendations."""
+    book = models.ForeignKey(Book, related_name="neighbors", on_delete=models.CASCADE)
+    neighbor = models.ForeignKey(Book, related_name="recommended_in", on_delete=models.CASCADE)
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['book', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['book', 'rank'], name='unique_book_neighbor_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.book_id} -> {self.neighbor_id} ({self.score:.3f})"
+
 class ExtraImage(models.Model):
     book = models.ForeignKey(Book, default=None, on_delete=models.CASCADE)
     image = models.FileField(upload_to=upload_with_uuid(path=PATH))
     cover = models.BooleanField(default=False)
     back = models.BooleanField(default=False)
+    variants = models.JSONField(default=dict, blank=True, editable=False)
  
     def __str__(self):
         return self.book.title
 
+    @property
+    def images(self):
+        return ImageVariants(self.image, self.variants)
+
     def save(self, *args, **kwargs):
         if self.cover:
             self.book.cover = self.image
@@ -130,6 +285,9 @@ class ExtraImage(models.Model):
             self.book.save()
         super(ExtraImage, self).save(*args, **kwargs)
 
+# Line price as computed by OrderBook.get_total_item_price, for aggregates
+ORDER_LINE_TOTAL = F('quantity') * F('item__effective_price')
+
 class OrderBook(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     ordered = models.BooleanField(default=False)
@@ -139,15 +297,32 @@ class OrderBook(models.Model):
     def __str__(self):
         return f"{self.quantity} of {self.item.title}"
 
+    def get_unit_price(self):
+        return self.item.get_effective_price()
+
     def get_total_item_price(self):
-        if self.item.discount_price:
-            return self.quantity * self.item.discount_price
-        return self.quantity * self.item.price
+        return self.quantity * self.get_unit_price()
 
     def get_items_final_price(self) -> str: # TODO: annotate the other methods
         return f"{self.get_total_item_price():,.2f}"
 
 
+class StockReservation(models.Model):
+    """
+    Copies of a book held for a cart line, already taken from
+    ``Book.stock``. See ``djbooks.inventory``.
+    """
+    line = models.OneToOneField(OrderBook, related_name="reservation", on_delete=models.CASCADE)
+    book = models.ForeignKey(Book, related_name="reservations", on_delete=models.CASCADE)
+    quantity = models.PositiveIntegerField(default=0)
+    expires_at = models.DateTimeField(db_index=True)
+    # Extensions never keep the copies past STOCK_RESERVATION_MAX_HOLD from here
+    held_since = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.quantity} of {self.book_id} until {self.expires_at}"
+
+
 class Order(models.Model):  
     class ShippingOption(models.TextChoices):
         dhl = 'dhl', _('DHL')
@@ -170,6 +345,22 @@ class Order(models.Model):
         blank=True,
         null=True,
     )
+    # Denormalized from the lines by update_totals
+    subtotal = models.DecimalField(default=0, editable=False, max_digits=12, decimal_places=2)
+    item_count = models.PositiveIntegerField(default=0, editable=False)
+    item_quantity = models.PositiveIntegerField(default=0, editable=False)
+    # Last Mercado Pago preference, reused while the lines don't change
+    preference_id = models.CharField(max_length=100, blank=True, null=True, editable=False)
+    preference_hash = models.CharField(max_length=64, blank=True, editable=False)
+    preference_expires = models.DateTimeField(blank=True, null=True, editable=False)
+    # Lines as paid, see djbooks.orders
+    snapshot = models.JSONField(default=list, blank=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Purchase history, newest first
+            models.Index(fields=['user', 'ordered', 'ordered_date', 'id'], name='order_history_idx'),
+        ]
 
     """
     1. Book added to cart
@@ -184,45 +375,107 @@ class Order(models.Model):
         return f"Compra de {self.user.username}"
 
     def get_total(self):
-        total = 0
-        for order_item in self.items.all():
-            total += order_item.get_total_item_price()
-        return total
+        return self.subtotal
+
+    def get_status(self):
+        if self.received:
+            return "Entregado"
+        if self.being_delivered:
+            return "En camino"
+        if self.paid:
+            return "Pagado"
+        return "En proceso"
+
+    def calculate_totals(self):
+        totals = self.items.aggregate(
+            subtotal=Sum(ORDER_LINE_TOTAL),
+            item_count=Count('id'),
+            item_quantity=Sum('quantity'),
+        )
+        return {
+            'subtotal': totals['subtotal'] or 0,
+            'item_count': totals['item_count'],
+            'item_quantity': totals['item_quantity'] or 0,
+        }
+
+    def update_totals(self):
+        """Recompute the stored totals, called whenever the lines change."""
+        with transaction.atomic():
+            # Lock the row so concurrent line changes update it one at a time
+            list(Order.objects.select_for_update().filter(pk=self.pk).values_list('pk'))
+            totals = self.calculate_totals()
+            Order.objects.filter(pk=self.pk).update(**totals)
+        for field, value in totals.items():
+            setattr(self, field, value)
+
+    def get_preference_lines(self):
+        return [(line.item_id, line.quantity, float(line.get_unit_price())) for line in self.items.all()]
+
+    def get_preference_hash(self, lines=None):
+        """Changes whenever a line, a quantity or a price changes."""
+        lines = sorted(self.get_preference_lines() if lines is None else lines)
+        return hashlib.sha256(json.dumps(lines).encode()).hexdigest()
 
     def get_preference(self):
-        sdk = SDK(str(settings.MERCADO_PAGO_PRIVATE_KEY))
-        
-        if not self.paid:
-            preference_data = {
-                "items": [
-
-                ],
-                "auto_return": "approved",
-                "back_urls": {
-                    "success": "http://localhost:8000/payments/approved",
-                    "failure": "http://localhost:8000/payments/failure",
-                    "pending": "http://localhost:8000/payments/pending"
-                }
-
-            }
-            # TODO: FIX PICTURE 
-            for order_item in self.items.all():
-                preference_data['items'].append({
-                    "id": order_item.item.id,
-                    "title": order_item.item.title,
-                    "description": order_item.item.description,
-                    "quantity": order_item.quantity,
-                    #"picture_url": "https://cdn.shopify.com/s/files/1/1830/5085/products/VE0007_BCAA_Capsule_90ct_2048x2048.png?v=1494855182",
-                    "unit_price": float(order_item.get_total_item_price())
-                })
-            # preference_data['total_amount'] = str(self.get_total())
-            preference_response = sdk.preference().create(preference_data)
-            preference = preference_response["response"]
-            # import json
-            # print("Data: ", json.dumps(preference, indent=4))
-            #print("PREFERENCE: ", json.dumps(preference_response, indent=4))
-            print(f"ID: {preference.get('id')}")
-            return preference.get("id")
+        """
+        Mercado Pago preference id for the current lines. The gateway is
+        only called when the lines changed or the cached one expired.
+        """
+        if self.paid:
+            return None
+        lines = self.get_preference_lines()
+        preference_hash = self.get_preference_hash(lines)
+        now = timezone.now()
+        if (self.preference_id and self.preference_hash == preference_hash
+                and self.preference_expires and self.preference_expires > now):
+            return self.preference_id
+
+        expires = now + timedelta(seconds=settings.MERCADO_PAGO_PREFERENCE_TTL)
+        # Never payable once the copies went back to the stock, they may
+        # be sold again (see djbooks.inventory.release_expired)
+        held_until = StockReservation.objects.filter(line__order=self).aggregate(
+            held_until=Min('expires_at'))['held_until']
+        if held_until is not None:
+            expires = min(expires, held_until)
+        preference_data = {
+            "items": [],
+            "auto_return": "approved",
+            "back_urls": {
+                "success": settings.SITE_URL + reverse("djbooks:purchases"),
+                "failure": settings.SITE_URL + reverse("djbooks:payment"),
+                "pending": settings.SITE_URL + reverse("djbooks:purchases"),
+            },
+            # Payment notifications are matched back to the order with it
+            "external_reference": str(self.pk),
+            "notification_url": settings.SITE_URL + reverse("djbooks:mercadopago-webhook"),
+            # Mercado Pago stops accepting it when our cached copy expires
+            "expires": True,
+            "expiration_date_to": expires.isoformat(timespec='milliseconds'),
+            # Copied to its payments, tells which preference they paid
+            "metadata": {"preference_hash": preference_hash},
+        }
+        # TODO: FIX PICTURE 
+        for order_item in self.items.all():
+            preference_data['items'].append({
+                "id": order_item.item.id,
+                "title": order_item.item.title,
+                "description": order_item.item.description,
+                "quantity": order_item.quantity,
+                "unit_price": float(order_item.get_unit_price())
+            })
+        preference_id = get_gateway(Payment.PaymentMethod.mercado_pago).create_checkout(preference_data)
+        if not preference_id:
+            return None
+
+        fields = {
+            'preference_id': preference_id,
+            'preference_hash': preference_hash,
+            'preference_expires': expires,
+        }
+        Order.objects.filter(pk=self.pk).update(**fields)
+        for field, value in fields.items():
+            setattr(self, field, value)
+        return preference_id
 
 
 ADDRESS_CHOICES = (
@@ -258,9 +511,56 @@ class Payment(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, blank=True, null=True
     )
-    amount = models.FloatField()
+    order = models.ForeignKey(
+        Order, related_name="payments", on_delete=models.SET_NULL, blank=True, null=True
+    )
+    amount = models.DecimalField(**MONEY)
+    status = models.CharField(max_length=30, blank=True)
     timestamp = models.DateTimeField(auto_now_add=True)
     payment_method = models.CharField(max_length=2, choices=PaymentMethod.choices)
 
+    class Meta:
+        constraints = [
+            # Gateways notify the same payment many times
+            models.UniqueConstraint(fields=['payment_method', 'charge_id'], name='unique_payment_charge'),
+        ]
+
     def __str__(self):
-        return f"Pago de {self.user.username} usando {self.payment_method.label}"
\ No newline at end of file
+        return f"Pago de {self.user.username} usando {self.get_payment_method_display()}"
+
+
+class PaymentEvent(models.Model):
+    """
+    Gateway notification waiting to be processed by the
+    ``process_payment_events`` command, the webhook only stores it.
+    """
+    payment_method = models.CharField(max_length=2, choices=Payment.PaymentMethod.choices)
+    topic = models.CharField(max_length=50, blank=True)
+    resource_id = models.CharField(max_length=50, blank=True)
+    payload = models.JSONField(default=dict, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # Failed events wait until then, see djbooks.payments
+    next_attempt_at = models.DateTimeField(blank=True, null=True)
+    error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['processed_at', 'id'], name='payment_event_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.topic} {self.resource_id}"
+
+
+class ReplicationHeartbeat(models.Model):
+    """
+    Single row written on the primary, how old it is on a replica tells
+    how far behind the replica is (see the ``replica_lag`` command).
+    """
+    beat_at = models.DateTimeField()
+
+    @classmethod
+    def beat(cls):
+        return cls.objects.update_or_create(pk=1, defaults={'beat_at': timezone.now()})[0]
@@ -0,0 +1,40 @@
+"""
+Snapshots of paid orders, for the purchase history.
+
+When an order is paid its lines are copied into ``Order.snapshot``
+(title, unit price, quantity, line total and cover thumbnail of every
+book), so the history renders a page of orders from one query and keeps
+showing what was paid after prices change or books are deleted.
+"""
+from decimal import Decimal
+
+from djbooks.images import ImageVariants
+from djbooks.models import Order
+
+
+def line_snapshot(book, quantity):
+    # As strings, JSON floats would round the prices
+    unit_price = Decimal(str(book.discount_price or book.price))
+    return {
+        'book': book.pk,
+        'slug': book.slug,
+        'title': book.title,
+        'unit_price': str(unit_price),
+        'quantity': quantity,
+        'total': str(unit_price * quantity),
+        'thumbnail': ImageVariants(book.cover, book.cover_variants).url('thumbnail'),
+    }
+
+
+def snapshot_orders(pks):
+    """Store the snapshot of the orders ``pks``, returns how many."""
+    pks = list(pks)
+    lines = Order.items.through.objects.filter(order_id__in=pks).select_related(
+        'orderbook__item').order_by('orderbook_id')
+    snapshots = {pk: [] for pk in pks}
+    for row in lines:
+        snapshots[row.order_id].append(line_snapshot(row.orderbook.item, row.orderbook.quantity))
+    Order.objects.bulk_update(
+        [Order(pk=pk, snapshot=snapshot) for pk, snapshot in snapshots.items()],
+        ['snapshot'], batch_size=500)
+    return len(snapshots)
@@ -0,0 +1,148 @@
+"""
+Keyset (cursor) pagination.
+
+Pages are fetched with ``WHERE (key, id) > (last key, last id) ORDER BY
+key, id LIMIT n`` instead of ``OFFSET``, so every page costs the same as
+the first and rows can't shift between pages when books are added. The
+cursor is the sort key of the first/last row of the current page.
+"""
+import base64
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+
+
+# Ids are 64 bit integers, larger ones overflow the database driver
+MAX_INTEGER = 2 ** 63 - 1
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class CursorEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        # DjangoJSONEncoder drops the microseconds, rows in the same
+        # millisecond would be skipped
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values, cls=CursorEncoder).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidCursor(cursor)
+
+
+class KeysetPage:
+
+    def __init__(self, object_list, has_next, has_previous, next_cursor, previous_cursor, count=None):
+        self.object_list = object_list
+        self.has_next = has_next
+        self.has_previous = has_previous
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+        # May be approximate, see CollectionListView.count_mode
+        self.count = count
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator:
+    """
+    ``fields`` are the ordering, e.g. ``('-effective_price', '-id')``, and
+    must end with a unique field. All of them share the same direction.
+    """
+
+    def __init__(self, queryset, fields, per_page):
+        self.queryset = queryset
+        self.fields = fields
+        self.per_page = per_page
+        self.names = [field.lstrip('-') for field in fields]
+        self.descending = fields[0].startswith('-')
+
+    def key_field(self, name):
+        annotation = self.queryset.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return self.queryset.model._meta.get_field(name)
+
+    def cursor_values(self, cursor):
+        """
+        The sort key of ``cursor`` as values of their fields. Cursors come
+        from the query string, anything else than what ``cursor()`` made
+        is an ``InvalidCursor``, not an error of the query.
+        """
+        values = decode_cursor(cursor)
+        if not isinstance(values, list) or len(values) != len(self.names):
+            raise InvalidCursor(cursor)
+        try:
+            values = [self.key_field(name).clean(value, None) for name, value in zip(self.names, values)]
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(cursor)
+        # clean() doesn't check the range of ids
+        for value in values:
+            if value is None or isinstance(value, int) and abs(value) > MAX_INTEGER:
+                raise InvalidCursor(cursor)
+        return values
+
+    def reversed_fields(self):
+        return [name if self.descending else '-' + name for name in self.names]
+
+    def after(self, values, descending):
+        """Rows strictly after ``values`` going in the given direction."""
+        condition = Q()
+        for index, name in enumerate(self.names):
+            lookup = 'lt' if descending else 'gt'
+            step = Q(**{f'{name}__{lookup}': values[index]})
+            for previous, value in zip(self.names[:index], values):
+                step &= Q(**{previous: value})
+            condition |= step
+        return condition
+
+    def page(self, after=None, before=None, count=None):
+        queryset = self.queryset
+        backwards = before is not None and after is None
+        cursor = before if backwards else after
+        if cursor is not None:
+            values = self.cursor_values(cursor)
+            queryset = queryset.filter(self.after(values, self.descending != backwards))
+        queryset = queryset.order_by(*(self.reversed_fields() if backwards else self.fields))
+        # The keys are read back from their own columns, so they can be
+        # alias() expressions, which keep ORDER BY matching an expression index
+        queryset = queryset.annotate(**{
+            f'keyset_{index}': F(name) for index, name in enumerate(self.names)})
+
+        # One extra row tells if there is a page further on
+        rows = list(queryset[:self.per_page + 1])
+        more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if backwards:
+            rows.reverse()
+        has_next = more if not backwards else True
+        has_previous = more if backwards else cursor is not None
+        return KeysetPage(
+            rows,
+            has_next=bool(rows) and has_next,
+            has_previous=bool(rows) and has_previous,
+            next_cursor=self.cursor(rows[-1]) if rows else None,
+            previous_cursor=self.cursor(rows[0]) if rows else None,
+            count=count,
+        )
+
+    def cursor(self, row):
+        return encode_cursor([getattr(row, f'keyset_{index}') for index in range(len(self.names))])
@@ -0,0 +1,192 @@
+"""
+Mercado Pago notifications.
+
+The webhook only appends a ``PaymentEvent`` so it answers right away,
+``process_payment_events`` later drains the queue in batches. Payments
+are always fetched from the gateway, the notification body is not
+trusted, and every step is idempotent so repeated or replayed
+notifications are harmless.
+
+An approved payment only pays its order when it paid the order's
+current preference and its whole subtotal. Every preference of an
+order carries the same ``external_reference``, an older (cheaper) one
+may still be payable. Payments don't say which preference they paid,
+but Mercado Pago copies the preference's ``metadata`` to them, and
+``Order.get_preference`` puts the hash of the lines there. Payments
+that don't match are recorded, and the error is left on their events
+for staff to look at.
+
+Events whose payment can't be fetched are retried later, waiting twice
+as long after each failure, so a gateway outage doesn't use up their
+``MAX_ATTEMPTS`` in a few seconds.
+"""
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db.models import F, Q
+from django.utils import timezone
+
+from djbooks.cart import invalidate_cart_summaries
+from djbooks.gateway import get_gateway
+from djbooks.inventory import confirm_orders
+from djbooks.orders import snapshot_orders
+from djbooks.models import Order, OrderBook, Payment, PaymentEvent
+from djbooks.transactions import write_atomic
+
+
+EVENT_BATCH_SIZE = 200
+FETCH_WORKERS = 8
+# Events failing this many times stay in the table for inspection
+MAX_ATTEMPTS = 5
+# Seconds before retrying a failed event, doubled after each attempt
+RETRY_DELAY = 60
+PAID_STATUSES = ('approved',)
+CENT = Decimal('0.01')
+
+
+def record_mercadopago_event(params, body):
+    """
+    Queue a notification. Mercado Pago sends the ids in the query string
+    (``?topic=payment&id=1``) or in the JSON body (``{"type": "payment",
+    "data": {"id": "1"}}``) depending on the notification kind.
+    """
+    data = body.get('data') if isinstance(body.get('data'), dict) else {}
+    topic = params.get('topic') or params.get('type') or body.get('type') or body.get('topic') or ''
+    resource_id = params.get('data.id') or params.get('id') or data.get('id') or ''
+    return PaymentEvent.objects.create(
+        payment_method=Payment.PaymentMethod.mercado_pago,
+        topic=str(topic)[:50],
+        resource_id=str(resource_id)[:50],
+        payload=body,
+    )
+
+
+def order_reference(payment):
+    reference = str(payment.get('external_reference') or '')
+    return int(reference) if reference.isdigit() else None
+
+
+def payment_amount(payment):
+    # Through str, the float 187.44 isn't Decimal('187.44'). Gateways
+    # summing floats send 30.299999999999997 for 3 x 10.10.
+    amount = Decimal(str(payment.get('transaction_amount') or 0))
+    return amount.quantize(CENT) if amount.is_finite() else amount
+
+
+def payment_preference_hash(payment):
+    metadata = payment.get('metadata')
+    return metadata.get('preference_hash') if isinstance(metadata, dict) else None
+
+
+def payment_mismatch(payment, order):
+    """Why ``payment`` doesn't pay ``order``, None when it does."""
+    if not order.preference_hash or payment_preference_hash(payment) != order.preference_hash:
+        return 'paid an older preference of the order'
+    if payment_amount(payment) != order.subtotal.quantize(CENT):
+        return f'paid {payment_amount(payment)}, the order is {order.subtotal}'
+    return None
+
+
+def retry_at(now, attempts):
+    """When to retry an event that failed ``attempts`` times."""
+    return now + timedelta(seconds=RETRY_DELAY * 2 ** (attempts - 1))
+
+
+def pending_events(batch_size=EVENT_BATCH_SIZE, max_attempts=MAX_ATTEMPTS, now=None):
+    return list(PaymentEvent.objects.filter(
+        Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now or timezone.now()),
+        processed_at__isnull=True, attempts__lt=max_attempts,
+    ).order_by('id')[:batch_size])
+
+
+def process_payment_events(batch_size=EVENT_BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+    """
+    Process one batch of queued events. Returns ``(events, payments)``,
+    how many events were handled and how many payments were recorded.
+    """
+    events = pending_events(batch_size, max_attempts)
+    if not events:
+        return 0, 0
+
+    # The same payment is usually notified several times
+    by_payment = {}
+    for event in events:
+        if event.topic == 'payment' and event.resource_id:
+            by_payment.setdefault(event.resource_id, []).append(event)
+
+    fetched, errors = {}, {}
+    gateway = get_gateway(Payment.PaymentMethod.mercado_pago)
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as pool:
+        futures = {payment_id: pool.submit(gateway.fetch_payment, payment_id) for payment_id in by_payment}
+    for payment_id, future in futures.items():
+        try:
+            fetched[payment_id] = future.result()
+        except Exception as error:
+            errors[payment_id] = str(error)
+
+    orders = Order.objects.in_bulk({order_reference(payment) for payment in fetched.values()} - {None})
+    payments = []
+    paid = set()
+    mismatches = {}
+    for payment_id, payment in fetched.items():
+        order = orders.get(order_reference(payment))
+        payments.append(Payment(
+            charge_id=payment_id,
+            user_id=order.user_id if order else None,
+            order=order,
+            amount=payment_amount(payment),
+            status=payment.get('status') or '',
+            payment_method=Payment.PaymentMethod.mercado_pago,
+        ))
+        if order and payment.get('status') in PAID_STATUSES:
+            mismatch = payment_mismatch(payment, order)
+            if mismatch:
+                mismatches[payment_id] = mismatch
+            else:
+                paid.add(order.pk)
+
+    now = timezone.now()
+    failed = {event.pk for payment_id in errors for event in by_payment[payment_id]}
+    # Reads the known payments before writing, see djbooks.transactions
+    with write_atomic():
+        known = set(Payment.objects.filter(
+            payment_method=Payment.PaymentMethod.mercado_pago, charge_id__in=fetched,
+        ).values_list('charge_id', flat=True))
+        # ignore_conflicts covers another worker inserting the same payment
+        Payment.objects.bulk_create(
+            [payment for payment in payments if payment.charge_id not in known],
+            ignore_conflicts=True,
+        )
+        # Known payments only change status (e.g. pending -> approved)
+        for status in {payment.status for payment in payments if payment.charge_id in known}:
+            Payment.objects.filter(
+                payment_method=Payment.PaymentMethod.mercado_pago,
+                charge_id__in=[p.charge_id for p in payments if p.charge_id in known and p.status == status],
+            ).update(status=status)
+        if paid:
+            # Lines as paid for the purchase history, once per order
+            completed = list(Order.objects.filter(pk__in=paid, paid=False).values_list('pk', flat=True))
+            snapshot_orders(completed)
+            Order.objects.filter(pk__in=completed, paid=False).update(paid=True, ordered=True, ordered_date=now)
+            OrderBook.objects.filter(order__in=paid).update(ordered=True)
+            confirm_orders(paid)
+        PaymentEvent.objects.filter(pk__in=[e.pk for e in events if e.pk not in failed]).update(
+            processed_at=now, attempts=F('attempts') + 1, error='')
+        for payment_id, mismatch in mismatches.items():
+            PaymentEvent.objects.filter(pk__in=[e.pk for e in by_payment[payment_id]]).update(
+                error=mismatch)
+        # Failed events of a payment may have failed a different number of times
+        retries = defaultdict(list)
+        for payment_id, error in errors.items():
+            for event in by_payment[payment_id]:
+                retries[error, event.attempts + 1].append(event.pk)
+        for (error, attempts), pks in retries.items():
+            PaymentEvent.objects.filter(pk__in=pks).update(
+                attempts=attempts, error=error, next_attempt_at=retry_at(now, attempts))
+
+    if paid:
+        # Their cart is now an order, the header badge must go back to zero
+        invalidate_cart_summaries({orders[pk].user_id for pk in paid})
+    return len(events) - len(failed), len(payments) - len(known)
@@ -0,0 +1,144 @@
+"""
+Item-item recommendations from purchases and wishlists.
+
+Every user is a sparse vector of the books they bought or wished for and
+two books are as similar as the cosine of their columns. Only the top
+``TOP_K`` neighbours of each book are kept in ``BookNeighbor`` so
+``Book.get_related_books`` is a single indexed lookup.
+"""
+import math
+from collections import defaultdict
+from heapq import nlargest
+
+from django.db import transaction
+from django.db.models import Q
+
+from djbooks.models import Book, BookNeighbor, OrderBook
+
+
+PURCHASE_WEIGHT = 1.0
+WISHLIST_WEIGHT = 0.5
+TOP_K = 12
+# Caps the pairs generated by a single very active user
+MAX_BASKET = 200
+# Curated related books rank above any computed similarity (at most 1)
+CURATED_SCORE = 2.0
+BATCH_SIZE = 5000
+
+
+def load_baskets(users=None, books=None):
+    """
+    ``{user_id: {book_id: weight}}`` from completed orders and wishlists,
+    optionally restricted to some users or some books.
+    """
+    purchases = OrderBook.objects.filter(order__ordered=True)
+    wishes = Book.users_wishlist.through.objects.all()
+    if users is not None:
+        purchases = purchases.filter(user__in=users)
+        wishes = wishes.filter(user__in=users)
+    if books is not None:
+        purchases = purchases.filter(item__in=books)
+        wishes = wishes.filter(book__in=books)
+
+    baskets = defaultdict(dict)
+    for user_id, book_id in wishes.values_list('user_id', 'book_id').iterator(chunk_size=BATCH_SIZE):
+        baskets[user_id][book_id] = WISHLIST_WEIGHT
+    # A purchase outweighs a wish for the same book
+    for user_id, book_id in purchases.values_list('user_id', 'item_id').iterator(chunk_size=BATCH_SIZE):
+        baskets[user_id][book_id] = PURCHASE_WEIGHT
+    return baskets
+
+
+def column_norms(baskets):
+    norms = defaultdict(float)
+    for items in baskets.values():
+        for book_id, weight in items.items():
+            norms[book_id] += weight * weight
+    return norms
+
+
+def co_occurrences(baskets, targets=None):
+    """Dot products between book columns, only rows in ``targets`` if given."""
+    dots = defaultdict(lambda: defaultdict(float))
+    for items in baskets.values():
+        if len(items) > MAX_BASKET:
+            items = dict(nlargest(MAX_BASKET, items.items(), key=lambda item: item[1]))
+        for book_id, weight in items.items():
+            if targets is not None and book_id not in targets:
+                continue
+            row = dots[book_id]
+            for other_id, other_weight in items.items():
+                if other_id != book_id:
+                    row[other_id] += weight * other_weight
+    return dots
+
+
+def compute_neighbors(targets=None):
+    """
+    ``{book_id: [(neighbor_id, score), ...]}`` for ``targets``, or for
+    every book that has interactions when ``targets`` is None.
+    """
+    if targets is None:
+        baskets = load_baskets()
+        norms = column_norms(baskets)
+    else:
+        targets = set(targets)
+        # Only the users who touched the targets contribute to their rows
+        users = {user_id for user_id in load_baskets(books=targets)}
+        baskets = load_baskets(users=users)
+        candidates = {book_id for items in baskets.values() for book_id in items}
+        # Norms need every interaction of the candidates, not just these users
+        norms = column_norms(load_baskets(books=candidates))
+
+    neighbors = {}
+    for book_id, row in co_occurrences(baskets, targets).items():
+        scores = (
+            (other_id, dot / math.sqrt(norms[book_id] * norms[other_id]))
+            for other_id, dot in row.items()
+        )
+        neighbors[book_id] = nlargest(TOP_K, scores, key=lambda item: item[1])
+    return neighbors
+
+
+def curated_neighbors(books=None):
+    Through = Book.related_books.through
+    pairs = Through.objects.all()
+    if books is not None:
+        pairs = pairs.filter(from_book__in=books)
+    curated = defaultdict(list)
+    for book_id, related_id in pairs.values_list('from_book_id', 'to_book_id').order_by('pk'):
+        curated[book_id].append(related_id)
+    return curated
+
+
+def refresh_recommendations(books=None):
+    """
+    Recompute and store the neighbours of ``books`` (ids), or of the whole
+    catalog when None. Returns how many books got neighbours.
+    """
+    computed = compute_neighbors(books)
+    curated = curated_neighbors(books)
+
+    rows = []
+    for book_id in set(computed) | set(curated):
+        ranked = [(related_id, CURATED_SCORE) for related_id in curated.get(book_id, [])]
+        seen = {related_id for related_id, _ in ranked}
+        ranked += [item for item in computed.get(book_id, []) if item[0] not in seen]
+        rows += [
+            BookNeighbor(book_id=book_id, neighbor_id=neighbor_id, rank=rank, score=score)
+            for rank, (neighbor_id, score) in enumerate(ranked[:TOP_K])
+        ]
+
+    with transaction.atomic():
+        stale = BookNeighbor.objects.all()
+        if books is not None:
+            stale = stale.filter(book__in=books)
+        stale.delete()
+        BookNeighbor.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return len({row.book_id for row in rows})
+
+
+def books_ordered_since(since):
+    return set(OrderBook.objects.filter(
+        Q(order__ordered=True) & Q(order__ordered_date__gte=since)
+    ).values_list('item_id', flat=True))
@@ -0,0 +1,131 @@
+"""
+Catalog reads on read replicas, everything else on the primary.
+
+``ReplicaRouter`` sends reads of the catalog models (books, categories,
+images, tags and the search tables) to one of ``DATABASE_REPLICAS``
+while a request is being served. Carts, orders, payments, sessions and
+auth always use ``default``, and so does everything outside requests
+(management commands, payment workers), which often read right after
+writing.
+
+Replicas lag behind, so reads go back to the primary:
+
+* inside a transaction on the primary,
+* in POST (and other unsafe) requests, which check stock and prices
+  before changing them,
+* for the rest of a request once it wrote anything,
+* for ``REPLICA_PIN_SECONDS`` after a user's request wrote, through a
+  cookie set by ``replica_pin_middleware``, so a user sees the stock
+  and the books they just changed.
+
+Raw SQL reading the catalog picks its connection with
+``router.db_for_read`` too (see djbooks.search and djbooks.trigrams).
+"""
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.utils.decorators import sync_and_async_middleware
+
+
+PIN_COOKIE = 'djbooks_primary'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+CATALOG_MODELS = {
+    'djbooks.book',
+    'djbooks.book_category',
+    'djbooks.book_related_books',
+    'djbooks.category',
+    'djbooks.extraimage',
+    'djbooks.bookneighbor',
+    'djbooks.booktrigram',
+    'taggit.tag',
+    'taggit.taggeditem',
+}
+
+# Writes that don't pin, every request with a session may save it
+UNPINNED_WRITES = {'sessions.session'}
+
+
+class RequestState:
+    # Mutable so writes made in sync_to_async threads, which run with a
+    # copy of the context, are seen by the middleware
+    def __init__(self, pinned):
+        self.pinned = pinned
+        self.wrote = False
+
+
+request_state = ContextVar('replica_request_state', default=None)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = request_state.get()
+        if (state is None or state.pinned or state.wrote or not replicas()
+                or model._meta.label_lower not in CATALOG_MODELS
+                or connections['default'].in_atomic_block):
+            return 'default'
+        return random.choice(replicas())
+
+    def db_for_write(self, model, **hints):
+        state = request_state.get()
+        if state is not None and model._meta.label_lower not in UNPINNED_WRITES:
+            state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the primary, never migrated themselves
+        return db not in replicas()
+
+
+def is_pinned(request):
+    if request.method not in SAFE_METHODS:
+        return True
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def finish(state, response):
+    if state.wrote:
+        seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+        response.set_cookie(PIN_COOKIE, str(time.time() + seconds), max_age=seconds,
+                            httponly=True, samesite='Lax')
+    return response
+
+
+@sync_and_async_middleware
+def replica_pin_middleware(get_response):
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            state = RequestState(is_pinned(request))
+            token = request_state.set(state)
+            try:
+                response = await get_response(request)
+            finally:
+                request_state.reset(token)
+            return finish(state, response)
+    else:
+        def middleware(request):
+            state = RequestState(is_pinned(request))
+            token = request_state.set(state)
+            try:
+                response = get_response(request)
+            finally:
+                request_state.reset(token)
+            return finish(state, response)
+    return middleware
@@ -0,0 +1,266 @@
+import re
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, connections, router
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+
+FTS_TABLE = "djbooks_book_fts"
+
+# bm25 weights, in the same order as the indexed columns:
+# title, author, editorial, description, tags
+FTS_WEIGHTS = (10.0, 6.0, 2.0, 1.0, 4.0)
+
+FTS_CREATE_SQL = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+    title, author, editorial, description, tags,
+    tokenize = 'unicode61 remove_diacritics 2'
+)
+"""
+
+# Tags are joined through the content type by natural key, its id isn't
+# known up front.
+FTS_POPULATE_SQL = f"""
+INSERT INTO {FTS_TABLE} (rowid, title, author, editorial, description, tags)
+SELECT b.id, b.title, b.author, b.editorial, COALESCE(b.description, ''),
+    COALESCE((
+        SELECT group_concat(t.name, ' ')
+        FROM taggit_taggeditem ti
+        JOIN taggit_tag t ON t.id = ti.tag_id
+        JOIN django_content_type ct ON ct.id = ti.content_type_id
+        WHERE ti.object_id = b.id
+            AND ct.app_label = 'djbooks' AND ct.model = 'book'
+    ), '')
+FROM djbooks_book b
+"""
+
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(query):
+    return TOKEN_RE.findall(query.lower())
+
+
+class SearchResults:
+    """
+    Lazy result set for a search query.
+
+    Only the requested slice is fetched, so it can be handed straight to a
+    ``Paginator``: it asks for ``count()`` once and then for one page.
+    """
+
+    def __init__(self, backend, query):
+        self.backend = backend
+        self.query = query
+        self._count = None
+
+    def count(self):
+        if self._count is None:
+            self._count = self.backend.count(self.query)
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start = key.start or 0
+            stop = key.stop if key.stop is not None else self.count()
+            return self.backend.fetch(self.query, start, stop)
+        return self.backend.fetch(self.query, key, key + 1)[0]
+
+
+class BaseSearchBackend:
+
+    def search(self, query):
+        return SearchResults(self, query)
+
+    def count(self, query):
+        raise NotImplementedError
+
+    def fetch(self, query, start, stop):
+        raise NotImplementedError
+
+    # Index maintenance hooks, no-ops for backends reading the tables directly
+    def index_book(self, book):
+        pass
+
+    def index_books(self, pks):
+        pass
+
+    def remove_book(self, pk):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class DatabaseSearchBackend(BaseSearchBackend):
+    """Portable fallback: every term must match some field, no ranking."""
+
+    def get_queryset(self, query):
+        from djbooks.models import Book
+
+        terms = tokenize(query)
+        if not terms:
+            return Book.objects.none()
+        condition = Q()
+        for term in terms:
+            condition &= (
+                Q(title__icontains=term) |
+                Q(author__icontains=term) |
+                Q(editorial__icontains=term) |
+                Q(description__icontains=term) |
+                Q(tags__name__iexact=term)
+            )
+        return Book.objects.filter(condition).distinct().order_by('title', 'id')
+
+    def count(self, query):
+        return self.get_queryset(query).count()
+
+    def fetch(self, query, start, stop):
+        return list(self.get_queryset(query)[start:stop])
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """
+    Search backed by an SQLite FTS5 table (created by migration 0003).
+
+    Each term is matched as a prefix and all terms are required, results
+    are ranked with bm25 giving more weight to title and author.
+    """
+
+    def match_expression(self, query):
+        # Quoting every token keeps FTS5 operators typed by users inert
+        return " ".join(f'"{term}"*' for term in tokenize(query))
+
+    def reader(self):
+        # The FTS table follows the books, possibly on a replica
+        from djbooks.models import Book
+
+        return connections[router.db_for_read(Book)]
+
+    def count(self, query):
+        expression = self.match_expression(query)
+        if not expression:
+            return 0
+        with self.reader().cursor() as cursor:
+            cursor.execute(
+                f"SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s",
+                [expression],
+            )
+            return cursor.fetchone()[0]
+
+    def fetch(self, query, start, stop):
+        from djbooks.models import Book
+
+        expression = self.match_expression(query)
+        if not expression or stop <= start:
+            return []
+        weights = ", ".join(str(w) for w in FTS_WEIGHTS)
+        with self.reader().cursor() as cursor:
+            cursor.execute(
+                f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+                f"ORDER BY bm25({FTS_TABLE}, {weights}) LIMIT %s OFFSET %s",
+                [expression, stop - start, start],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+        books = Book.objects.in_bulk(ids)
+        return [books[pk] for pk in ids if pk in books]
+
+    def index_book(self, book):
+        tags = " ".join(book.tags.names())
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [book.pk])
+            cursor.execute(
+                f"INSERT INTO {FTS_TABLE} "
+                "(rowid, title, author, editorial, description, tags) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                [book.pk, book.title, book.author, book.editorial,
+                 book.description or "", tags],
+            )
+
+    def index_books(self, pks):
+        """Index many books at once, used by bulk loaders that skip signals."""
+        pks = list(pks)
+        if not pks:
+            return
+        placeholders = ", ".join(["%s"] * len(pks))
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({placeholders})", pks)
+            cursor.execute(f"{FTS_POPULATE_SQL} WHERE b.id IN ({placeholders})", pks)
+
+    def remove_book(self, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [pk])
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(FTS_CREATE_SQL)
+            cursor.execute(f"DELETE FROM {FTS_TABLE}")
+            cursor.execute(FTS_POPULATE_SQL)
+
+
+class FuzzySearchBackend(BaseSearchBackend):
+    """
+    Typo tolerant lookups over the trigram index (djbooks.trigrams),
+    used when the main backend finds nothing. Only the best
+    ``FUZZY_LIMIT`` books are kept, ranked by similarity.
+    """
+
+    def __init__(self):
+        self.matches = {}
+
+    def get_ids(self, query):
+        from djbooks.trigrams import fuzzy_search
+
+        if query not in self.matches:
+            self.matches[query] = [pk for pk, _ in fuzzy_search(query)]
+        return self.matches[query]
+
+    def count(self, query):
+        return len(self.get_ids(query))
+
+    def fetch(self, query, start, stop):
+        from djbooks.models import Book
+
+        ids = self.get_ids(query)[start:stop]
+        books = Book.objects.in_bulk(ids)
+        return [books[pk] for pk in ids if pk in books]
+
+    def index_book(self, book):
+        self.index_books([book.pk])
+
+    def index_books(self, pks):
+        from djbooks.trigrams import index_books
+
+        index_books(pks)
+
+    def remove_book(self, pk):
+        # Rows go with the book (on_delete=CASCADE)
+        pass
+
+    def rebuild(self):
+        from djbooks.trigrams import index_books
+
+        index_books()
+
+
+@lru_cache(maxsize=None)
+def get_search_backend():
+    path = getattr(settings, "SEARCH_BACKEND", None)
+    if path is None:
+        if connection.vendor == "sqlite":
+            return SQLiteFTSBackend()
+        return DatabaseSearchBackend()
+    return import_string(path)()
+
+
+def search_books(query):
+    results = get_search_backend().search(query)
+    if results.count() == 0:
+        # Nothing matched as typed, try again allowing for typos
+        return FuzzySearchBackend().search(query)
+    return results
@@ -0,0 +1,274 @@
+from PIL import UnidentifiedImageError
+
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from djbooks import autocomplete
+from djbooks.cart import invalidate_cart_summaries
+from djbooks.catalog_cache import bump_book_version, bump_catalog_version
+from djbooks.images import build_variants, needs_variants
+from djbooks.middleware import record_query
+from djbooks.recommendations import refresh_recommendations
+from djbooks.models import ORDER_LINE_TOTAL, Book, Category, ExtraImage, Order, OrderBook
+from djbooks.search import FuzzySearchBackend, get_search_backend
+
+
+# SQLite
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    # WAL lets readers go on while a writer commits, stock updates
+    # then only wait for each other
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Feeds the query recorders of djbooks.middleware, a no-op when none
+    # is active. The wrapper list outlives reconnections
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+# Search index
+
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    get_search_backend().index_book(instance)
+    FuzzySearchBackend().index_book(instance)
+
+
+@receiver(post_delete, sender=Book)
+def unindex_book(sender, instance, **kwargs):
+    get_search_backend().remove_book(instance.pk)
+
+
+@receiver(m2m_changed, sender=Book.tags.through)
+def reindex_book_tags(sender, instance, action, reverse, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if isinstance(instance, Book):
+        get_search_backend().index_book(instance)
+        FuzzySearchBackend().index_book(instance)
+
+
+# Autocomplete, no-ops while this process has no index
+
+@receiver(post_save, sender=Book)
+def update_autocomplete(sender, instance, raw=False, **kwargs):
+    if not raw:
+        autocomplete.update_book(instance)
+
+
+@receiver(post_delete, sender=Book)
+def remove_from_autocomplete(sender, instance, **kwargs):
+    autocomplete.remove_book(instance.pk)
+
+
+@receiver(m2m_changed, sender=Book.tags.through)
+def update_autocomplete_tags(sender, instance, action, **kwargs):
+    if action in ("post_add", "post_remove", "post_clear") and isinstance(instance, Book):
+        autocomplete.update_book(instance)
+
+
+# Category book counts
+
+@receiver(m2m_changed, sender=Book.category.through)
+def update_category_counts(sender, instance, action, reverse, pk_set, **kwargs):
+    # pk_set of a remove is what was asked for, not what was attached,
+    # only the existing rows are counted before they go
+    if reverse:
+        # category.book_set.add(...), instance is the Category
+        categories = Category.objects.filter(pk=instance.pk)
+        if action == "pre_remove":
+            instance._removed_books = sender.objects.filter(
+                category_id=instance.pk, book_id__in=pk_set).count()
+        elif action == "post_add":
+            categories.update(book_count=F("book_count") + len(pk_set))
+        elif action == "post_remove":
+            categories.update(book_count=F("book_count") - getattr(instance, "_removed_books", 0))
+        elif action == "post_clear":
+            categories.update(book_count=0)
+        return
+
+    if action == "pre_clear":
+        instance._cleared_categories = list(
+            instance.category.values_list("pk", flat=True))
+    elif action == "pre_remove":
+        instance._removed_categories = list(sender.objects.filter(
+            book_id=instance.pk, category_id__in=pk_set).values_list("category_id", flat=True))
+    elif action == "post_clear":
+        pk_set = getattr(instance, "_cleared_categories", [])
+        Category.objects.filter(pk__in=pk_set).update(book_count=F("book_count") - 1)
+    elif action == "post_add":
+        Category.objects.filter(pk__in=pk_set).update(book_count=F("book_count") + 1)
+    elif action == "post_remove":
+        pk_set = getattr(instance, "_removed_categories", [])
+        Category.objects.filter(pk__in=pk_set).update(book_count=F("book_count") - 1)
+
+
+@receiver(pre_delete, sender=Book)
+def release_category_counts(sender, instance, **kwargs):
+    # The through rows are removed by the cascade without m2m signals
+    Category.objects.filter(book=instance).update(book_count=F("book_count") - 1)
+
+
+# Order totals
+
+def refresh_order_totals(orders):
+    users = set()
+    for order in orders:
+        order.update_totals()
+        users.add(order.user_id)
+    # The header shows the stored totals through the cart summary cache,
+    # dropped after the commit so nobody caches the old ones again
+    transaction.on_commit(lambda: invalidate_cart_summaries(users))
+
+
+@receiver(m2m_changed, sender=Order.items.through)
+def update_order_totals(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action in ("post_add", "post_remove", "post_clear"):
+            refresh_order_totals([instance])
+        return
+
+    # order_book.order_set.add(...), instance is the OrderBook
+    if action == "pre_clear":
+        instance._cleared_orders = list(instance.order_set.values_list("pk", flat=True))
+    elif action == "post_clear":
+        pk_set = getattr(instance, "_cleared_orders", [])
+    if action in ("post_add", "post_remove", "post_clear"):
+        refresh_order_totals(Order.objects.filter(pk__in=pk_set))
+
+
+@receiver(post_save, sender=OrderBook)
+def update_line_order_totals(sender, instance, created, raw=False, **kwargs):
+    # New lines aren't in any order yet, adding them fires m2m_changed
+    if raw or created:
+        return
+    refresh_order_totals(instance.order_set.all())
+
+
+@receiver(pre_delete, sender=OrderBook)
+def remember_line_orders(sender, instance, **kwargs):
+    instance._order_ids = list(instance.order_set.values_list("pk", flat=True))
+
+
+@receiver(post_delete, sender=OrderBook)
+def update_deleted_line_order_totals(sender, instance, **kwargs):
+    refresh_order_totals(Order.objects.filter(pk__in=getattr(instance, "_order_ids", [])))
+
+
+@receiver(post_save, sender=Book)
+def update_open_order_totals(sender, instance, created, raw=False, **kwargs):
+    # Open carts follow the book price, closed orders keep what was paid
+    if raw or created or not getattr(instance, "_price_changed", True):
+        return
+    orders = Order.objects.filter(ordered=False, items__item=instance)
+    users = set(orders.values_list("user_id", flat=True))
+    if not users:
+        return
+    # Only the subtotal depends on the price, one UPDATE for every cart
+    # however popular the book
+    lines = OrderBook.objects.filter(order=OuterRef("pk")).order_by().values("order")
+    orders.update(subtotal=Coalesce(
+        Subquery(lines.annotate(total=Sum(ORDER_LINE_TOTAL)).values("total")),
+        Value(0), output_field=Order._meta.get_field("subtotal")))
+    transaction.on_commit(lambda: invalidate_cart_summaries(users))
+
+
+# Image variants
+
+@receiver(post_save, sender=Book)
+def build_book_variants(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    default = Book._meta.get_field("cover").default
+    changes = {}
+    for field in ("cover", "back"):
+        file = getattr(instance, field)
+        variants = getattr(instance, f"{field}_variants")
+        if needs_variants(file, variants, default):
+            try:
+                changes[f"{field}_variants"] = build_variants(file)
+            except (OSError, UnidentifiedImageError):
+                continue
+    if changes:
+        # update() so saving the sizes doesn't run the save signals again
+        Book.objects.filter(pk=instance.pk).update(**changes)
+        for field, value in changes.items():
+            setattr(instance, field, value)
+
+
+@receiver(post_save, sender=ExtraImage)
+def build_extra_image_variants(sender, instance, raw=False, **kwargs):
+    if raw or not needs_variants(instance.image, instance.variants):
+        return
+    try:
+        instance.variants = build_variants(instance.image)
+    except (OSError, UnidentifiedImageError):
+        return
+    ExtraImage.objects.filter(pk=instance.pk).update(variants=instance.variants)
+
+
+# Fragment cache versions
+# Bumped once the transaction commits, a page rendered before that would
+# cache the old rows under the new version
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def bump_book_fragments(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    pk = instance.pk
+    transaction.on_commit(lambda: (bump_book_version(pk), bump_catalog_version()))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def bump_category_fragments(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(post_save, sender=ExtraImage)
+@receiver(post_delete, sender=ExtraImage)
+def bump_extra_image_fragments(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    book_id = instance.book_id
+    transaction.on_commit(lambda: bump_book_version(book_id))
+
+
+@receiver(m2m_changed, sender=Book.tags.through)
+@receiver(m2m_changed, sender=Book.category.through)
+@receiver(m2m_changed, sender=Book.related_books.through)
+def bump_book_relation_fragments(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    pks = []
+    if isinstance(instance, Book):
+        pks.append(instance.pk)
+        if sender is Book.related_books.through:
+            # The relation is symmetrical, the other books show it too
+            pks.extend(pk_set or ())
+    transaction.on_commit(lambda: (bump_book_version(*pks), bump_catalog_version()))
+
+
+# Related books
+
+@receiver(m2m_changed, sender=Book.related_books.through)
+def refresh_curated_neighbors(sender, instance, action, pk_set, **kwargs):
+    # Curated relations are stored with the computed ones, see get_related_books
+    if action in ("post_add", "post_remove", "post_clear"):
+        refresh_recommendations([instance.pk, *(pk_set or ())])
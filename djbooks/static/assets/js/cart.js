@@ -0,0 +1,31 @@
+// Add to cart without leaving the page, links keep their href as fallback
+(function($) {
+    "use strict";
+    function getCookie(name) {
+        var match = document.cookie.match('(^|;)\\s*' + name + '=([^;]*)');
+        return match ? decodeURIComponent(match[2]) : null;
+    }
+    $(document).on('click', '.js-add-to-cart', function (e) {
+        var link = $(this);
+        var api = link.attr('data-cart-api');
+        if (!api) {
+            return;
+        }
+        e.preventDefault();
+        $.ajax({
+            url: api,
+            method: 'POST',
+            headers: {'X-CSRFToken': getCookie('csrftoken')},
+        }).done(function (data) {
+            var count = data.cart.item_count;
+            $('.cart-count').text(count).css('display', count ? 'inline' : 'none');
+            link.attr('title', 'En el carrito (' + data.line.quantity + ')');
+        }).fail(function (xhr) {
+            if (xhr.status === 401) {
+                window.location = link.attr('href');
+            } else if (xhr.responseJSON && xhr.responseJSON.error) {
+                alert(xhr.responseJSON.error);
+            }
+        });
+    });
+})(jQuery);
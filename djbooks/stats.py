@@ -0,0 +1,25 @@
+from django.db.models import Count
+
+from djbooks.models import Category
+
+
+def category_book_counts():
+    """Books per category, read from the denormalized ``book_count``."""
+    return {category: category.book_count for category in Category.objects.all()}
+
+
+def refresh_category_counts():
+    """
+    Recompute every ``Category.book_count`` with one grouped query.
+
+    Signals keep the counts current, this is for bulk loads that bypass
+    them and for repairing drift.
+    """
+    categories = list(Category.objects.annotate(total=Count('book')))
+    stale = []
+    for category in categories:
+        if category.book_count != category.total:
+            category.book_count = category.total
+            stale.append(category)
+    Category.objects.bulk_update(stale, ['book_count'])
+    return len(stale)
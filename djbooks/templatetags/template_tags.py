@@ -1,13 +1,39 @@
 from django import template
-from djbooks.models import Order
+from django.utils.html import format_html
+from djbooks.assets import bundle_tags
+from djbooks.cart import get_cart_summary
 
 register = template.Library()
 
 
 @register.filter
 def cart_item_count(user):
-    if user.is_authenticated:
-        qs = Order.objects.filter(user=user, ordered=False)
-        if qs.exists():
-            return qs[0].items.count()
-    return 0
+    # Prefer the cart_summary context variable, this is kept for old templates
+    return get_cart_summary(user).item_count
+
+
+@register.simple_tag
+def picture(images, variant, css_class='img-fluid', alt=''):
+    """
+    Render an image variant (see djbooks.images.ImageVariants) as a
+    <picture> with a WebP source and a JPEG fallback.
+    """
+    image = images[variant]
+    img = format_html(
+        '<img alt="{}" class="{}" src="{}"{} loading="lazy" />',
+        alt, css_class, image['jpg'] or '#',
+        format_html(' width="{}" height="{}"', image['width'], image['height'])
+        if image['width'] else '',
+    )
+    if not image['webp']:
+        return img
+    return format_html(
+        '<picture><source srcset="{}" type="image/webp" />{}</picture>',
+        image['webp'], img,
+    )
+
+
+@register.simple_tag
+def bundle(name):
+    """Link the CSS/JS bundle ``name`` (see djbooks.assets)."""
+    return bundle_tags(name)
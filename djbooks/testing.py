@@ -0,0 +1,59 @@
+"""
+Helpers for tests to hold views to a query budget.
+
+    from djbooks.testing import assert_query_budget
+
+    def test_index(self):
+        assert_query_budget(self.client, reverse('djbooks:index'))
+
+The budget defaults to the view's entry in ``settings.QUERY_BUDGETS``.
+Going over it, or repeating a statement often enough to look like an
+N+1, fails with the offending statements in the message.
+"""
+from django.conf import settings
+from django.urls import resolve
+
+from djbooks.middleware import QueryRecorder
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class query_budget(QueryRecorder):
+    """
+    Context manager failing when the block runs more than ``budget``
+    queries, or repeats a statement ``n_plus_one`` times or more (pass
+    None to allow repeats).
+    """
+
+    def __init__(self, budget, n_plus_one=-1):
+        super().__init__()
+        self.budget = budget
+        self.threshold = n_plus_one
+
+    def __exit__(self, *exc_info):
+        super().__exit__(*exc_info)
+        if exc_info[0] is not None:
+            return
+        problems = []
+        if self.count > self.budget:
+            problems.append('%d queries, budget is %d' % (self.count, self.budget))
+        if self.threshold is not None:
+            repeated = self.repeated(None if self.threshold == -1 else self.threshold)
+            problems += ['repeated %d times: %s' % (times, sql) for _, times, sql in repeated]
+        if problems:
+            raise QueryBudgetExceeded('\n'.join(problems))
+
+
+def assert_query_budget(client, path, budget=None, method='get', **kwargs):
+    """
+    Request ``path`` with the test ``client`` within ``budget`` queries
+    (by default the view's ``QUERY_BUDGETS`` entry). Returns the response.
+    """
+    if budget is None:
+        name = resolve(path.split('?')[0]).view_name
+        budget = settings.QUERY_BUDGETS[name]
+    with query_budget(budget):
+        response = getattr(client, method)(path, **kwargs)
+    return response
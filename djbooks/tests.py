@@ -1,3 +1,945 @@
-from django.test import TestCase
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import Counter
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.db.models import F
+from django.http import HttpResponse
+from django.test import (
+    LiveServerTestCase, RequestFactory, TestCase, TransactionTestCase, override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from djbooks import async_views, autocomplete, views
+from djbooks.cart import CartService, get_cart_summary
+from djbooks.catalog_cache import get_book_version, get_catalog_version
+from djbooks.fake_mercadopago import start_fake_server
+from djbooks.gateway import DummyGateway, get_gateway
+from djbooks.inventory import OutOfStock, extend, release_expired
+from djbooks.management.commands.import_time import LAZY_MODULES, STARTUP
+from djbooks.models import Book, Category, ExtraImage, Order, Payment, PaymentEvent, StockReservation
+from djbooks.pagination import encode_cursor
+from djbooks.routers import PIN_COOKIE, replica_pin_middleware
+from djbooks.payments import MAX_ATTEMPTS, RETRY_DELAY, process_payment_events
+from djbooks.search import FuzzySearchBackend, search_books
+from djbooks.testing import assert_query_budget
+from djbooks.uploads import ingest_images
+
+
+def use_gateway(test, path):
+    """Pay through the gateway class at ``path`` for the rest of ``test``."""
+    override = test.settings(PAYMENT_GATEWAYS={'MP': path})
+    override.enable()
+    get_gateway.cache_clear()
+    test.addCleanup(get_gateway.cache_clear)
+    test.addCleanup(override.disable)
+
+
+def run_threads(count, target):
+    """Run ``target(n)`` in ``count`` threads started together, returns their results."""
+    start = threading.Barrier(count)
+    results = [None] * count
+
+    def run(n):
+        start.wait()
+        try:
+            results[n] = target(n)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class StockTests(TransactionTestCase):
+    """Many buyers after the same few copies at once."""
+
+    THREADS = 12
+    ATTEMPTS = 10
+
+    def setUp(self):
+        self.books = [Book.objects.create(title=f'Libro {n}', author='Autor', price=10, stock=20)
+                      for n in range(3)]
+        self.users = [User.objects.create(username=f'buyer-{n}') for n in range(self.THREADS)]
+
+    def buy(self, n):
+        cart = CartService(self.users[n])
+        outcome = Counter()
+        for attempt in range(self.ATTEMPTS):
+            book = self.books[attempt % len(self.books)]
+            try:
+                if attempt % 4 == 3:
+                    cart.remove(book.slug, 1)
+                    outcome['removed'] += 1
+                else:
+                    cart.add(book.slug)
+                    outcome['added'] += 1
+            except OutOfStock:
+                outcome['out of stock'] += 1
+            except Exception as error:
+                outcome[f'{type(error).__name__}: {error}'] += 1
+        return outcome
+
+    def test_no_oversell_and_no_errors(self):
+        outcome = sum(run_threads(self.THREADS, self.buy), Counter())
+        errors = {key: count for key, count in outcome.items()
+                  if key not in ('added', 'removed', 'out of stock')}
+        self.assertEqual(errors, {})
+        # 12 buyers want more than the 60 copies
+        self.assertGreater(outcome['out of stock'], 0)
+
+        for book in self.books:
+            book.refresh_from_db()
+            held = sum(StockReservation.objects.filter(book=book).values_list('quantity', flat=True))
+            in_carts = sum(book.orderbook_set.values_list('quantity', flat=True))
+            self.assertGreaterEqual(book.stock, 0)
+            self.assertEqual(book.stock + held, 20)
+            self.assertEqual(held, in_carts)
+
+    def test_extensions_stop_at_the_maximum_hold(self):
+        CartService(self.users[0]).add(self.books[0].slug)
+        order = Order.objects.get(user=self.users[0], ordered=False)
+        held_since = timezone.now() - timedelta(seconds=settings.STOCK_RESERVATION_MAX_HOLD - 60)
+        StockReservation.objects.update(held_since=held_since)
+        # Reloading the payment page over and over
+        for _ in range(3):
+            extend(order)
+            CartService(self.users[0]).add(self.books[0].slug)
+        reservation = StockReservation.objects.get()
+        self.assertEqual(reservation.quantity, 4)
+        self.assertEqual(reservation.expires_at,
+                         held_since + timedelta(seconds=settings.STOCK_RESERVATION_MAX_HOLD))
+
+    def test_expired_reservations_go_back_to_the_stock(self):
+        run_threads(self.THREADS, self.buy)
+        StockReservation.objects.update(expires_at=timezone.now())
+        release_expired()
+        self.assertEqual(set(Book.objects.values_list('stock', flat=True)), {20})
+        self.assertFalse(Order.objects.filter(items__isnull=False).exists())
+
+
+class CartSummaryTests(TestCase):
+
+    def order_queries(self, save):
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                save()
+        return [query['sql'] for query in queries if '"djbooks_order"' in query['sql']]
+
+    def test_price_changes_update_every_cart_at_once(self):
+        book = Book.objects.create(title='Libro', author='Autor', price=10, stock=50)
+        other = Book.objects.create(title='Otro', author='Autor', price='2.50', stock=50)
+        users = [User.objects.create(username=f'buyer-{n}') for n in range(5)]
+        for n, user in enumerate(users):
+            CartService(user).add(book.slug, n + 1)
+            CartService(user).add(other.slug)
+        book = Book.objects.get(pk=book.pk)
+        book.discount_price = 8
+        self.assertLessEqual(len(self.order_queries(book.save)), 2)
+        for n, user in enumerate(users):
+            order = Order.objects.get(user=user, ordered=False)
+            self.assertEqual(order.subtotal, Decimal('8') * (n + 1) + Decimal('2.50'))
+            self.assertEqual(order.subtotal, order.calculate_totals()['subtotal'])
+            self.assertEqual(get_cart_summary(user).total, float(order.subtotal))
+
+    def test_other_changes_leave_the_carts_alone(self):
+        book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        CartService(User.objects.create(username='buyer')).add(book.slug)
+        book = Book.objects.get(pk=book.pk)
+        book.stock = 3
+        book.description = 'Otra'
+        self.assertEqual(self.order_queries(book.save), [])
+        book.price = 10
+        self.assertEqual(self.order_queries(lambda: book.save(update_fields=['price'])), [])
+
+    def test_price_changes_reach_the_cached_summary(self):
+        user = User.objects.create(username='buyer')
+        book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        CartService(user).add(book.slug, 2)
+        self.assertEqual(get_cart_summary(user).total, 20)
+        book.price = 15
+        with self.captureOnCommitCallbacks(execute=True):
+            book.save()
+        self.assertEqual(get_cart_summary(user).total, 30)
+
+
+class CartApiTests(TestCase):
+
+    def setUp(self):
+        self.book = Book.objects.create(title='Libro', author='Autor', price='12.50', stock=3)
+        self.user = User.objects.create(username='buyer')
+        self.client.force_login(self.user)
+
+    def post(self, action, slug=None, **data):
+        return self.client.post(reverse(f'djbooks:cart-api-{action}', args=[slug or self.book.slug]), data)
+
+    def test_changes(self):
+        response = self.post('add', quantity=2)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {
+            'line': {'slug': self.book.slug, 'title': 'Libro', 'quantity': 2, 'unit_price': 12.5, 'total': 25.0},
+            'cart': {'item_count': 1, 'quantity': 2, 'total': 25.0},
+        })
+        self.assertEqual(self.post('quantity', quantity=1).json()['cart']['total'], 12.5)
+        response = self.post('remove')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'line': None, 'cart': {'item_count': 0, 'quantity': 0, 'total': 0.0}})
+
+    def test_out_of_stock(self):
+        self.post('add', quantity=2)
+        response = self.post('add', quantity=2)
+        self.assertEqual(response.status_code, 409)
+        self.assertIn('error', response.json())
+        # Nothing changed
+        self.assertEqual(get_cart_summary(self.user).quantity, 2)
+        self.assertEqual(Book.objects.get(pk=self.book.pk).stock, 1)
+
+    def test_errors(self):
+        self.assertEqual(self.post('add', quantity='dos').status_code, 400)
+        self.assertEqual(self.post('quantity').status_code, 400)
+        self.assertEqual(self.post('add', slug='no-existe').status_code, 404)
+        self.assertEqual(self.client.get(reverse('djbooks:cart-api-add', args=[self.book.slug])).status_code, 405)
+        self.client.logout()
+        self.assertEqual(self.post('add').status_code, 401)
+        self.assertFalse(Order.objects.exists())
+
+
+class CategoryCountTests(TestCase):
+
+    def setUp(self):
+        self.book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        self.poetry = Category.objects.create(name='Poesía')
+        self.essays = Category.objects.create(name='Ensayo')
+        self.book.category.add(self.poetry)
+
+    def counts(self):
+        return dict(Category.objects.filter(pk__in=[self.poetry.pk, self.essays.pk]).values_list(
+            'name', 'book_count'))
+
+    def test_removing_unattached_categories(self):
+        other = Book.objects.create(title='Otro', author='Autor', price=10, stock=5)
+        other.category.add(self.essays)
+        self.book.category.remove(self.poetry, self.essays)
+        self.assertEqual(self.counts(), {'Poesía': 0, 'Ensayo': 1})
+        # From the category side
+        self.essays.book_set.remove(self.book, other)
+        self.assertEqual(self.counts(), {'Poesía': 0, 'Ensayo': 0})
+
+    def test_adding_twice(self):
+        self.book.category.add(self.poetry, self.essays)
+        self.poetry.book_set.add(self.book)
+        self.assertEqual(self.counts(), {'Poesía': 1, 'Ensayo': 1})
+
+
+class FragmentVersionTests(TestCase):
+
+    def test_versions_are_bumped_on_commit(self):
+        book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        versions = get_book_version(book.pk), get_catalog_version()
+        book.stock = 4
+        with self.captureOnCommitCallbacks() as callbacks:
+            book.save()
+            category = Category.objects.create(name='Poesía')
+            book.category.add(category)
+        # A page rendered now must not cache the uncommitted rows as new
+        self.assertEqual((get_book_version(book.pk), get_catalog_version()), versions)
+        for callback in callbacks:
+            callback()
+        self.assertGreater(get_book_version(book.pk), versions[0])
+        self.assertGreater(get_catalog_version(), versions[1])
+
+    def test_stock_changes_are_bumped_on_commit(self):
+        book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        version = get_book_version(book.pk)
+        with self.captureOnCommitCallbacks() as callbacks:
+            CartService(User.objects.create(username='buyer')).add(book.slug)
+        # The detail fragment shows the stock
+        self.assertEqual(get_book_version(book.pk), version)
+        for callback in callbacks:
+            callback()
+        self.assertGreater(get_book_version(book.pk), version)
+
+
+class PreferenceExpiryTests(TestCase):
+
+    def test_preference_expires_with_the_reservations(self):
+        user = User.objects.create(username='buyer')
+        book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        CartService(user).add(book.slug)
+        order = Order.objects.get(user=user, ordered=False)
+        held_until = timezone.now() + timedelta(minutes=5)
+        StockReservation.objects.update(expires_at=held_until)
+        use_gateway(self, 'djbooks.gateway.DummyGateway')
+        self.assertTrue(order.get_preference())
+        self.assertEqual(order.preference_expires, held_until)
+
+
+class UnreachableGateway(DummyGateway):
+
+    def fetch_payment(self, payment_id):
+        raise ValueError('gateway down')
+
+
+class PaymentEventTests(TestCase):
+
+    def setUp(self):
+        use_gateway(self, 'djbooks.gateway.DummyGateway')
+        self.user = User.objects.create(username='buyer')
+        self.cheap = Book.objects.create(title='Barato', author='Autor', price=1, stock=5)
+        self.expensive = Book.objects.create(title='Caro', author='Autor', price=1000, stock=5)
+        self.cart = CartService(self.user)
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def notify(self, payment_id):
+        return PaymentEvent.objects.create(
+            payment_method=Payment.PaymentMethod.mercado_pago, topic='payment', resource_id=payment_id)
+
+    def test_payment_of_the_current_preference_pays_the_order(self):
+        self.cart.add(self.cheap.slug)
+        order = self.get_order()
+        event = self.notify(order.get_preference())
+        self.assertEqual(process_payment_events(), (1, 1))
+        order.refresh_from_db()
+        event.refresh_from_db()
+        self.assertTrue(order.paid)
+        self.assertEqual(event.error, '')
+        self.assertEqual(len(order.snapshot), 1)
+
+    def test_cents_survive_the_float_amounts(self):
+        # 3 x 10.10 adds up to 30.299999999999997 in floats
+        book = Book.objects.create(title='Con centavos', author='Autor', price='10.10', stock=5)
+        self.cart.add(book.slug, 3)
+        order = self.get_order()
+        self.notify(order.get_preference())
+        process_payment_events()
+        order.refresh_from_db()
+        self.assertTrue(order.paid)
+
+    def test_payment_of_an_older_preference_does_not_pay_the_order(self):
+        self.cart.add(self.cheap.slug)
+        old_preference = self.get_order().get_preference()
+        self.cart.add(self.expensive.slug)
+        order = self.get_order()
+        self.assertNotEqual(order.get_preference(), old_preference)
+        event = self.notify(old_preference)
+        process_payment_events()
+        order.refresh_from_db()
+        event.refresh_from_db()
+        self.assertFalse(order.paid)
+        self.assertEqual(order.snapshot, [])
+        self.assertIsNotNone(event.processed_at)
+        self.assertEqual(event.error, 'paid an older preference of the order')
+        # Recorded all the same, for staff
+        self.assertEqual(Payment.objects.get(charge_id=old_preference).amount, 1)
+
+    def test_payment_of_another_amount_does_not_pay_the_order(self):
+        self.cart.add(self.cheap.slug)
+        order = self.get_order()
+        event = self.notify(order.get_preference())
+        # The price changed after the preference was made
+        Order.objects.filter(pk=order.pk).update(subtotal=2)
+        process_payment_events()
+        order.refresh_from_db()
+        event.refresh_from_db()
+        self.assertFalse(order.paid)
+        self.assertIn('paid 1', event.error)
+
+    def test_failed_fetches_back_off(self):
+        use_gateway(self, 'djbooks.tests.UnreachableGateway')
+        event = self.notify('12345')
+        now = timezone.now()
+        self.assertEqual(process_payment_events(), (0, 0))
+        event.refresh_from_db()
+        self.assertEqual((event.attempts, event.error), (1, 'gateway down'))
+        self.assertGreaterEqual(event.next_attempt_at, now + timedelta(seconds=RETRY_DELAY))
+        # Not retried right away
+        self.assertEqual(process_payment_events(), (0, 0))
+        event.refresh_from_db()
+        self.assertEqual(event.attempts, 1)
+
+        for attempts in range(2, MAX_ATTEMPTS + 1):
+            PaymentEvent.objects.filter(pk=event.pk).update(next_attempt_at=timezone.now())
+            process_payment_events()
+            event.refresh_from_db()
+            self.assertEqual(event.attempts, attempts)
+        delay = event.next_attempt_at - timezone.now()
+        self.assertGreater(delay, timedelta(seconds=RETRY_DELAY * 2 ** (MAX_ATTEMPTS - 2)))
+
+
+class MercadoPagoTests(LiveServerTestCase):
+    """
+    The real gateway and SDK against djbooks.fake_mercadopago, which
+    notifies payments to the webhook of the live server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = start_fake_server()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        override = self.settings(SITE_URL=self.live_server_url, MERCADO_PAGO_API_URL=self.server.url)
+        override.enable()
+        self.addCleanup(override.disable)
+        # After the override, the gateway keeps its SDK
+        use_gateway(self, 'djbooks.gateway.MercadoPagoGateway')
+        self.user = User.objects.create(username='buyer')
+        self.cheap = Book.objects.create(title='Barato', author='Autor', price=10, stock=5)
+        self.expensive = Book.objects.create(title='Caro', author='Autor', price=1000, stock=5)
+        self.cart = CartService(self.user)
+
+    def get_order(self):
+        return Order.objects.get(user=self.user, ordered=False)
+
+    def test_checkout_creates_a_preference(self):
+        self.cart.add(self.cheap.slug, 2)
+        order = self.get_order()
+        preference_id = order.get_preference()
+        preference = self.server.preferences[preference_id]
+        self.assertEqual(preference['external_reference'], str(order.pk))
+        self.assertEqual(preference['notification_url'],
+                         self.live_server_url + reverse('djbooks:mercadopago-webhook'))
+        self.assertEqual([(item['title'], item['quantity'], item['unit_price']) for item in preference['items']],
+                         [('Barato', 2, 10.0)])
+        # Unchanged lines reuse it
+        created = self.server.calls.count(('POST', '/checkout/preferences'))
+        self.assertEqual(self.get_order().get_preference(), preference_id)
+        self.assertEqual(self.server.calls.count(('POST', '/checkout/preferences')), created)
+
+    def test_notified_payment_pays_the_order(self):
+        self.cart.add(self.cheap.slug)
+        order = self.get_order()
+        payment = self.server.pay(order.get_preference())
+        event = PaymentEvent.objects.get()
+        self.assertEqual((event.topic, event.resource_id), ('payment', str(payment['id'])))
+        self.assertEqual(process_payment_events(), (1, 1))
+        order.refresh_from_db()
+        event.refresh_from_db()
+        self.assertTrue(order.paid)
+        self.assertEqual(event.error, '')
+        self.assertEqual(Payment.objects.get(charge_id=str(payment['id'])).amount, 10)
+
+    def test_cents_survive_the_float_amounts(self):
+        book = Book.objects.create(title='Con centavos', author='Autor', price='10.10', stock=5)
+        self.cart.add(book.slug, 3)
+        order = self.get_order()
+        payment = self.server.pay(order.get_preference())
+        self.assertNotIn('preference_id', payment)
+        process_payment_events()
+        order.refresh_from_db()
+        self.assertTrue(order.paid)
+        self.assertEqual(PaymentEvent.objects.get().error, '')
+
+    def test_payment_of_an_older_preference_does_not_pay_the_order(self):
+        self.cart.add(self.cheap.slug)
+        old_preference = self.get_order().get_preference()
+        self.cart.add(self.expensive.slug)
+        self.assertNotEqual(self.get_order().get_preference(), old_preference)
+        self.server.pay(old_preference)
+        process_payment_events()
+        order = self.get_order()
+        event = PaymentEvent.objects.get()
+        self.assertFalse(order.paid)
+        self.assertIsNotNone(event.processed_at)
+        self.assertEqual(event.error, 'paid an older preference of the order')
+
+
+def png(size=(40, 60), corrupt=False):
+    from PIL import Image
+
+    output = io.BytesIO()
+    Image.new('RGB', size, 'red').save(output, 'PNG')
+    data = bytearray(output.getvalue())
+    if corrupt:
+        # Bad checksum, verify() raises SyntaxError
+        data[data.index(b'IDAT') + 4] ^= 0xff
+    return bytes(data)
+
+
+class UploadTests(TestCase):
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        override = self.settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+
+    def stored_files(self):
+        return sorted(name for _, _, names in os.walk(self.media) for name in names)
+
+    def uploads(self):
+        return [
+            SimpleUploadedFile('buena.png', png()),
+            SimpleUploadedFile('rota.png', png(corrupt=True)),
+            SimpleUploadedFile('cortada.png', png()[:60]),
+            SimpleUploadedFile('texto.png', b'no es una imagen'),
+            # DecompressionBombError with the limit patched below
+            SimpleUploadedFile('enorme.png', png((200, 200))),
+        ]
+
+    def test_bad_files_only_fail_themselves(self):
+        with mock.patch('PIL.Image.MAX_IMAGE_PIXELS', 5000):
+            results = ingest_images(self.book, self.uploads(), cover=0)
+        self.assertEqual([result['ok'] for result in results], [True, False, False, False, False])
+        self.assertTrue(all(result['error'] for result in results[1:]))
+        image = ExtraImage.objects.get()
+        self.assertTrue(image.cover)
+        # The good one and its 8 variants, nothing left of the others
+        root = os.path.splitext(os.path.basename(image.image.name))[0]
+        self.assertEqual(len(self.stored_files()), 9)
+        self.assertTrue(all(name.startswith(root) for name in self.stored_files()))
+
+    def test_stored_files_are_deleted_when_the_batch_fails(self):
+        with mock.patch.object(ExtraImage.objects, 'bulk_create', side_effect=RuntimeError('db down')):
+            with self.assertRaises(RuntimeError):
+                ingest_images(self.book, self.uploads())
+        self.assertEqual(self.stored_files(), [])
+
+
+class EffectivePriceTests(TestCase):
+
+    def setUp(self):
+        self.plain = Book.objects.create(title='Sin descuento', author='Autor', price=100)
+        self.discounted = Book.objects.create(title='Con descuento', author='Autor', price=100,
+                                              discount_price=80)
+
+    def prices(self):
+        return dict(Book.objects.values_list('title', 'effective_price'))
+
+    def test_update(self):
+        Book.objects.update(price=F('price') + 50)
+        self.assertEqual(self.prices(), {'Sin descuento': 150, 'Con descuento': 80})
+        Book.objects.filter(pk=self.plain.pk).update(discount_price=Decimal('99.90'))
+        Book.objects.filter(pk=self.discounted.pk).update(discount_price=0)
+        self.assertEqual(self.prices(), {'Sin descuento': Decimal('99.90'), 'Con descuento': 150})
+
+    def test_bulk_update(self):
+        self.plain.price, self.discounted.discount_price = 120, None
+        Book.objects.bulk_update([self.plain, self.discounted], ['price', 'discount_price'])
+        self.assertEqual(self.prices(), {'Sin descuento': 120, 'Con descuento': 100})
+
+    def test_bulk_create(self):
+        Book.objects.bulk_create([Book(title='Nuevo', author='Autor', price=30, discount_price=25)])
+        self.assertEqual(self.prices()['Nuevo'], 25)
+
+    def test_save_with_update_fields(self):
+        self.discounted.discount_price = 60
+        self.discounted.save(update_fields=['discount_price'])
+        self.assertEqual(self.prices()['Con descuento'], 60)
+
+
+class CursorTests(TestCase):
+    """Cursors come from the query string, bad ones are a 404."""
+
+    BAD_CURSORS = (
+        'not-base64!', encode_cursor({'a': 1}), encode_cursor([1]), encode_cursor(['abc']),
+        encode_cursor(['x', 1]), encode_cursor([{'a': 1}, 1]), encode_cursor([None, 1]),
+        encode_cursor(['10.00', 10 ** 30]),
+    )
+
+    def setUp(self):
+        category = Category.objects.create(name='Novela')
+        for n in range(30):
+            book = Book.objects.create(title=f'Libro {n}', author='Autor', price=10 + n, stock=1)
+            book.category.add(category)
+        self.url = f'/categoria/{category.slug}'
+        self.user = User.objects.create(username='buyer')
+        for n in range(12):
+            Order.objects.create(user=self.user, ordered=True, ordered_date=timezone.now())
+
+    def test_category_pages(self):
+        page = self.client.get(self.url, {'sort': 'precio'})
+        self.assertEqual(page.status_code, 200)
+        cursor = page.context['page_obj'].next_cursor
+        self.assertEqual(self.client.get(self.url, {'sort': 'precio', 'after': cursor}).status_code, 200)
+        for bad in self.BAD_CURSORS:
+            with self.subTest(cursor=bad):
+                response = self.client.get(self.url, {'sort': 'precio', 'after': bad})
+                self.assertEqual(response.status_code, 404)
+
+    def test_purchase_history_pages(self):
+        self.client.force_login(self.user)
+        cursor = self.client.get('/compras').context['page_obj'].next_cursor
+        self.assertEqual(len(self.client.get('/compras', {'after': cursor}).context['orders']), 2)
+        for bad in self.BAD_CURSORS + (encode_cursor(['yesterday', 1]),):
+            with self.subTest(cursor=bad):
+                self.assertEqual(self.client.get('/compras', {'before': bad}).status_code, 404)
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        Book.objects.create(title='Cien años de soledad', author='Gabriel García Márquez')
+        Book.objects.create(title='Rayuela', author='Julio Cortázar').tags.add('novela')
+
+    def titles(self, query):
+        return [book.title for book in search_books(query)[:10]]
+
+    def test_terms_as_typed(self):
+        results = search_books('garcia cien')
+        self.assertNotIsInstance(results.backend, FuzzySearchBackend)
+        self.assertEqual([book.title for book in results[:10]], ['Cien años de soledad'])
+
+    def test_misspellings_fall_back_to_trigrams(self):
+        results = search_books('garcia marques')
+        self.assertIsInstance(results.backend, FuzzySearchBackend)
+        self.assertEqual([book.title for book in results[:10]], ['Cien años de soledad'])
+        self.assertEqual(self.titles('soledda'), ['Cien años de soledad'])
+        self.assertEqual(self.titles('cortazr'), ['Rayuela'])
+        # Tags are indexed too
+        self.assertEqual(self.titles('novella'), ['Rayuela'])
+
+    def test_no_match(self):
+        self.assertEqual(self.titles('xyzzy'), [])
+
+
+class FacetTests(TestCase):
+
+    def setUp(self):
+        # Cached by category id and catalog version, both repeat across tests
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.category = Category.objects.create(name='Novela')
+        for title, editorial, year, price, discount, tags in (
+            ('A', 'Alfa', '1990', 50, None, ['poesia']),
+            ('B', 'Alfa', '2000', 150, None, ['poesia', 'clasico']),
+            ('C', 'Beta', '2000', 300, 90, ['clasico']),
+            ('D', 'Beta', '2010', 600, None, []),
+        ):
+            book = Book.objects.create(title=title, author='Autor', editorial=editorial, year=year,
+                                       price=price, discount_price=discount, stock=1)
+            book.category.add(self.category)
+            book.tags.add(*tags)
+        self.url = f'/categoria/{self.category.slug}'
+
+    def browse(self, **filters):
+        page = self.client.get(self.url, filters)
+        counts = {facet['name']: {value['value']: value['count'] for value in facet['values']}
+                  for facet in page.context['facets']}
+        titles = sorted(book.title for book in page.context['object_list'])
+        return page.context['page_obj'].count, titles, counts
+
+    def test_counts(self):
+        _, titles, counts = self.browse()
+        self.assertEqual(titles, ['A', 'B', 'C', 'D'])
+        self.assertEqual(counts['editorial'], {'Alfa': 2, 'Beta': 2})
+        self.assertEqual(counts['tag'], {'poesia': 2, 'clasico': 2})
+        # C is counted at its discount price
+        self.assertEqual(counts['price'], {'0-100': 2, '100-200': 1, '500-': 1})
+
+    def test_filters_are_combined(self):
+        count, titles, counts = self.browse(tag='clasico', year='2000', price='0-100')
+        self.assertEqual((count, titles), (1, ['C']))
+        # Each facet is counted under the other facets' filters
+        self.assertEqual(counts['tag'], {'clasico': 1})
+        self.assertEqual(counts['year'], {'2000': 1})
+        self.assertEqual(counts['price'], {'0-100': 1, '100-200': 1})
+        self.assertEqual(counts['editorial'], {'Beta': 1})
+
+    def test_values_of_a_facet_are_either(self):
+        count, titles, counts = self.browse(editorial=['Beta', 'Alfa'], year='2000')
+        self.assertEqual((count, titles), (2, ['B', 'C']))
+        self.assertEqual(counts['editorial'], {'Alfa': 1, 'Beta': 1})
+        self.assertEqual(counts['year'], {'1990': 1, '2000': 2, '2010': 1})
+
+    def test_sort_form_keeps_the_filters(self):
+        page = self.client.get(self.url, {'tag': 'clasico', 'year': '2000', 'sort': 'precio'})
+        self.assertEqual(page.context['filter_params'], [('tag', 'clasico'), ('year', '2000')])
+        self.assertContains(page, '<input type="hidden" name="tag" value="clasico">', html=True)
+        self.assertContains(page, '<input type="hidden" name="year" value="2000">', html=True)
+
+
+class ImportCatalogTests(TestCase):
+
+    def import_lines(self, lines):
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as source:
+            source.write('\n'.join(lines) + '\n')
+        self.addCleanup(os.remove, source.name)
+        err = io.StringIO()
+        call_command('import_catalog', source.name, stdout=io.StringIO(), stderr=err)
+        return err.getvalue()
+
+    def book(self, **fields):
+        return json.dumps({'title': 'Libro', 'author': 'Autor', 'price': 100, **fields})
+
+    def test_a_broken_line_only_rejects_itself(self):
+        errors = self.import_lines([
+            self.book(title='Antes'), '{"title": "Roto", ', '[1, 2]', self.book(title='Después')])
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)), ['Antes', 'Después'])
+        self.assertIn('record 2: invalid JSON', errors)
+        self.assertIn('record 3: not a JSON object', errors)
+
+    def test_stock(self):
+        self.import_lines([
+            self.book(title='Agotado', stock=0), self.book(title='Sin dato'),
+            self.book(title='Vacío', stock=''), self.book(title='Negativo', stock=-2)])
+        self.assertEqual(dict(Book.objects.values_list('title', 'stock')),
+                         {'Agotado': 0, 'Sin dato': 1, 'Vacío': 1})
+
+    def test_books_need_a_price(self):
+        errors = self.import_lines([
+            json.dumps({'title': 'Sin precio', 'author': 'Autor'}),
+            self.book(title='Vacío', price=''), self.book(title='Gratis', price=0),
+            self.book(title='Raro', price='NaN')])
+        self.assertEqual(list(Book.objects.values_list('title', flat=True)), ['Gratis'])
+        self.assertEqual(errors.count('price is required'), 2)
+
+
+class AutocompleteTests(TestCase):
+
+    def setUp(self):
+        self.book = Book.objects.create(title='Cien años de soledad', author='Gabriel García Márquez')
+        autocomplete.rebuild()
+
+    def labels(self, text):
+        return [suggestion['label'] for suggestion in autocomplete.suggest(text)]
+
+    def test_edits_are_applied(self):
+        self.assertIn('Cien años de soledad', self.labels('soled'))
+        self.book.title = 'El amor en los tiempos del cólera'
+        self.book.save()
+        self.assertEqual(self.labels('soled'), [])
+        self.assertIn('El amor en los tiempos del cólera', self.labels('colera'))
+        self.book.delete()
+        self.assertEqual(self.labels('colera'), [])
+
+    def test_edits_during_a_rebuild_are_kept(self):
+        build = autocomplete.PrefixIndex.build
+
+        def build_then_edit(index):
+            build(index)
+            # Saved after the new index read the books
+            Book.objects.filter(pk=self.book.pk).update(title='Pedro Páramo')
+            self.book.refresh_from_db()
+            self.book.save()
+
+        with mock.patch.object(autocomplete.PrefixIndex, 'build', build_then_edit):
+            autocomplete.rebuild()
+        self.assertEqual(self.labels('soled'), [])
+        self.assertIn('Pedro Páramo', self.labels('pedro'))
+
+    def test_a_forked_process_starts_its_own_builder(self):
+        builds = []
+        # As inherited from a parent that called start(), the thread isn't
+        # running here
+        with mock.patch.object(autocomplete, '_thread', threading.Thread()), \
+                mock.patch.object(autocomplete, '_pid', -1), \
+                mock.patch.object(autocomplete, 'keep_built', lambda: builds.append(os.getpid())):
+            autocomplete.reset_after_fork()
+            # The inherited index answers meanwhile
+            self.assertIn('Cien años de soledad', self.labels('soled'))
+            autocomplete._thread.join()
+            self.assertEqual(builds, [os.getpid()])
+            self.assertEqual(autocomplete._pid, os.getpid())
+
+    def test_suggest_while_books_change(self):
+        index = autocomplete.PrefixIndex()
+        titles = [f'Libro {n} de prueba' for n in range(200)]
+        for pk, title in enumerate(titles):
+            index.update_book(pk, title, f'Autor {pk % 7}', f'libro-{pk}', [])
+        stop = threading.Event()
+
+        def edit():
+            while not stop.is_set():
+                for pk, title in enumerate(titles):
+                    index.remove_book(pk)
+                    index.update_book(pk, title, f'Autor {pk % 7}', f'libro-{pk}', [])
+
+        editor = threading.Thread(target=edit)
+        editor.start()
+        try:
+            results = run_threads(4, lambda n: [len(index.suggest(prefix)) for _ in range(300)
+                                                 for prefix in ('libro', 'autor', 'prueba')])
+        finally:
+            stop.set()
+            editor.join()
+        self.assertTrue(all(results))
+
+
+class QueryBudgetTests(TestCase):
+    """The main pages within their ``QUERY_BUDGETS``, cold and cached."""
+
+    @classmethod
+    def setUpTestData(cls):
+        call_command('generate_catalog', '--books', '300', '--users', '20', stdout=io.StringIO())
+        cls.book = Book.objects.filter(recommended_in__isnull=False).distinct().first()
+        cls.category = Category.objects.order_by('-book_count').first()
+        cls.user = User.objects.create(username='reader')
+        for book in Book.objects.filter(stock__gt=0)[:5]:
+            CartService(cls.user).add(book.slug)
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def assert_budget(self, path):
+        for attempt in ('cold', 'cached'):
+            with self.subTest(path=path, cache=attempt):
+                response = assert_query_budget(self.client, path)
+                self.assertEqual(response.status_code, 200)
+
+    def test_index(self):
+        self.assert_budget(reverse('djbooks:index'))
+
+    def test_book_detail(self):
+        self.assert_budget(self.book.get_absolute_url())
+
+    def test_category(self):
+        url = reverse('djbooks:categoria', kwargs={'category': self.category.slug})
+        self.assert_budget(url)
+        self.assert_budget(url + '?sort=precio&price=100-200')
+
+    def test_order_summary(self):
+        self.client.force_login(self.user)
+        self.assert_budget(reverse('djbooks:order-summary'))
+
+    def test_search(self):
+        self.assert_budget(reverse('djbooks:buscar_libro') + '?query=amor')
+
+
+@override_settings(ROOT_URLCONF='unice.urls_async')
+class AsyncViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Novela')
+        self.book = Book.objects.create(title='Libro', author='Autor', price=10, stock=5)
+        self.book.category.add(self.category)
+        self.book.tags.add('clasico')
+
+    def test_fragment_keys_are_the_templates(self):
+        self.client.get(f'/{self.book.slug}')
+        context = {'object': self.book, 'book_version': get_book_version(self.book.pk),
+                   'catalog_version': get_catalog_version()}
+        keys = async_views.fragment_keys(views.BookDetailView.template_name, context)
+        self.assertEqual(set(keys), {'book_breadcrumb', 'book_detail', 'book_related'})
+        # All of them stored by the render
+        self.assertEqual(len(cache.get_many(list(keys.values()))), 3)
+
+    def test_fragments_evicted_after_the_check_are_rendered_from_data(self):
+        async def nothing_stale(template_name, context):
+            return set()
+
+        with mock.patch.object(async_views, 'stale_fragments', nothing_stale):
+            page = self.client.get(f'/{self.book.slug}')
+            self.assertContains(page, 'Novela')
+            self.assertContains(page, 'clasico')
+            home = self.client.get('/')
+            self.assertContains(home, f'/categoria/{self.category.slug}')
+
+
+class StartupImportTests(TestCase):
+
+    def test_heavy_modules_are_not_imported_at_startup(self):
+        # A fresh interpreter, this one has already imported everything
+        script = f'{STARTUP}; import sys; print(" ".join(sorted(sys.modules)))'
+        result = subprocess.run(
+            [sys.executable, '-c', script], capture_output=True, text=True, check=True,
+            env={**os.environ, 'DJANGO_SETTINGS_MODULE': settings.SETTINGS_MODULE})
+        loaded = set(result.stdout.split())
+        self.assertIn('djbooks.models', loaded)
+        self.assertEqual([name for name in LAZY_MODULES if name in loaded], [])
+
+
+REPLICA = 'test_replica'
+
+
+@override_settings(DATABASE_REPLICAS=[REPLICA])
+class ReplicaTests(TransactionTestCase):
+    """Catalog reads through ReplicaRouter, with a replica file synced by sync_replica."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # After super(): the alias isn't one of the test databases, every
+        # test copies the primary over it with sync_replica anyway
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.settings[REPLICA] = {
+            **connections['default'].settings_dict,
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        connections[REPLICA].close()
+        del connections[REPLICA]
+        del connections.settings[REPLICA]
+        for name in os.listdir(cls.replica_dir):
+            os.remove(os.path.join(cls.replica_dir, name))
+        os.rmdir(cls.replica_dir)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.book = Book.objects.create(title='Primera edición', author='Autor', stock=5)
+        self.sync()
+
+    def sync(self):
+        call_command('sync_replica', stdout=io.StringIO())
+
+    def get(self, view, cookies=None, method='get'):
+        request = getattr(RequestFactory(), method)('/')
+        request.COOKIES.update(cookies or {})
+        return replica_pin_middleware(view)(request)
+
+    def read_title(self, request):
+        return HttpResponse(Book.objects.get(pk=self.book.pk).title)
+
+    def rename(self, title):
+        # On the primary, outside any request
+        Book.objects.filter(pk=self.book.pk).update(title=title)
+
+    def test_unpinned_reads_use_the_replica_until_it_is_synced(self):
+        self.rename('Segunda edición')
+        response = self.get(self.read_title)
+        self.assertEqual(response.content.decode(), 'Primera edición')
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+        self.sync()
+        self.assertEqual(self.get(self.read_title).content.decode(), 'Segunda edición')
+
+    def test_a_request_reads_its_own_writes(self):
+        def write_then_read(request):
+            self.rename('Segunda edición')
+            return self.read_title(request)
+
+        response = self.get(write_then_read)
+        self.assertEqual(response.content.decode(), 'Segunda edición')
+
+        # The cookie pins the next requests of the user to the primary
+        cookies = {PIN_COOKIE: response.cookies[PIN_COOKIE].value}
+        self.assertEqual(self.get(self.read_title, cookies).content.decode(), 'Segunda edición')
+        # Everybody else still reads the replica
+        self.assertEqual(self.get(self.read_title).content.decode(), 'Primera edición')
+
+    def test_unsafe_methods_read_the_primary(self):
+        self.rename('Segunda edición')
+        self.assertEqual(self.get(self.read_title, method='post').content.decode(), 'Segunda edición')
@@ -0,0 +1,33 @@
+"""
+Transactions that write.
+
+Django starts SQLite transactions with a plain (deferred) ``BEGIN``, the
+write lock is only asked for by the first write. When the transaction
+read before and another connection wrote meanwhile, SQLite can't
+upgrade it and fails right away with "database is locked", without
+waiting for the busy timeout. ``write_atomic`` begins with ``BEGIN
+IMMEDIATE`` instead: the lock is taken, waiting for it if needed,
+before anything is read. Other databases get a plain ``atomic``.
+"""
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+
+class WriteAtomic(transaction.Atomic):
+
+    def __enter__(self):
+        connection = transaction.get_connection(self.using)
+        if connection.vendor != 'sqlite' or connection.in_atomic_block:
+            # Nested blocks are savepoints, the transaction already began
+            return super().__enter__()
+        # The BEGIN Django sends when entering the outermost block
+        connection._start_transaction_under_autocommit = (
+            lambda: connection.cursor().execute('BEGIN IMMEDIATE'))
+        try:
+            return super().__enter__()
+        finally:
+            del connection._start_transaction_under_autocommit
+
+
+def write_atomic(using=None):
+    """``transaction.atomic()`` for blocks that read and then write."""
+    return WriteAtomic(using or DEFAULT_DB_ALIAS, savepoint=True, durable=False)
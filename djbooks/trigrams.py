@@ -0,0 +1,125 @@
+"""
+Typo tolerant search over trigrams.
+
+Title, author and tags of every book are folded (no accents, lowercase),
+split into words and cut into trigrams, pg_trgm style: ``'  m', ' ma',
+'mar', ..., 'ez '``. A book matches when it contains at least
+``TRIGRAM_THRESHOLD`` of the query trigrams, so "garcia marques" finds
+García Márquez.
+
+Lookups prune candidates before counting: the query trigrams are sorted
+by how many books contain them, and any book reaching the threshold must
+contain one of the rarest ``n - needed + 1`` of them (prefix filtering).
+Only those books are then scored, in one grouped query over the
+``(gram, book)`` index, instead of every book sharing a common trigram.
+When even that prefix is too common the required overlap is raised.
+"""
+import math
+import re
+
+from django.db import connection, connections, router, transaction
+
+from djbooks.helpers import fold
+
+
+# Fraction of the query trigrams a book must contain
+TRIGRAM_THRESHOLD = 0.5
+FUZZY_LIMIT = 120
+MAX_CANDIDATES = 5000
+BATCH_SIZE = 5000
+
+NON_WORD_RE = re.compile(r'[\W_]+')
+
+
+def normalize(text):
+    return NON_WORD_RE.sub(' ', fold(text)).strip()
+
+
+def trigrams(text):
+    grams = set()
+    for word in normalize(text).split():
+        padded = f'  {word} '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def load_documents(pks=None):
+    """``{book_id: text}`` to index."""
+    from taggit.models import TaggedItem
+    from djbooks.models import Book
+
+    books = Book.objects.all() if pks is None else Book.objects.filter(pk__in=pks)
+    documents = {pk: [title, author] for pk, title, author in books.values_list('pk', 'title', 'author')}
+    tagged = TaggedItem.objects.filter(
+        content_type__app_label='djbooks', content_type__model='book', object_id__in=list(documents))
+    for pk, name in tagged.values_list('object_id', 'tag__name'):
+        documents[pk].append(name)
+    return {pk: ' '.join(parts) for pk, parts in documents.items()}
+
+
+def index_books(pks=None):
+    """(Re)index ``pks``, or every book when None."""
+    from djbooks.models import BookTrigram
+
+    if pks is not None:
+        pks = list(pks)
+    documents = load_documents(pks)
+    table = BookTrigram._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        stale = BookTrigram.objects.all()
+        if pks is not None:
+            stale = stale.filter(book__in=pks)
+        stale.delete()
+        # Millions of rows on a full rebuild, too many for model instances
+        rows = []
+        for pk, text in documents.items():
+            grams = trigrams(text)
+            rows += [(pk, gram, len(grams)) for gram in grams]
+            if len(rows) >= BATCH_SIZE:
+                cursor.executemany(f'INSERT INTO {table} (book_id, gram, doc_size) VALUES (%s, %s, %s)', rows)
+                rows = []
+        if rows:
+            cursor.executemany(f'INSERT INTO {table} (book_id, gram, doc_size) VALUES (%s, %s, %s)', rows)
+    return len(documents)
+
+
+def fuzzy_search(query, limit=FUZZY_LIMIT, threshold=TRIGRAM_THRESHOLD):
+    """``[(book_id, similarity), ...]`` best first."""
+    from djbooks.models import BookTrigram
+
+    grams = sorted(trigrams(query))
+    if not grams:
+        return []
+    needed = max(1, math.ceil(threshold * len(grams)))
+    table = BookTrigram._meta.db_table
+    placeholders = ', '.join(['%s'] * len(grams))
+
+    with connections[router.db_for_read(BookTrigram)].cursor() as cursor:
+        # How many books have each trigram, answered from the gram index
+        cursor.execute(
+            f'SELECT gram, COUNT(*) FROM {table} WHERE gram IN ({placeholders}) GROUP BY gram',
+            grams,
+        )
+        frequency = dict(cursor.fetchall())
+        # Trigrams no book has can't help reaching the threshold
+        if sum(1 for gram in grams if gram in frequency) < needed:
+            return []
+        ordered = sorted(grams, key=lambda gram: frequency.get(gram, 0))
+        # Queries made of very common trigrams would score most of the
+        # catalog, ask for more overlap while the candidates (estimated
+        # from the frequencies) are too many; only the best are returned
+        while needed < len(grams) and sum(
+                frequency.get(gram, 0) for gram in ordered[:len(grams) - needed + 1]) > MAX_CANDIDATES:
+            needed += 1
+        rarest = ordered[:len(grams) - needed + 1]
+        prefix = ', '.join(['%s'] * len(rarest))
+        cursor.execute(
+            f'SELECT book_id, COUNT(*) AS shared, doc_size FROM {table} '
+            f'WHERE gram IN ({placeholders}) AND book_id IN ('
+            f'SELECT book_id FROM {table} WHERE gram IN ({prefix})) '
+            f'GROUP BY book_id, doc_size HAVING COUNT(*) >= %s '
+            # Ties go to the books with fewer other trigrams
+            f'ORDER BY COUNT(*) DESC, doc_size ASC, book_id ASC LIMIT %s',
+            [*grams, *rarest, needed, limit],
+        )
+        return [(pk, shared / len(grams)) for pk, shared, _ in cursor.fetchall()]
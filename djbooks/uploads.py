@@ -0,0 +1,96 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import transaction
+
+from djbooks.catalog_cache import bump_book_version, bump_catalog_version
+from djbooks.images import FORMATS, VARIANTS, render_variants, variant_name
+from djbooks.models import Book, ExtraImage
+
+
+INGEST_WORKERS = min(8, os.cpu_count() or 1)
+
+
+def discard(storage, name):
+    """Delete a stored upload and whatever variants were written for it."""
+    path = storage.path(name)
+    for variant in VARIANTS:
+        for ext in FORMATS:
+            try:
+                os.remove(variant_name(path, variant, ext))
+            except FileNotFoundError:
+                pass
+    storage.delete(name)
+
+
+def store_image(book, upload):
+    """
+    Stream one upload to storage, check it is an image and render its
+    variants. Runs in a worker thread, Pillow releases the GIL while
+    decoding and resizing. Never raises, a bad file only fails its own
+    result.
+    """
+    from PIL import Image
+
+    field = ExtraImage._meta.get_field('image')
+    result = {'name': upload.name, 'size': upload.size, 'ok': False, 'error': None}
+    name = None
+    try:
+        # storage.save copies the upload chunk by chunk
+        name = field.storage.save(field.generate_filename(ExtraImage(book=book), upload.name), upload)
+        path = field.storage.path(name)
+        with Image.open(path) as image:
+            image.verify()
+        variants = {'source': name, **render_variants(path)}
+    # Not only OSError: truncated files raise SyntaxError from verify(),
+    # huge ones DecompressionBombError
+    except Exception as error:
+        if name is not None:
+            discard(field.storage, name)
+        result['error'] = str(error) or 'Imagen no válida'
+        return result, None
+    result['ok'] = True
+    return result, ExtraImage(book=book, image=name, variants=variants)
+
+
+def ingest_images(book, uploads, cover=None, back=None):
+    """
+    Store many extra images of ``book`` at once.
+
+    ``cover`` and ``back`` are optional indexes into ``uploads`` of the
+    images to promote. Rows are inserted with one ``bulk_create`` and the
+    promotion is a single ``UPDATE``, so ``ExtraImage.save`` and
+    ``Book.save`` don't run per file. Returns one result per upload.
+    """
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        processed = list(pool.map(lambda upload: store_image(book, upload), uploads))
+
+    results = [result for result, _ in processed]
+    images = []
+    changes = {}
+    for index, (result, image) in enumerate(processed):
+        if image is None:
+            continue
+        if index == cover:
+            image.cover = True
+            changes.update(cover=image.image.name, cover_variants=image.variants)
+        if index == back:
+            image.back = True
+            changes.update(back=image.image.name, back_variants=image.variants)
+        images.append(image)
+
+    try:
+        with transaction.atomic():
+            ExtraImage.objects.bulk_create(images)
+            if changes:
+                Book.objects.filter(pk=book.pk).update(**changes)
+    except Exception:
+        # Nothing points to the stored files
+        for image in images:
+            discard(image.image.storage, image.image.name)
+        raise
+    # bulk_create and update() skip the signals that invalidate fragments
+    bump_book_version(book.pk)
+    if changes:
+        bump_catalog_version()
+    return results
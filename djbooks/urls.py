@@ -17,13 +17,15 @@ urlpatterns = [
 
     path('accounts/login/', views.CustomLoginView.as_view(),name='login'),
     path('accounts/signup/', views.CustomSignupView.as_view(),name='sign_up'),
-    path('compras', views.PaymentSummaryView.as_view(), name='purchases'),
+    path('compras', views.PurchaseHistoryView.as_view(), name='purchases'),
     path('carrito', views.OrderSummaryView.as_view(), name='order-summary'),
     path('checkout', views.CheckoutView.as_view(), name='checkout'),
     path("wishlist", views.wishlist, name="users-wishlist"),
     path('pago', views.PaymentView.as_view(), name='payment'),
+    path('pago/notificaciones/mercadopago', views.mercadopago_webhook, name='mercadopago-webhook'),
     path('solicitar_libro',views.request_book,name='solicitar_libro'),
     path('buscar_libro', views.search_view, name='buscar_libro'),
+    path('api/autocomplete', views.autocomplete_view, name='autocomplete'),
     path('catalogo',views.collection,name='catalago'),
     path('categoria/<str:category>',views.CollectionListView.as_view(), name='categoria'),
     path('<slug:slug>', views.BookDetailView.as_view(), name='book_detail'),
@@ -32,6 +34,9 @@ urlpatterns = [
     path('add-to-cart/<slug>/', views.add_to_cart, name='add-to-cart'),
     path('remove-from-cart/<slug>/', views.remove_from_cart, name='remove-from-cart'),
     path('remove-item-from-cart/<slug>/', views.remove_single_item_from_cart,name='remove-single-item-from-cart'),
+    path('api/cart/<slug>/add/', views.cart_api, {'action': 'add'}, name='cart-api-add'),
+    path('api/cart/<slug>/remove/', views.cart_api, {'action': 'remove'}, name='cart-api-remove'),
+    path('api/cart/<slug>/quantity/', views.cart_api, {'action': 'quantity'}, name='cart-api-quantity'),
     
     # Wish List
     path('add-to-wishlist/<slug>/', views.add_to_wishlist, name='add-to-wishlist'),
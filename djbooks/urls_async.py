@@ -0,0 +1,21 @@
+from django.urls import URLPattern
+
+from . import async_views
+# app_name is needed by include(), under the same namespace
+from .urls import app_name, urlpatterns as sync_urlpatterns
+
+
+# URL name -> async view replacing the sync one, see djbooks.async_views
+ASYNC_VIEWS = {
+    'index': async_views.index,
+    'catalago': async_views.collection,
+    'categoria': async_views.CollectionListView.as_view(),
+    'book_detail': async_views.book_detail,
+    'buscar_libro': async_views.search_view,
+}
+
+urlpatterns = [
+    URLPattern(pattern.pattern, ASYNC_VIEWS.get(pattern.name, pattern.callback),
+               pattern.default_args, pattern.name)
+    for pattern in sync_urlpatterns
+]
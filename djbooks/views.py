@@ -1,13 +1,33 @@
-from unicodedata import category
-from django.urls import reverse
-from django.utils import timezone
-from django.contrib import messages
-from django.shortcuts import redirect, render
+import json
 
-from .models import Book, Category, ExtraImage, OrderBook, Order, Address
+from allauth.account.views import LoginView, SignupView
+from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.decorators import login_required
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.paginator import Paginator
+from django.db import OperationalError
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, redirect, render
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from django.views.decorators.http import require_POST
+from django.views.generic import DetailView, ListView, View
+
+from .autocomplete import suggest
+from .cart import CartService
+from .catalog_cache import get_book_version
+from .facets import facet_filter, get_facets, parse_filters
 from .forms import CheckoutForm, SearchForm
-
-from django.views.generic import DetailView, View
+from .inventory import OutOfStock, extend as extend_reservations
+from .models import Book, Category, Order, Address
+from .pagination import InvalidCursor, KeysetPaginator
+from .payments import record_mercadopago_event
+from .search import search_books
+from .stats import category_book_counts
+from .uploads import ingest_images
 
 
 # Home views
@@ -28,30 +48,38 @@ class BookDetailView(DetailView):
         # Call the base implementation first to get a context
         context = super().get_context_data(**kwargs)
         # Add data for the context
+        # Lazy, only queried when their cached fragment is rendered again
         data = {"layout":"agency",
-        "header":"dark position-relative nav-lg"}
+        "header":"dark position-relative nav-lg",
+        "book_version": get_book_version(self.object.pk),
+        "extra_images": self.object.extraimage_set.all(),
+        "tags": self.object.tags.all(),
+        "related_books": self.object.get_related_books()}
         context.update(data)
         return context
     
 # class BookSearchView(View):
 #     model = Book
-from django.db.models import Q
+
+SEARCH_RESULTS_PER_PAGE = 12
 
 def search_view(request):
     form = SearchForm(request.GET)
     results = []
     if form.is_valid():
         query = form.cleaned_data['query']
-        # Perform search operation using the query
-        # You can use Django ORM or any other method to fetch the search results
-        results = Book.objects.filter(
-            Q(title__icontains=query) |
-            Q(author__icontains=query) |
-            Q(tags__name__in=[query])
-        )
+        # Ranked and de-duplicated by the search backend, only the
+        # requested page is loaded from the database
+        paginator = Paginator(search_books(query), SEARCH_RESULTS_PER_PAGE)
+        results = paginator.get_page(request.GET.get('page'))
 
     return render(request, 'search-book.html', {'form': form, 'results': results, "layout":default_layout,"header":"dark position-relative nav-lg"})
 
+
+def autocomplete_view(request):
+    # Served from memory, see djbooks.autocomplete
+    return JsonResponse({'suggestions': suggest(request.GET.get('q', '')[:100])})
+
 def index(request):
     # TODO: Change to class based view
     books = Book.objects.all().order_by('-id')
@@ -76,7 +104,7 @@ class CheckoutView(View):
     
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.prefetch_related('items__item').get(user=self.request.user, ordered=False)
             form = CheckoutForm()
             context = {
                 'form': form,
@@ -185,7 +213,9 @@ class CheckoutView(View):
 
 class PaymentView(View):
     def get(self, *args, **kwargs):
-        order = Order.objects.get(user=self.request.user, ordered=False)
+        order = Order.objects.prefetch_related('items__item').get(user=self.request.user, ordered=False)
+        # Don't let the books go while paying
+        extend_reservations(order)
         # if order.billing_address:
         #     messages.info(self.request, "Agregaste una dirección")
         # else:
@@ -199,28 +229,34 @@ class PaymentView(View):
         return render(self.request, "payment.html", context)
 
 
-from django.contrib.auth.mixins import LoginRequiredMixin
-from django.core.exceptions import ObjectDoesNotExist
+class PurchaseHistoryView(LoginRequiredMixin, View):
+    """
+    The user's past orders, newest first, paginated with a cursor. They
+    render from their snapshots (djbooks.orders), one query per page.
+    """
+    paginate_by = 10
 
-class PaymentSummaryView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
+        orders = Order.objects.filter(user=self.request.user, ordered=True).only(
+            'ordered_date', 'subtotal', 'item_quantity', 'paid', 'being_delivered', 'received', 'snapshot')
+        paginator = KeysetPaginator(orders, ('-ordered_date', '-id'), self.paginate_by)
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
-            context = {
-                'object': order
-            }
-            data = {"layout":default_layout,"header":"dark position-relative nav-lg"}
-            context.update(data)
-            return render(self.request, 'purchases.html',context)
-        except ObjectDoesNotExist:
-            messages.warning(self.request, "Tu carrito está vacío")
-            return redirect("/")
+            page = paginator.page(after=self.request.GET.get('after'), before=self.request.GET.get('before'))
+        except InvalidCursor:
+            raise Http404("Página no válida")
+        context = {
+            'orders': page.object_list,
+            'page_obj': page,
+        }
+        data = {"layout":default_layout,"header":"dark position-relative nav-lg"}
+        context.update(data)
+        return render(self.request, 'purchases.html', context)
 
 
 class OrderSummaryView(LoginRequiredMixin, View):
     def get(self, *args, **kwargs):
         try:
-            order = Order.objects.get(user=self.request.user, ordered=False)
+            order = Order.objects.prefetch_related('items__item').get(user=self.request.user, ordered=False)
             context = {
                 'object': order
             }
@@ -233,7 +269,6 @@ class OrderSummaryView(LoginRequiredMixin, View):
 
 
 # pages views 
-from allauth.account.views import LoginView, SignupView
 class CustomLoginView(LoginView):
 
     def get_context_data(self, **kwargs):
@@ -254,31 +289,38 @@ class CustomSignupView(SignupView):
         context.update(data)
         return context
 
-from django.contrib.admin.views.decorators import staff_member_required
+
+def get_image_position(data, key, total):
+    # 1-based position typed in the form, None when empty or out of range
+    try:
+        position = int(data.get(key) or 0)
+    except ValueError:
+        return None
+    return position - 1 if 0 < position <= total else None
 
 @staff_member_required
 def multiple_upload(request, slug):
     book = get_object_or_404(Book, slug=slug)
-    if request.method == 'POST':
-        data = request.POST
-        images = request.FILES.getlist('images')
-
-        print("DATA: ", data)
-
-        for image in images:
-            print("IMG: ",image)
-            ExtraImage.objects.create(
-                book=book,
-                image=image,
-            )
-        return redirect(reverse("admin:djbooks_book_change", args=(book.id,)))
     context = {
         "book": book,
     }
+    if request.method == 'POST':
+        images = request.FILES.getlist('images')
+        results = ingest_images(
+            book,
+            images,
+            cover=get_image_position(request.POST, 'cover', len(images)),
+            back=get_image_position(request.POST, 'back', len(images)),
+        )
+        stored = sum(1 for result in results if result['ok'])
+        if stored == len(results):
+            messages.success(request, f"{stored} imágenes agregadas a {book.title}")
+            return redirect(reverse("admin:djbooks_book_change", args=(book.id,)))
+        messages.warning(request, f"{stored} de {len(results)} imágenes agregadas")
+        context["results"] = results
     return render(request,'admin/multiupload.html',context)
 
 
-
 def pages_404(request):
     context = {"layout":default_layout,"header":default_header}
     return render(request,'pages/404/404.html',context)
@@ -294,135 +336,181 @@ def request_book(request):
     }
     return render(request,'request-book.html',context)
 
-from django.views.generic import ListView
-
 
 def collection(request):
     context={
         "header":"dark",
         "layout":"agency", 
-        # passing a dict with the total of books per category
-        "data": Book.get_book_all_categories_count()
+        # passing a dict with the total of books per category, as a callable
+        # so it is only evaluated when the cached fragment is stale
+        "data": category_book_counts
     }
     return render(request,'collection.html',context)
 
 
+# sort parameter -> (label, ordering), every ordering ends with the id
+# and is backed by an index on Book
+COLLECTION_SORTS = {
+    'recientes': ("Más recientes", ('-id',)),
+    'precio': ("Precio: menor a mayor", ('effective_price', 'id')),
+    '-precio': ("Precio: mayor a menor", ('-effective_price', '-id')),
+    'anio': ("Año: más antiguos", ('year', 'id')),
+    '-anio': ("Año: más recientes", ('-year', '-id')),
+}
+
+# cart.js posts with the CSRF cookie
+@method_decorator(ensure_csrf_cookie, name='dispatch')
 class CollectionListView(ListView):
-    paginate_by = 4
+    """
+    Books of a category, paginated with a cursor (?after= / ?before=)
+    so deep pages cost the same as the first one.
+    """
+    paginate_by = 24
+    page_sizes = (24, 50, 100)
     model = Book
     context_object_name = "category_books"
     template_name = "book_categories/book_category.html"
+    default_sort = 'recientes'
+    # 'approximate' reads Category.book_count, 'exact' runs a COUNT and
+    # None shows no total
+    count_mode = 'approximate'
+
+    def get_category(self):
+        if not hasattr(self, 'category'):
+            self.category = get_object_or_404(Category, slug=self.kwargs['category'])
+        return self.category
+
+    def get_sort(self):
+        sort = self.request.GET.get('sort')
+        return sort if sort in COLLECTION_SORTS else self.default_sort
+
+    def get_paginate_by(self, queryset):
+        try:
+            per_page = int(self.request.GET.get('per_page', self.paginate_by))
+        except ValueError:
+            return self.paginate_by
+        return per_page if per_page in self.page_sizes else self.paginate_by
+
+    def get_filters(self):
+        if not hasattr(self, 'filters'):
+            self.filters = parse_filters(self.request.GET)
+        return self.filters
+
+    def get_facets(self):
+        if not hasattr(self, 'facets'):
+            self.facets = get_facets(self.get_category(), self.get_filters())
+        return self.facets
 
     def get_queryset(self, **kwargs):
-       qs = super().get_queryset(**kwargs)
-       return qs.filter(category__slug=self.kwargs['category'])
+        books = Book.objects.filter(category=self.get_category())
+        if self.get_filters():
+            books = books.filter(facet_filter(self.get_filters()))
+        return books
+
+    def get_count(self, queryset):
+        if self.get_filters():
+            # Exact and already computed with the facets
+            return self.get_facets()['count']
+        if self.count_mode == 'approximate':
+            return self.get_category().book_count
+        if self.count_mode == 'exact':
+            return queryset.count()
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        paginator = KeysetPaginator(queryset, COLLECTION_SORTS[self.get_sort()][1], page_size)
+        try:
+            page = paginator.page(
+                after=self.request.GET.get('after'),
+                before=self.request.GET.get('before'),
+                count=self.get_count(queryset),
+            )
+        except InvalidCursor:
+            raise Http404("Página no válida")
+        return paginator, page, page.object_list, page.has_next or page.has_previous
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        slug = self.kwargs['category']
-        category = Category.objects.get(slug=slug)
-        # Add data for the context
+        # The cursors are added by the pagination links
+        params = self.request.GET.copy()
+        for key in ('after', 'before'):
+            params.pop(key, None)
         data = {"layout":default_layout,
             "header":"dark position-relative nav-lg",
-            "title": category.name,
+            "title": self.get_category().name,
+            "sort": self.get_sort(),
+            "sorts": [(key, label) for key, (label, _) in COLLECTION_SORTS.items()],
+            "per_page": self.get_paginate_by(None),
+            "page_sizes": self.page_sizes,
+            "base_query": params.urlencode(),
+            "facets": self.get_facets()['facets'],
+            "filters": self.get_filters(),
+            # Kept by the sort and page size form
+            "filter_params": [(facet, value) for facet, values in self.get_filters().items()
+                              for value in values],
+            "approximate_count": self.count_mode == 'approximate' and not self.get_filters(),
         }
         context.update(data)
         return context
 
 # cart views
 
-from django.shortcuts import render, get_object_or_404
-from django.contrib.auth.decorators import login_required
+
+def change_cart(request, slug, change):
+    """Runs a CartService change, messages are for the redirecting views"""
+    try:
+        return change(CartService(request.user), slug)
+    except Book.DoesNotExist:
+        raise Http404("No existe ese libro")
+    except OutOfStock:
+        messages.warning(request, "Lo sentimos, ya no hay ejemplares disponibles")
+        return None
+    except OperationalError:
+        # Waited the whole lock timeout, see djbooks.transactions
+        messages.warning(request, "El carrito está ocupado, inténtalo de nuevo")
+        return None
 
 @login_required
 def add_to_cart(request, slug):
-    book = get_object_or_404(Book, slug=slug)
-    # Check availability of the book
-    if book.stock == 0:
-        messages.warning(request, "Lo sentimos, ya no hay ejemplares disponibles")
-        return redirect("djbooks:order-summary")          
-    order_item, created = OrderBook.objects.get_or_create(
-        item=book,
-        user=request.user,
-        ordered=False
-    )
-    order_qs = Order.objects.filter(user=request.user, ordered=False)
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order book is in the order
-        if order.items.filter(item__slug=book.slug).exists():
-            order_item.quantity += 1
-            order_item.save()
-            messages.info(request, "Libro añadido al carrito.")
-            return redirect("djbooks:order-summary")
-        else:
-            order.items.add(order_item)
-            messages.info(request, "Libro añadido al carrito.")
-            return redirect("djbooks:order-summary")
-    else:
-        ordered_date = timezone.now()
-        order = Order.objects.create(
-            user=request.user, ordered_date=ordered_date)
-        order.items.add(order_item)
-        messages.info(request, "This book was added to your cart.")
-        return redirect("djbooks:order-summary")
+    if change_cart(request, slug, lambda cart, slug: cart.add(slug)):
+        messages.info(request, "Libro añadido al carrito.")
+    return redirect("djbooks:order-summary")
 
 @login_required
 def remove_from_cart(request, slug):
-    item = get_object_or_404(Book, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderBook.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            order.items.remove(order_item)
-            order_item.delete()
-            messages.info(request, "Libro retirado del carrito")
-            return redirect("djbooks:order-summary")
-        else:
-            messages.info(request, "This item was not in your cart")
-            return redirect("djbooks:order-summary")
-    else:
-        messages.info(request, "You do not have an active order")
-        return redirect("djbooks:order-summary")
+    if change_cart(request, slug, lambda cart, slug: cart.remove(slug)):
+        messages.info(request, "Libro retirado del carrito")
+    return redirect("djbooks:order-summary")
 
 @login_required
 def remove_single_item_from_cart(request, slug):
-    item = get_object_or_404(Book, slug=slug)
-    order_qs = Order.objects.filter(
-        user=request.user,
-        ordered=False
-    )
-    if order_qs.exists():
-        order = order_qs[0]
-        # check if the order item is in the order
-        if order.items.filter(item__slug=item.slug).exists():
-            order_item = OrderBook.objects.filter(
-                item=item,
-                user=request.user,
-                ordered=False
-            )[0]
-            if order_item.quantity > 1:
-                order_item.quantity -= 1
-                order_item.save()
-            else:
-                order.items.remove(order_item)
-            messages.info(request, "Libro retirado del carrito")
-            return redirect("djbooks:order-summary")
+    if change_cart(request, slug, lambda cart, slug: cart.remove(slug, 1)):
+        messages.info(request, "Libro retirado del carrito")
+    return redirect("djbooks:order-summary")
+
+# Cart JSON endpoints, they answer with the changed line and the cart totals
+@require_POST
+def cart_api(request, slug, action):
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Inicia sesión para usar el carrito"}, status=401)
+    cart = CartService(request.user)
+    try:
+        if action == "add":
+            change = cart.add(slug, int(request.POST.get("quantity", 1)))
+        elif action == "remove":
+            quantity = request.POST.get("quantity")
+            change = cart.remove(slug, int(quantity) if quantity else None)
         else:
-            messages.info(request, "This item was not in your cart")
-            return redirect("djbooks:order-summary")
-    else:
-        messages.info(request, "You do not have an active order")
-        return redirect("djbooks:order-summary")
+            change = cart.set_quantity(slug, int(request.POST["quantity"]))
+    except (KeyError, ValueError):
+        return JsonResponse({"error": "Cantidad no válida"}, status=400)
+    except Book.DoesNotExist:
+        return JsonResponse({"error": "No existe ese libro"}, status=404)
+    except OutOfStock:
+        return JsonResponse({"error": "Lo sentimos, ya no hay ejemplares disponibles"}, status=409)
+    except OperationalError:
+        return JsonResponse({"error": "El carrito está ocupado, inténtalo de nuevo"}, status=503)
+    return JsonResponse(change.as_dict())
 
 # wishlist
 @login_required
@@ -450,3 +538,16 @@ def remove_from_wishlist(request, slug):
         messages.success(request, "Quitaste " + book.title + " de tu wishlist")
     return redirect("djbooks:users-wishlist")
 
+
+# Payment notifications
+
+@csrf_exempt
+@require_POST
+def mercadopago_webhook(request):
+    # Only queued here, process_payment_events does the work
+    try:
+        body = json.loads(request.body or b'{}')
+    except ValueError:
+        body = {}
+    record_mercadopago_event(request.GET, body if isinstance(body, dict) else {})
+    return HttpResponse(status=200)
@@ -12,5 +12,12 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'unice.settings')
+# Serve the async catalog views, see djbooks.async_views
+os.environ.setdefault('DJBOOKS_ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
+
+# Builds the autocomplete index in the background, see djbooks.autocomplete
+from djbooks import autocomplete  # noqa: E402
+
+autocomplete.start()
@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 from pathlib import Path
 import os
 import environ
+from django.core.exceptions import ImproperlyConfigured
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -60,6 +61,10 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    # First so it sees the queries of the other middleware too
+    'djbooks.middleware.query_count_middleware',
+    # Before anything that may write (sessions, auth)
+    'djbooks.routers.replica_pin_middleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -68,7 +73,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'unice.urls'
+# Async catalog views (djbooks.async_views), on by default under unice/asgi.py
+ASYNC_VIEWS = env.bool('DJBOOKS_ASYNC_VIEWS', default=False)
+
+ROOT_URLCONF = 'unice.urls_async' if ASYNC_VIEWS else 'unice.urls'
 
 TEMPLATES = [
     {
@@ -81,6 +89,8 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'djbooks.context_processors.cart',
+                'djbooks.context_processors.catalog_cache',
             ],
         },
     },
@@ -97,8 +107,50 @@ DATABASES = {
         'ENGINE': 'django.db.backends.sqlite3',
         # 'NAME': BASE_DIR / 'db.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # Seconds a writer waits for the lock, see djbooks.signals.configure_sqlite
+        'OPTIONS': {'timeout': 20},
+        # A file, the threaded tests need connections that wait for the
+        # lock and the in-memory test database fails them at once
+        'TEST': {'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3')},
+    }
+}
+
+# Read replica for the catalog, see djbooks.routers. A copy of the SQLite
+# file kept up to date by `python manage.py sync_replica --loop`
+REPLICA_PATH = env('DJBOOKS_REPLICA_PATH', default='')
+if REPLICA_PATH:
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': REPLICA_PATH,
+        'TEST': {'MIRROR': 'default'},
     }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['djbooks.routers.ReplicaRouter']
+# Seconds a user reads everything from the primary after writing
+REPLICA_PIN_SECONDS = 5
+
+
+# Cache
+# Fragment versions and cart summaries live here. Every process has its
+# own locmem cache and never sees what the others invalidate (other
+# workers, import_catalog, process_payment_events...), so it is only
+# allowed with DEBUG. Otherwise the default is a file cache, shared by
+# the processes of one host; use e.g. CACHE_URL=rediscache://127.0.0.1:6379/1
+# for several hosts.
+
+CACHES = {
+    'default': env.cache('CACHE_URL', default='locmemcache://' if DEBUG
+                         else 'filecache://' + os.path.join(BASE_DIR, 'cache')),
 }
+LOCAL_CACHE = CACHES['default']['BACKEND'] == 'django.core.cache.backends.locmem.LocMemCache'
+if LOCAL_CACHE and not DEBUG:
+    raise ImproperlyConfigured('CACHE_URL must be a cache shared by all processes, not locmem')
+
+# A local cache misses invalidations from other processes, what it
+# holds may only be that stale
+FRAGMENT_CACHE_TIMEOUT = 60 if LOCAL_CACHE else 60 * 60 * 24
+CART_SUMMARY_TIMEOUT = 60 if LOCAL_CACHE else 60 * 60
 
 
 # Password validation
@@ -146,6 +198,10 @@ STATIC_ROOT = BASE_DIR / 'djbooks/static'
 
 SASS_PROCESSOR_ROOT = STATIC_ROOT
 
+# Link the bundles of `python manage.py build_assets` instead of the
+# separate sources, see djbooks.assets
+ASSET_BUNDLES = env.bool('DJBOOKS_ASSET_BUNDLES', default=not DEBUG)
+
 # STATIC_URL = '/static/'
 
 # STATIC_ROOT = BASE_DIR / 'static'
@@ -172,4 +228,41 @@ ACCOUNT_EMAIL_VERIFICATION  = 'none'
 
 MERCADO_PAGO_PUBLIC_KEY = env("MERCADO_PAGO_PUBLIC_KEY")
 MERCADO_PAGO_PRIVATE_KEY = env("MERCADO_PAGO_PRIVATE_KEY")
-
+# Public address of the site, for the gateway redirects and notifications
+SITE_URL = env("SITE_URL", default="http://localhost:8000").rstrip("/")
+# Point it at `python manage.py fake_mercadopago` to develop and test offline
+MERCADO_PAGO_API_URL = env("MERCADO_PAGO_API_URL", default="https://api.mercadopago.com")
+# Gateway class per payment method, see djbooks.gateway
+# PAYMENT_GATEWAYS = {'MP': 'djbooks.gateway.DummyGateway'}
+# Seconds books stay reserved in a cart, see djbooks.inventory
+STOCK_RESERVATION_TTL = env.int("STOCK_RESERVATION_TTL", default=60*30)
+# Seconds a cart keeps its copies at most, however often it is extended
+STOCK_RESERVATION_MAX_HOLD = env.int("STOCK_RESERVATION_MAX_HOLD", default=60*60)
+# Seconds a preference is reused while the order lines don't change
+MERCADO_PAGO_PREFERENCE_TTL = env.int("MERCADO_PAGO_PREFERENCE_TTL", default=60*60*24)
+
+
+# Book search
+# Defaults to SQLite FTS5 on SQLite and to the ORM backend elsewhere
+# SEARCH_BACKEND = 'djbooks.search.SQLiteFTSBackend'
+# Seconds between rebuilds of the in-process autocomplete index, done by
+# a background thread the server starts (see djbooks.autocomplete)
+AUTOCOMPLETE_REBUILD_INTERVAL = 60 * 60
+
+
+# Query instrumentation, see djbooks.middleware
+# Sends X-Query-Count/X-Query-Time/X-Query-Repeated response headers
+QUERY_COUNT_HEADERS = DEBUG
+# Times the same statement can run in a request before it counts as an N+1
+QUERY_N_PLUS_ONE_THRESHOLD = 5
+# Most queries a view may run, logged when exceeded and checked by
+# djbooks.testing.assert_query_budget
+# (cold caches, logged in, with a cart)
+QUERY_BUDGETS = {
+    'djbooks:index': 6,
+    'djbooks:book_detail': 9,
+    'djbooks:categoria': 8,
+    'djbooks:order-summary': 7,
+    'djbooks:buscar_libro': 8,
+    'djbooks:purchases': 4,
+}
@@ -13,10 +13,14 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+import re
+
 from django.contrib import admin
 from django.conf import settings
 from django.conf.urls.static import static
-from django.urls import path,include
+from django.urls import path,include,re_path
+
+from djbooks import assets
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -25,6 +29,10 @@ urlpatterns = [
 ]
 
 if settings.DEBUG:
+    # Built bundles with their compressed copies, before the other static files
+    urlpatterns += [
+        re_path(r'^%s%s/(?P<path>.*)$' % (re.escape(settings.STATIC_URL.lstrip('/')), assets.BUILD_DIR), assets.serve),
+    ]
     urlpatterns += static(settings.MEDIA_URL,
                           document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL,
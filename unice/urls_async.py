@@ -0,0 +1,13 @@
+"""
+unice.urls with the async catalog views of djbooks.async_views, used as
+ROOT_URLCONF when settings.ASYNC_VIEWS is on.
+"""
+from django.urls import include, path
+
+from unice import urls
+
+urlpatterns = [
+    path('', include('djbooks.urls_async', namespace='djbooks'))
+    if getattr(pattern, 'namespace', None) == 'djbooks' else pattern
+    for pattern in urls.urlpatterns
+]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'unice.settings')
 
 application = get_wsgi_application()
+
+# Builds the autocomplete index in the background, see djbooks.autocomplete
+from djbooks import autocomplete  # noqa: E402
+
+autocomplete.start()